@@ -16,27 +16,46 @@
 
 import logging
 import sys
-from aws_utils import EBSHelper, AMIHelper
+from aws_utils import EBSHelper, AMIHelper, UtilityPool
 
-if len(sys.argv) != 5:
+# Leading --sparse and --scan-zeros flags select a sparse upload
+upload_args = { }
+args = sys.argv[1:]
+while args and args[0] in ('--sparse', '--scan-zeros'):
+    upload_args['sparse'] = True
+    if args.pop(0) == '--scan-zeros':
+        upload_args['scan_zeros'] = True
+
+if len(args) < 4:
+    print
+    print "Create an AMI on EC2 from one or more bootable image files"
     print
-    print "Create an AMI on EC2 from a bootable image file"
+    print "usage: %s [--sparse] [--scan-zeros] <ec2_region> <ec2_key> <ec2_secret> <image_file> [<image_file> ...]" % sys.argv[0]
     print
-    print "usage: %s <ec2_region> <ec2_key> <ec2_secret> <image_file>" % sys.argv[0]
+    print "--sparse skips the holes in the image files, and --scan-zeros also skips"
+    print "blocks of zeros in the parts the filesystem reports as allocated"
     print
     sys.exit(1)
 
-region = sys.argv[1]
-key = sys.argv[2]
-secret = sys.argv[3]
-image_file = sys.argv[4]
+region = args[0]
+key = args[1]
+secret = args[2]
+image_files = args[3:]
 
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
-ebs_helper = EBSHelper(region, key, secret)
-snapshot = ebs_helper.safe_upload_and_shutdown(image_file)
-
 ami_helper = AMIHelper(region, key, secret)
-ami = ami_helper.register_ebs_ami(snapshot)
 
-print "Got AMI: %s" % ami
+if len(image_files) == 1:
+    ebs_helper = EBSHelper(region, key, secret)
+    snapshot = ebs_helper.safe_upload_and_shutdown(image_files[0], **upload_args)
+    print "Got AMI: %s" % ami_helper.register_ebs_ami(snapshot)
+else:
+    # Upload the whole batch side by side on one utility instance
+    pool = UtilityPool(region, key, secret)
+    try:
+        snapshots = pool.files_to_snapshots(image_files, **upload_args)
+    finally:
+        pool.shutdown()
+    for (image_file, snapshot) in zip(image_files, snapshots):
+        print "Got AMI: %s for %s" % (ami_helper.register_ebs_ami(snapshot), image_file)
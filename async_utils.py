@@ -0,0 +1,405 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Event loop versions of the AMIHelper and EBSHelper build steps
+#
+# This uses trollius, the asyncio port for Python 2, so coroutines are written
+# with "yield From(...)" and return values with "raise Return(...)".  trollius
+# is no longer maintained, but this tree (boto, print statements, Queue) is
+# Python 2 only and asyncio itself needs Python 3 - the coroutines here carry
+# over to asyncio with little more than the import once the tree is ported.  Waits
+# sleep on the event loop.  Blocking boto calls and the upload itself run in a
+# bounded thread pool, so one loop can drive many builds at once:
+#
+#   runner = AsyncRunner()
+#   helpers = [ AsyncAMIHelper(AMIHelper(region, key, secret), runner) for ... ]
+#   amis = runner.run(trollius.gather(*[ helper.launch_wait_snapshot(ami, user_data)
+#                                        for helper in helpers ]))
+
+import functools
+import logging
+import os
+import trollius as asyncio
+from trollius import From, Return
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from boto.exception import EC2ResponseError
+import aws_utils
+import tuning_utils
+
+
+class AsyncRunner(object):
+    """
+    An event loop plus the thread pools that blocking calls are sent to.
+    Status polls get a pool of their own so that a long boto call cannot hold
+    up every wait.  Resource polls made in the same pass of the loop are
+    handed to the shared aws_utils.DescribePoller as one batch, so waiting
+    on many resources takes one thread per connection and kind, not one per
+    resource.
+    """
+
+    def __init__(self, loop=None, max_workers=16, poll_workers=8):
+        super(AsyncRunner, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.poll_executor = ThreadPoolExecutor(poll_workers)
+        # (poller, kind) -> { resource ID: [ futures ] }
+        self.pending = { }
+        self.flush_scheduled = False
+
+    @asyncio.coroutine
+    def call(self, func, *args, **kwargs):
+        """
+        Run func in the thread pool and return its result
+        """
+        result = yield From(self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs)))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def call_poll(self, func, *args, **kwargs):
+        """
+        Run a short status check func in the poll thread pool and return its
+        result
+        """
+        result = yield From(self.loop.run_in_executor(self.poll_executor, functools.partial(func, *args, **kwargs)))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def describe(self, conn, kind, resource_id):
+        """
+        Return a fresh boto object for resource_id, as
+        aws_utils.DescribePoller.describe()
+        """
+        future = asyncio.Future(loop=self.loop)
+        waiters = self.pending.setdefault( (aws_utils.describe_poller(conn), kind), { })
+        waiters.setdefault(resource_id, [ ]).append(future)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self._flush)
+        result = yield From(future)
+        raise Return(result)
+
+    @asyncio.coroutine
+    def poll_resource(self, kind, resource):
+        """
+        As aws_utils.poll_resource()
+        """
+        fresh = yield From(self.describe(resource.connection, kind, resource.id))
+        raise Return(aws_utils.refresh_resource(kind, resource, fresh))
+
+    @asyncio.coroutine
+    def image_state(self, conn, image_id):
+        """
+        As aws_utils.image_state()
+        """
+        image = yield From(self.describe(conn, 'image', image_id))
+        raise Return(image.state if image else None)
+
+    def _flush(self):
+        self.flush_scheduled = False
+        (pending, self.pending) = (self.pending, { })
+        for ((poller, kind), waiters) in pending.items():
+            batch = self.loop.run_in_executor(self.poll_executor, poller.describe_many, kind, list(waiters.keys()))
+            batch.add_done_callback(functools.partial(self._deliver, waiters))
+
+    def _deliver(self, waiters, batch):
+        for (resource_id, futures) in waiters.items():
+            for future in futures:
+                if future.cancelled():
+                    continue
+                if batch.cancelled():
+                    # exception() would raise CancelledError here
+                    future.cancel()
+                elif batch.exception():
+                    future.set_exception(batch.exception())
+                else:
+                    future.set_result(batch.result()[resource_id])
+
+    @asyncio.coroutine
+    def wait_for(self, poll, log, description, ready, failed=(), timeout=300, initial_interval=1, max_interval=15,
+                 backoff=1.5, retry_errors=(EC2ResponseError,), progress=None):
+        """
+        As aws_utils.wait_for(), but poll returns a coroutine and the time
+        between polls is spent on the event loop
+        """
+        waiter = aws_utils.Waiter(log, description, ready, failed, timeout, initial_interval, max_interval,
+                                  backoff, progress)
+        while True:
+            try:
+                state = yield From(poll())
+            except retry_errors as e:
+                waiter.poll_error(e)
+            else:
+                if waiter.done(state):
+                    raise Return(state)
+            yield From(asyncio.sleep(waiter.delay(), loop=self.loop))
+
+    @asyncio.coroutine
+    def wait_for_resource(self, kind, poll, target, log, description, timeout=300, **kwargs):
+        state = yield From(self.wait_for(poll, log, description, [ target ],
+                                         aws_utils.WAIT_FAILURE_STATES[kind].get(target, [ ]),
+                                         timeout=timeout, **kwargs))
+        raise Return(state)
+
+    @asyncio.coroutine
+    def wait_for_instance_state(self, instance, log, final_state='running', timeout=300):
+        """
+        As aws_utils.wait_for_ec2_instance_state() - the instance is
+        terminated if it does not get there
+        """
+        try:
+            yield From(self.wait_for_resource('instance', lambda: self.poll_resource('instance', instance),
+                                              final_state, log, "instance (%s)" % (instance.id), timeout))
+        except Exception:
+            log.error("Instance (%s) failed to enter state (%s)" % (instance.id, final_state), exc_info = True)
+            try:
+                yield From(self.call(aws_utils.terminate_instance, instance))
+            except Exception:
+                log.warning("WARNING: Instance (%s) failed to enter state (%s) and will not terminate - it may still be running" % (instance.id, final_state), exc_info = True)
+                raise Exception("Instance (%s) failed to enter desired state (%s) - it may still be running" % (instance.id, final_state))
+            raise Exception("Instance (%s) failed to enter state (%s) within %d seconds - stopping" % (instance.id, final_state, timeout))
+
+    def run(self, coroutine):
+        """
+        Run coroutine to completion on the loop and return its result
+        """
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.poll_executor.shutdown(wait=True)
+
+
+class AsyncAMIHelper(object):
+    """
+    Coroutine versions of the AMIHelper build steps.  Each AsyncAMIHelper
+    drives one AMIHelper, which holds the state of one build.
+    """
+
+    def __init__(self, helper, runner):
+        super(AsyncAMIHelper, self).__init__()
+        self.helper = helper
+        self.runner = runner
+        self.log = helper.log
+
+    @asyncio.coroutine
+    def register_ebs_ami(self, snapshot_id, **kwargs):
+        ami = yield From(self.runner.call(self.helper.register_ebs_ami, snapshot_id, **kwargs))
+        raise Return(ami)
+
+    @asyncio.coroutine
+    def launch_wait_snapshot(self, ami, user_data, img_size = 10, img_name = None, img_desc = None,
+                             console_log = None, instance_type = None, distro = None, arch = None,
+                             stall_timeout = None):
+        helper = self.helper
+        (img_name, img_desc) = helper._install_image_names(ami, img_name, img_desc)
+        try:
+            yield From(self.runner.call(helper._launch_install_instance, ami, user_data, img_size,
+                                        instance_type, distro, arch))
+            yield From(self.runner.wait_for_instance_state(helper.instance, self.log, final_state='running', timeout=300))
+            yield From(self.runner.call(helper._next_phase, 'install'))
+            self.log.debug("Instance (%s) is now running" % helper.instance.id)
+            self.log.debug("Public DNS will be: %s" % helper.instance.public_dns_name)
+            self.log.debug("Now waiting up to 30 minutes for instance to stop")
+            monitor = helper._install_monitor(console_log, stall_timeout)
+            @asyncio.coroutine
+            def _poll():
+                yield From(self.runner.call_poll(monitor.check))
+                state = yield From(self.runner.poll_resource('instance', helper.instance))
+                raise Return(state)
+            try:
+                yield From(self.runner.wait_for_resource('instance', _poll, 'stopped', self.log,
+                                                         "install on instance (%s)" % (helper.instance.id),
+                                                         timeout=1800, max_interval=30, progress=monitor.progress))
+            finally:
+                yield From(self.runner.call(helper._finish_install_monitor, monitor))
+            yield From(self.runner.call(helper._next_phase, None))
+
+            try:
+                if helper.image_method == 'compare':
+                    new_ami_id = yield From(self._compare_install_images(img_name, img_desc))
+                else:
+                    method = yield From(self.runner.call(helper._image_method))
+                    (new_ami_id, elapsed) = yield From(self._make_install_image(img_name, img_desc, method))
+            finally:
+                self.log.debug("Terminating/deleting instance")
+                yield From(self.runner.call(aws_utils.terminate_instance, helper.instance))
+            self.log.debug("SUCCESS: %s is now available for launch" % (new_ami_id))
+        finally:
+            yield From(self.runner.call(helper._cleanup_install))
+        raise Return(new_ami_id)
+
+    @asyncio.coroutine
+    def _make_install_image(self, img_name, img_desc, method):
+        helper = self.helper
+        start = time()
+        if method == 'snapshot':
+            snapshot = yield From(self.runner.call(helper._snapshot_root_volume))
+            try:
+                yield From(self.runner.wait_for_resource('snapshot', lambda: self.runner.poll_resource('snapshot', snapshot),
+                                                         'completed', self.log, "snapshot (%s)" % (snapshot.id),
+                                                         timeout=1200))
+                new_ami_id = yield From(self.runner.call(helper._register_root_snapshot, snapshot, img_name, img_desc))
+            except Exception as e:
+                # Re-raised by name - the yield can clear the exception being handled
+                yield From(self.runner.call(helper._delete_snapshot, snapshot))
+                raise e
+        else:
+            new_ami_id = yield From(self.runner.call(helper._create_install_image, img_name, img_desc))
+        self.log.debug("Waiting for newly generated AMI to become available")
+        try:
+            yield From(self.runner.wait_for_resource('image', lambda: self.runner.image_state(helper.conn, new_ami_id),
+                                                     'available', self.log, "AMI (%s)" % (new_ami_id),
+                                                     timeout=1200, initial_interval=5))
+        except Exception as e:
+            # Re-raised by name - the yield can clear the exception being handled
+            yield From(self.runner.call(helper._discard_image, new_ami_id))
+            raise e
+        elapsed = yield From(self.runner.call(helper._image_made, method, new_ami_id, start))
+        raise Return((new_ami_id, elapsed))
+
+    @asyncio.coroutine
+    def _compare_install_images(self, img_name, img_desc):
+        methods = tuning_utils.IMAGE_METHODS
+        made = yield From(asyncio.gather(*[ self._make_install_image("%s (%s)" % (img_name, method), img_desc, method)
+                                            for method in methods ], loop=self.runner.loop, return_exceptions=True))
+        for (method, result) in zip(methods, made):
+            if isinstance(result, Exception):
+                self.log.warning("Making AMI by %s failed: %s" % (method, result))
+        new_ami_id = yield From(self.runner.call(self.helper._keep_fastest_image, dict(zip(methods, made))))
+        raise Return(new_ami_id)
+
+
+class AsyncEBSHelper(object):
+    """
+    Coroutine versions of the EBSHelper upload steps.  The copy into the
+    volume still takes a pool thread for as long as it runs, but booting the
+    utility instance and waiting for the volume, its attachment and the
+    snapshot do not.
+    """
+
+    def __init__(self, helper, runner):
+        super(AsyncEBSHelper, self).__init__()
+        self.helper = helper
+        self.runner = runner
+        self.log = helper.log
+
+    @asyncio.coroutine
+    def start_ami(self, placement=None, upload_size=None):
+        helper = self.helper
+        try:
+            yield From(self.runner.call(helper._launch_utility_instance, placement, upload_size))
+            yield From(self.runner.wait_for_instance_state(helper.instance, self.log, final_state='running', timeout=300))
+            guestaddr = helper.instance.public_dns_name
+            self.log.debug("Waiting for SSH access to EC2 instance (User: %s)" % helper.user)
+            try:
+                yield From(self.runner.wait_for(lambda: self.runner.call_poll(helper._ssh_ready, guestaddr, helper.key_file_object.name),
+                                                self.log, "ssh access to (%s)" % (guestaddr), [ True ], timeout=300,
+                                                max_interval=5, retry_errors=(Exception,)))
+            except Exception as e:
+                raise Exception("Unable to gain ssh access after 300 seconds - aborting - %s" % (e))
+            yield From(self.runner.call(helper._prepare_utility_instance))
+        except Exception as e:
+            self.log.error("Exception while starting AMI - cleaning up")
+            self.log.exception(e)
+            yield From(self.terminate_ami())
+
+    @asyncio.coroutine
+    def terminate_ami(self):
+        yield From(self.runner.call(self.helper.terminate_ami))
+
+    @asyncio.coroutine
+    def file_to_snapshot(self, filename, **kwargs):
+        """
+        As EBSHelper.file_to_snapshot()
+        """
+        helper = self.helper
+        timer = helper._upload_timer(filename)
+        (volume, manifest) = yield From(self._file_to_volume(filename, **kwargs))
+        yield From(self.runner.call(timer.done))
+        snapshot = yield From(self.runner.call(helper._create_snapshot, volume, filename))
+        self.log.debug("Waiting up to 1200 seconds for snapshot (%s) to become completed" % (snapshot.id))
+        try:
+            yield From(self.runner.wait_for_resource('snapshot', lambda: self.runner.poll_resource('snapshot', snapshot),
+                                                     'completed', self.log, "snapshot (%s)" % (snapshot.id),
+                                                     timeout=1200, initial_interval=5, max_interval=30,
+                                                     progress=lambda: " progress (%s)" % (snapshot.progress)))
+        except Exception as e:
+            raise Exception("Unable to snapshot volume (%s) - aborting - %s" % (volume.id, e))
+        self.log.debug("Successful creation of snapshot (%s)" % (snapshot.id))
+        yield From(self.runner.call(helper._delete_volume, volume, manifest))
+        raise Return(snapshot.id)
+
+    @asyncio.coroutine
+    def _file_to_volume(self, filename, **kwargs):
+        # As EBSHelper._file_to_volume(), with the volume waits on the loop
+        helper = self.helper
+        settings = helper._upload_settings(filename, **kwargs)
+        (extents, manifest, volume_size) = yield From(self.runner.call(helper._plan_upload, **settings))
+        volume = None
+        if manifest:
+            volume = yield From(self.runner.call(helper._resume_volume, manifest, volume_size))
+        resumed = volume is not None
+
+        if not volume:
+            volume = yield From(self.runner.call(helper._request_volume, volume_size))
+            self.log.debug("Waiting up to 600 seconds for volume (%s) to become available" % (volume.id))
+            try:
+                yield From(self.runner.wait_for_resource('volume', lambda: self.runner.poll_resource('volume', volume),
+                                                         'available', self.log, "volume (%s)" % (volume.id), timeout=600))
+            except Exception as e:
+                raise Exception("Unable to create target volume for EBS AMI - aborting - %s" % (e))
+        yield From(self.runner.call(helper._record_volume, manifest, volume))
+
+        device = settings['device']
+        yield From(self.runner.call(helper._request_attach, volume, device))
+        self.log.debug("Waiting up to 120 seconds for volume (%s) to become in-use" % (volume.id))
+        @asyncio.coroutine
+        def _attachment_state():
+            yield From(self.runner.poll_resource('volume', volume))
+            raise Return(volume.attachment_state())
+        try:
+            yield From(self.runner.wait_for_resource('attachment', _attachment_state, 'attached', self.log,
+                                                     "volume (%s) attachment" % (volume.id), timeout=120))
+        except Exception as e:
+            raise Exception("Unable to attach volume (%s) to instance (%s) aborting - %s" % (volume.id, helper.instance.id, e))
+        local_device = aws_utils.guest_device(device)
+        self.log.debug("Waiting up to 120 seconds for (%s) to appear on the instance" % (local_device))
+        yield From(self.runner.wait_for(lambda: self.runner.call_poll(helper._device_present, local_device), self.log,
+                                        "device (%s)" % (local_device), [ True ], timeout=120,
+                                        initial_interval=0.5, max_interval=5, retry_errors=(Exception,)))
+
+        yield From(self.runner.call(helper._upload_to_volume, extents=extents, volume=volume, manifest=manifest,
+                                    resumed=resumed, **settings))
+        raise Return((volume, manifest))
+
+    @asyncio.coroutine
+    def safe_upload_and_shutdown(self, image_file, **kwargs):
+        """
+        As EBSHelper.safe_upload_and_shutdown()
+        """
+        helper = self.helper
+        if helper.instance:
+            raise Exception("Safe upload can only be used when the utility instance is not already running")
+        placement = yield From(self.runner.call(helper._upload_placement, image_file, kwargs))
+        yield From(self.start_ami(placement, os.path.getsize(image_file)))
+        try:
+            snapshot = yield From(self.file_to_snapshot(image_file, **kwargs))
+        finally:
+            yield From(self.terminate_ami())
+            helper.conn.log_counters()
+        raise Return(snapshot)
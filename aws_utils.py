@@ -21,11 +21,20 @@ import boto.ec2
 import random
 import logging 
 import process_utils
+import upload_utils
+import pipeline_utils
+import console_utils
+import tuning_utils
 import re
+import os
 import os.path
+import threading
+import atexit
+import inspect
+import Queue
 from boto.exception import EC2ResponseError
 from tempfile import NamedTemporaryFile
-from time import sleep
+from time import sleep, time
 from boto.ec2.blockdevicemapping import EBSBlockDeviceType, BlockDeviceMapping
 
 # Boto is very verbose - shut it up
@@ -51,35 +60,466 @@ PVGRUB_AKIS =  { 'us-east-1':      { 'i386':'aki-b2aa75db' ,'x86_64':'aki-b4aa75
                  'ap-northeast-1': { 'i386':'aki-3e99283f' ,'x86_64':'aki-40992841' },
                  'sa-east-1':      { 'i386':'aki-ce8f51d3' ,'x86_64':'aki-c88f51d5' } }
 
+# Attachment points used for concurrent uploads into one utility instance
+BATCH_DEVICES = [ '/dev/sd%s' % (letter) for letter in 'hijklmnop' ]
+
+
+# States from which a resource will never reach the state being waited for
+WAIT_FAILURE_STATES = { 'instance':   { 'running':    [ 'shutting-down', 'terminated' ],
+                                        'stopped':    [ 'shutting-down', 'terminated' ],
+                                        'terminated': [ ] },
+                        'volume':     { 'available':  [ 'error', 'deleting', 'deleted' ],
+                                        'in-use':     [ 'error', 'deleting', 'deleted' ] },
+                        'attachment': { 'attached':   [ 'detaching' ] },
+                        'snapshot':   { 'completed':  [ 'error' ] },
+                        'image':      { 'available':  [ 'failed', 'deregistered', 'invalid' ] } }
+
+
+class TokenBucket(object):
+    """
+    Allows rate calls per second on average, in bursts of up to burst calls.
+    take() blocks until a token is available.  penalize() empties the bucket
+    and holds everyone off for a while after the service pushes back.
+    """
+
+    def __init__(self, rate, burst):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time()
+        self.hold_until = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            self.lock.acquire()
+            try:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if now >= self.hold_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.hold_until - now, (1 - self.tokens) / self.rate)
+            finally:
+                self.lock.release()
+            sleep(delay)
+
+    def penalize(self, seconds):
+        self.lock.acquire()
+        try:
+            self.tokens = 0
+            self.hold_until = max(self.hold_until, time() + seconds)
+        finally:
+            self.lock.release()
 
-def wait_for_ec2_instance_state(instance, log, final_state='running', timeout=300):
-    for i in range(timeout):
-        if i % 10 == 0:
-            log.debug("Waiting for EC2 instance to enter state (%s): %d/%d" % (final_state,i,timeout))
-        try:
-            instance.update()
-        except EC2ResponseError, e:
-            # We occasionally get errors when querying an instance that has just started - ignore them and hope for the best
-            log.warning("EC2ResponseError encountered when querying EC2 instance (%s) - trying to continue" % (instance.id), exc_info = True)
-        except:
-            log.error("Exception encountered when updating status of instance (%s)" % (instance.id), exc_info = True)
+
+class RegionThrottle(object):
+    """
+    Token bucket and per operation call counts shared by every connection to
+    one region
+    """
+
+    def __init__(self, region_name, rate, burst):
+        super(RegionThrottle, self).__init__()
+        self.region_name = region_name
+        self.bucket = TokenBucket(rate, burst)
+        self.calls = { }
+        self.retries = { }
+        self.lock = threading.Lock()
+
+    def count(self, operation, retry=False):
+        self.lock.acquire()
+        try:
+            counts = self.retries if retry else self.calls
+            counts[operation] = counts.get(operation, 0) + 1
+        finally:
+            self.lock.release()
+
+
+# Requests per second and burst size allowed against each region
+API_RATE = 5
+API_BURST = 10
+
+_REGION_THROTTLES = { }
+_REGION_THROTTLES_LOCK = threading.Lock()
+
+def region_throttle(region_name):
+    _REGION_THROTTLES_LOCK.acquire()
+    try:
+        if region_name not in _REGION_THROTTLES:
+            _REGION_THROTTLES[region_name] = RegionThrottle(region_name, API_RATE, API_BURST)
+        return _REGION_THROTTLES[region_name]
+    finally:
+        _REGION_THROTTLES_LOCK.release()
+
+
+# EC2 error codes meaning the request was rejected unprocessed and can be sent again
+THROTTLE_ERRORS = [ 'RequestLimitExceeded', 'Throttling', 'ThrottlingException' ]
+# Error codes for a server side failure - the request may or may not have taken effect
+TRANSIENT_ERRORS = [ 'InternalError', 'Unavailable', 'ServiceUnavailable' ]
+# Calls that may be repeated after a server side failure without side effects
+IDEMPOTENT_PREFIXES = ( 'get_', 'describe_' )
+
+
+class ThrottledConnection(object):
+    """
+    Wraps a boto EC2 connection.  Every call waits for a token from the bucket
+    of its region and is retried with exponential backoff when EC2 throttles
+    it.  Server side errors are only retried for calls that are safe to
+    repeat: reads, and run_instances, which is given a client token so that a
+    repeat cannot start a second instance.  Anything that is not a method is
+    passed straight through to the connection.
+    """
+
+    def __init__(self, conn, max_retries=8, max_backoff=30):
+        super(ThrottledConnection, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.conn = conn
+        self.throttle = region_throttle(conn.region.name)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if not callable(attr):
+            return attr
+        def _call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return _call
+
+    def call(self, operation, *args, **kwargs):
+        method = getattr(self.conn, operation)
+        if operation == 'run_instances' and not kwargs.get('client_token'):
+            kwargs['client_token'] = "ebs-helper-%x" % (random.randrange(2**64))
+        idempotent = operation.startswith(IDEMPOTENT_PREFIXES) or 'client_token' in kwargs
+        attempt = 0
+        while True:
+            self.throttle.bucket.take()
+            self.throttle.count(operation, retry=attempt > 0)
             try:
-                terminate_instance(instance)
-            except:
-                log.warning("WARNING: Instance (%s) failed to enter state (%s) and will not terminate - it may still be running" % (instance.id, final_state), exc_info = True)
-                raise Exception("Instance (%s) failed to fully start or terminate - it may still be running" % (instance.id))
-            raise Exception("Exception encountered when waiting for instance (%s) enter state (%s)" % (instance.id, final_state))
-        if instance.state == final_state:
-            break
-        sleep(1)
+                return method(*args, **kwargs)
+            except EC2ResponseError, e:
+                throttled = e.error_code in THROTTLE_ERRORS
+                transient = e.error_code in TRANSIENT_ERRORS or (e.status >= 500 and not throttled)
+                if attempt >= self.max_retries or not (throttled or (transient and idempotent)):
+                    raise
+                delay = min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.0)
+                if throttled:
+                    # Slow down every caller in the region, not just this one
+                    self.throttle.bucket.penalize(delay)
+                self.log.debug("%s failed with (%s) - retrying in %.1f seconds" % (operation, e.error_code or e.status, delay))
+                sleep(delay)
+                attempt += 1
+
+    def counters(self):
+        """
+        Return { operation: (calls, retries) } for the region of this connection
+        """
+        self.throttle.lock.acquire()
+        try:
+            return dict([ (operation, (count, self.throttle.retries.get(operation, 0)))
+                          for (operation, count) in self.throttle.calls.items() ])
+        finally:
+            self.throttle.lock.release()
+
+    def log_counters(self):
+        for (operation, (count, retries)) in sorted(self.counters().items()):
+            self.log.debug("EC2 API %s: %d calls, %d retries (%s)" % (operation, count, retries, self.throttle.region_name))
+
+
+class DescribePoller(object):
+    """
+    Refreshes every resource that the process is waiting on with one
+    Describe* call per resource kind per tick, however many waiters there are.
+    Callers ask for a resource with describe() and block until a poll that
+    started after their request has finished.  Whichever caller arrives when
+    no poll is scheduled runs the next one on behalf of all the others, no
+    sooner than min_interval after the last.  Use describe_poller() to get the
+    shared poller for a connection.
+    """
+
+    # kind: (connection method, ID filter name)
+    KINDS = { 'instance': ('get_all_instances', 'instance-id'),
+              'volume':   ('get_all_volumes', 'volume-id'),
+              'snapshot': ('get_all_snapshots', 'snapshot-id'),
+              'image':    ('get_all_images', 'image-id') }
+
+    def __init__(self, conn, min_interval=2):
+        super(DescribePoller, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.conn = conn
+        self.min_interval = min_interval
+        self.cond = threading.Condition()
+        self.pending = dict([ (kind, set()) for kind in self.KINDS ])
+        self.results = { }
+        self.generation = 0
+        self.scheduled = False
+        self.taken = False
+        self.last_poll = 0
+        self.calls = 0
+
+    def describe(self, kind, resource_id):
+        """
+        Return a fresh boto object for resource_id, or None if EC2 does not
+        (yet) know about it.
+        """
+        return self.describe_many(kind, [ resource_id ])[resource_id]
 
-    if instance.state != final_state:
+    def describe_many(self, kind, resource_ids):
+        """
+        As describe() for several resources of one kind - returns
+        { resource ID: boto object or None }
+        """
+        self.cond.acquire()
+        try:
+            self.pending[kind].update(resource_ids)
+            # A poll that has already taken its list of IDs will not include us
+            wanted = self.generation + (2 if self.taken else 1)
+            while self.generation < wanted:
+                if self.scheduled:
+                    self.cond.wait()
+                else:
+                    self._lead()
+            return dict([ (resource_id, self.results.get( (kind, resource_id) )) for resource_id in resource_ids ])
+        finally:
+            self.cond.release()
+
+    def update(self, kind, resource):
+        """
+        Refresh resource in place, like its own update() method, and return
+        its state.
+        """
+        return refresh_resource(kind, resource, self.describe(kind, resource.id))
+
+    def _lead(self):
+        # Called with the lock held - run one poll for everyone waiting
+        self.scheduled = True
+        try:
+            # Leave the lock free while waiting out min_interval so that other
+            # waiters can add their IDs to this poll
+            while time() < self.last_poll + self.min_interval:
+                self.cond.wait(self.last_poll + self.min_interval - time())
+            requests = self.pending
+            self.pending = dict([ (kind, set()) for kind in self.KINDS ])
+            self.taken = True
+            self.last_poll = time()
+            self.cond.release()
+            try:
+                results = self._poll(requests)
+            finally:
+                self.cond.acquire()
+            self.results.update(results)
+        finally:
+            self.generation += 1
+            self.scheduled = False
+            self.taken = False
+            self.cond.notify_all()
+
+    def _poll(self, requests):
+        results = { }
+        for (kind, ids) in requests.items():
+            if not ids:
+                continue
+            (method, id_filter) = self.KINDS[kind]
+            # An ID filter, unlike an ID list, does not fail the whole call
+            # when one of the resources does not exist yet
+            found = getattr(self.conn, method)(filters={ id_filter: sorted(ids) })
+            self.calls += 1
+            if kind == 'instance':
+                found = [ instance for reservation in found for instance in reservation.instances ]
+            for resource_id in ids:
+                results[ (kind, resource_id) ] = None
+            for resource in found:
+                results[ (kind, resource.id) ] = resource
+            self.log.debug("Described %d %s(s) in one call" % (len(ids), kind))
+        return results
+
+
+_DESCRIBE_POLLERS = { }
+_DESCRIBE_POLLERS_LOCK = threading.Lock()
+
+def describe_poller(conn):
+    """
+    Return the DescribePoller shared by everything using connection conn
+    """
+    # boto objects refer to the raw connection - key on that, but poll
+    # through a throttled one
+    if isinstance(conn, ThrottledConnection):
+        conn = conn.conn
+    _DESCRIBE_POLLERS_LOCK.acquire()
+    try:
+        if conn not in _DESCRIBE_POLLERS:
+            _DESCRIBE_POLLERS[conn] = DescribePoller(ThrottledConnection(conn))
+        return _DESCRIBE_POLLERS[conn]
+    finally:
+        _DESCRIBE_POLLERS_LOCK.release()
+
+
+def refresh_resource(kind, resource, fresh):
+    """
+    Copy a freshly described boto object over resource, if there is one, and
+    return the state of resource
+    """
+    if fresh:
+        resource.__dict__.update(fresh.__dict__)
+    if kind in ('instance', 'image'):
+        return resource.state
+    return resource.status
+
+
+def poll_resource(kind, resource):
+    """
+    Refresh a boto instance, volume, snapshot or image through the shared
+    poller for its connection and return its state.
+    """
+    return describe_poller(resource.connection).update(kind, resource)
+
+
+class Waiter(object):
+    """
+    The bookkeeping for one wait: wall clock deadline, backoff with jitter and
+    deciding whether a state means done, failed or not yet.  wait_for() drives
+    it with a blocking poll; async_utils drives the same thing from an event
+    loop.
+    """
+
+    def __init__(self, log, description, ready, failed=(), timeout=300, initial_interval=1, max_interval=15,
+                 backoff=1.5, progress=None):
+        super(Waiter, self).__init__()
+        self.log = log
+        self.description = description
+        self.ready = ready
+        self.failed = failed
+        self.timeout = timeout
+        self.deadline = time() + timeout
+        self.interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.progress = progress
+        self.state = None
+
+    def done(self, state):
+        """
+        Record state from a poll and return True if it is one of the ready
+        states.  Raise if it is one of the failed states.
+        """
+        self.state = state
+        if state in self.ready:
+            return True
+        if state in self.failed:
+            raise Exception("%s entered state (%s) and will not reach (%s)" %
+                            (self.description, state, '/'.join(map(str, self.ready))))
+        return False
+
+    def poll_error(self, e):
+        self.log.debug("Error while checking %s - will retry: %s" % (self.description, e))
+
+    def delay(self):
+        """
+        Return how long to sleep before the next poll.  Raise if the deadline
+        has passed.
+        """
+        remaining = self.deadline - time()
+        if remaining <= 0:
+            raise Exception("Timed out after %d seconds waiting for %s to reach (%s) - last state (%s)" %
+                            (self.timeout, self.description, '/'.join(map(str, self.ready)), self.state))
+        self.log.debug("%s is (%s)%s - waiting for (%s) - %d seconds left" %
+                       (self.description, self.state, self.progress() if self.progress else '',
+                        '/'.join(map(str, self.ready)), remaining))
+        delay = min(remaining, self.interval * random.uniform(0.5, 1.5))
+        self.interval = min(self.max_interval, self.interval * self.backoff)
+        return delay
+
+
+def wait_for(poll, log, description, ready, failed=(), timeout=300, initial_interval=1, max_interval=15,
+             backoff=1.5, retry_errors=(EC2ResponseError,), progress=None):
+    """
+    Call poll() until it returns one of the states in ready and return that
+    state.  Raise if it returns one of the states in failed, or if timeout
+    seconds of wall clock time pass first - time spent inside poll() counts.
+    Polls start initial_interval apart and back off to max_interval, with
+    jitter so that concurrent waiters do not poll in step.  Exceptions in
+    retry_errors are treated as "not ready yet".  progress is an optional
+    callable returning extra detail for the debug log.
+    """
+    waiter = Waiter(log, description, ready, failed, timeout, initial_interval, max_interval, backoff, progress)
+    while True:
+        try:
+            state = poll()
+        except retry_errors, e:
+            waiter.poll_error(e)
+        else:
+            if waiter.done(state):
+                return state
+        sleep(waiter.delay())
+
+
+def wait_for_resource(kind, poll, target, log, description, timeout=300, **kwargs):
+    """
+    wait_for() a single target state, failing early on the states listed for
+    this kind of resource in WAIT_FAILURE_STATES.
+    """
+    return wait_for(poll, log, description, [ target ], WAIT_FAILURE_STATES[kind].get(target, [ ]),
+                    timeout=timeout, **kwargs)
+
+
+def wait_for_ec2_instance_state(instance, log, final_state='running', timeout=300):
+    try:
+        wait_for_resource('instance', lambda: poll_resource('instance', instance), final_state, log, "instance (%s)" % (instance.id), timeout)
+    except:
+        log.error("Instance (%s) failed to enter state (%s)" % (instance.id, final_state), exc_info = True)
         try:
             terminate_instance(instance)
         except:
             log.warning("WARNING: Instance (%s) failed to enter state (%s) and will not terminate - it may still be running" % (instance.id, final_state), exc_info = True)
             raise Exception("Instance (%s) failed to enter desired state (%s) - it may still be running" % (instance.id, final_state))
-        raise Exception("Instance failed to start after %d seconds - stopping" % (timeout))
+        raise Exception("Instance (%s) failed to enter state (%s) within %d seconds - stopping" % (instance.id, final_state, timeout))
+
+
+def image_state(conn, image_id):
+    # A freshly created AMI is sometimes not visible to queries right away -
+    # treat that the same as pending
+    image = describe_poller(conn).describe('image', image_id)
+    if not image:
+        return None
+    return image.state
+
+
+def wait_for_ec2_image(conn, image_id, log, timeout=1200):
+    wait_for_resource('image', lambda: image_state(conn, image_id), 'available', log, "AMI (%s)" % (image_id),
+                      timeout, initial_interval=5)
+    return describe_poller(conn).describe('image', image_id)
+
+
+_EC2_CONNECTIONS = { }
+_EC2_CONNECTIONS_LOCK = threading.Lock()
+
+def ec2_connection(ec2_region, access_key, secret_key):
+    """
+    Return the ThrottledConnection shared by everything in this process that
+    talks to ec2_region with these credentials.  The region lookup and the
+    connection, along with its pool of keep-alive HTTP connections, are made
+    once and reused.
+    """
+    key = (ec2_region, access_key, secret_key)
+    _EC2_CONNECTIONS_LOCK.acquire()
+    try:
+        if key not in _EC2_CONNECTIONS:
+            region = boto.ec2.get_region(ec2_region, aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+            if not region:
+                raise Exception("Unknown EC2 region (%s)" % (ec2_region))
+            _EC2_CONNECTIONS[key] = ThrottledConnection(region.connect(aws_access_key_id=access_key,
+                                                                       aws_secret_access_key=secret_key))
+        return _EC2_CONNECTIONS[key]
+    finally:
+        _EC2_CONNECTIONS_LOCK.release()
+
+
+def guest_device(device):
+    # Xen guests see /dev/sdX as /dev/xvdX
+    return device.replace("/dev/sd", "/dev/xvd")
 
 
 def terminate_instance(instance):
@@ -94,17 +534,33 @@ def terminate_instance(instance):
 
 class AMIHelper(object):
 
-    def __init__(self, ec2_region, access_key, secret_key):
+    def __init__(self, ec2_region, access_key, secret_key, connection = None, instance_type = 'm1.small',
+                 history = None, policy = 'time', image_method = 'create_image'):
         super(AMIHelper, self).__init__()
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         try:
-            self.region = boto.ec2.get_region(ec2_region, aws_access_key_id=access_key, aws_secret_access_key=secret_key)
-            self.conn = self.region.connect(aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+            self.conn = connection or ec2_connection(ec2_region, access_key, secret_key)
+            self.region = self.conn.region
         except Exception as e:
             self.log.error("Exception while attempting to establish EC2 connection")
             raise
         self.security_group = None
         self.instance = None
+        # Instance type, or 'auto' to choose one from the timings in history
+        # by policy - 'time' or 'cost'
+        self.instance_type = instance_type
+        self.history = history
+        if (instance_type == 'auto' or image_method in ('auto', 'compare')) and not history:
+            self.history = tuning_utils.InstanceHistory()
+        self.policy = policy
+        self.timer = None
+        # How the finished install becomes an AMI:
+        #   'create_image' - CreateImage on the stopped instance
+        #   'snapshot'     - snapshot its root volume and register that, as
+        #                    register_ebs_ami() does
+        #   'compare'      - both at once, keeping whichever is available first
+        #   'auto'         - whichever has been faster in this region so far
+        self.image_method = image_method
 
     def register_ebs_ami(self, snapshot_id, arch = 'x86_64', default_ephem_map = True,
                          img_name = None, img_desc = None):
@@ -144,38 +600,120 @@ class AMIHelper(object):
 
 
     def launch_wait_snapshot(self, ami, user_data, img_size = 10, img_name = None, img_desc = None,
-                             remote_access_cmd = None):
+                             remote_access_cmd = None, console_log = None, instance_type = None,
+                             distro = None, arch = None, stall_timeout = None):
+        """
+        Launch ami with user_data, wait for the install it runs to power the
+        instance off and return a new AMI made from it.  The install is
+        followed through the console output and abandoned as soon as that
+        shows a failure, or if stall_timeout is given, once it has not changed
+        for that many seconds.  The console output is saved to console_log if
+        given.
+        instance_type overrides the one the helper was created with.  distro
+        names the install in the timing history and arch limits the instance
+        types an 'auto' choice can make.
+        """
 
+        (img_name, img_desc) = self._install_image_names(ami, img_name, img_desc)
+        try:
+            ami = self._launch_wait_snapshot(ami, user_data, img_size, img_name, img_desc, remote_access_cmd,
+                                             console_log, instance_type, distro, arch, stall_timeout)
+        finally:
+            self._cleanup_install()
+        return ami
+
+
+    def _install_image_names(self, ami, img_name, img_desc):
         if not img_name:
             rand_id = random.randrange(2**32)
             # These names need to be unique, hence the pseudo-uuid
             img_name = 'EBSHelper AMI - %s - uuid-%x' % (ami, rand_id)
         if not img_desc:
             img_desc = 'Created from modified snapshot of AMI %s' % (ami)
+        return (img_name, img_desc)
+
+
+    def _cleanup_install(self):
+        if self.security_group:
+            try:
+                self.security_group.delete()
+            except:
+                self.log.warning("Had a temporary security group but failed to delete it on EC2 - group may still be present")
+
+        # TODO: This is sometimes redundant - try to clean up
+        if self.instance:
+            try:
+                self.instance.update()
+                if self.instance.state != 'terminated':
+                    terminate_instance(self.instance)
+            except:
+                self.log.warning("Still have an instance object but either could not query or could not terminate")
+        self.conn.log_counters()
+
+
+    def _launch_wait_snapshot(self, ami, user_data, img_size = 10, img_name = None, img_desc = None,
+                             remote_access_command = None, console_log = None, instance_type = None,
+                             distro = None, arch = None, stall_timeout = None):
+
+        self._launch_install_instance(ami, user_data, img_size, instance_type, distro, arch)
+
+        wait_for_ec2_instance_state(self.instance, self.log, final_state='running', timeout=300)
+        self._next_phase('install')
 
+        self.log.debug("Instance (%s) is now running" % self.instance.id)
+        self.log.debug("Public DNS will be: %s" % self.instance.public_dns_name)
+        self.log.debug("Now waiting up to 30 minutes for instance to stop")
+
+        monitor = self._install_monitor(console_log, stall_timeout)
+        def _poll():
+            monitor.check()
+            return poll_resource('instance', self.instance)
         try:
-            ami = self._launch_wait_snapshot(ami, user_data, img_size, img_name, img_desc, remote_access_cmd)
+            wait_for_resource('instance', _poll, 'stopped', self.log, "install on instance (%s)" % (self.instance.id),
+                              timeout=1800, max_interval=30, progress=monitor.progress)
         finally:
-            if self.security_group:
-                try:
-                    self.security_group.delete()
-                except:
-                    self.log.warning("Had a temporary security group but failed to delete it on EC2 - group may still be present")
+            self._finish_install_monitor(monitor)
+        self._next_phase(None)
 
-            # TODO: This is sometimes redundant - try to clean up
-            if self.instance:
-                try:
-                    self.instance.update()
-                    if self.instance.state != 'terminated':
-                        terminate_instance(self.instance)
-                except:
-                    self.log.warning("Still have an instance object but either could not query or could not terminate")
-        return ami
+        try:
+            if self.image_method == 'compare':
+                new_ami_id = self._compare_install_images(img_name, img_desc)
+            else:
+                (new_ami_id, elapsed) = self._make_install_image(img_name, img_desc, self._image_method())
+        finally:
+            self.log.debug("Terminating/deleting instance")
+            terminate_instance(self.instance)
 
+        self.log.debug("SUCCESS: %s is now available for launch" % (new_ami_id))
+
+        return new_ami_id
+
+
+    def _install_monitor(self, console_log, stall_timeout=None):
+        return console_utils.InstallMonitor(self.conn, self.instance, self.log, console_log,
+                                            stall_timeout=stall_timeout)
+
+
+    def _finish_install_monitor(self, monitor):
+        # Pick up the last of the console for the log, whatever it says
+        monitor.last_fetch = 0
+        try:
+            monitor.check()
+        except Exception as e:
+            self.log.debug("Final console check: %s" % (e))
+        if monitor.log_file:
+            self.log.debug("Console output of instance (%s) saved in (%s)" % (self.instance.id, monitor.log_file))
 
-    def _launch_wait_snapshot(self, ami, user_data, img_size = 10, img_name = None, img_desc = None,
-                             remote_access_command = None):
 
+    def _next_phase(self, phase):
+        # Record the phase that just finished in the history and start timing
+        # the next one, if any
+        if self.timer:
+            self.timer.done()
+            self.timer = tuning_utils.PhaseTimer(self.history, self.timer.distro, self.timer.instance_type, phase) if phase else None
+
+
+    def _launch_install_instance(self, ami, user_data, img_size, instance_type = None, distro = None, arch = None):
         rand_id = random.randrange(2**32)
         # Modified from code taken from Image Factory 
         # Create security group
@@ -193,9 +731,13 @@ class AMIHelper(object):
         block_map['/dev/sda'] = ebs_root
 
         # Now launch it
-        instance_type="m1.small"
+        distro = distro or 'unknown'
+        instance_type = tuning_utils.resolve_instance_type(instance_type or self.instance_type, self.history, distro,
+                                                           [ 'boot', 'install' ], arch, self.policy, log=self.log,
+                                                           installer=True)
         self.log.debug("Starting ami %s in region %s with instance_type %s" % (ami, self.region.name, instance_type))
 
+        self.timer = tuning_utils.PhaseTimer(self.history, distro, instance_type, 'boot')
         reservation = self.conn.run_instances(ami, max_count=1, instance_type=instance_type, 
                                               user_data = user_data,
                                               security_groups = [ security_group_name ],
@@ -206,61 +748,216 @@ class AMIHelper(object):
 
         self.instance = reservation.instances[0]
 
-        wait_for_ec2_instance_state(self.instance, self.log, final_state='running', timeout=300)
 
-        self.log.debug("Instance (%s) is now running" % self.instance.id)
-        self.log.debug("Public DNS will be: %s" % self.instance.public_dns_name)
-        self.log.debug("Now waiting up to 30 minutes for instance to stop")
+    def _image_method(self):
+        if self.image_method == 'auto':
+            return tuning_utils.choose_image_method(self.history, self.region.name, self.log)
+        return self.image_method
+
+
+    def _make_install_image(self, img_name, img_desc, method):
+        # Make an AMI from the stopped install instance by method and wait for
+        # it to be available.  Returns (AMI ID, seconds taken).
+        start = time()
+        if method == 'snapshot':
+            snapshot = self._snapshot_root_volume()
+            try:
+                wait_for_resource('snapshot', lambda: poll_resource('snapshot', snapshot), 'completed', self.log,
+                                  "snapshot (%s)" % (snapshot.id), timeout=1200)
+                new_ami_id = self._register_root_snapshot(snapshot, img_name, img_desc)
+            except:
+                self._delete_snapshot(snapshot)
+                raise
+        else:
+            new_ami_id = self._create_install_image(img_name, img_desc)
+        self.log.debug("Waiting for newly generated AMI to become available")
+        try:
+            wait_for_ec2_image(self.conn, new_ami_id, self.log)
+        except:
+            self._discard_image(new_ami_id)
+            raise
+        return (new_ami_id, self._image_made(method, new_ami_id, start))
+
+
+    def _discard_image(self, ami_id):
+        # Clean up after an AMI that never became available - the exception
+        # that got us here matters more than one from the clean up
+        try:
+            self.deregister_ami(ami_id)
+        except Exception as e:
+            self.log.warning("Unable to deregister AMI (%s) - it and its snapshot may be left behind: %s" % (ami_id, e))
+
+
+    def _image_made(self, method, ami_id, start):
+        elapsed = time() - start
+        self.log.debug("AMI (%s) made by %s was available after %d seconds" % (ami_id, method, elapsed))
+        if self.history:
+            self.history.record(tuning_utils.image_history_key(self.region.name), method, 'available', elapsed)
+        return elapsed
+
+
+    def _compare_install_images(self, img_name, img_desc):
+        # Make an AMI both ways at once, keep the one available first and
+        # deregister the other.  AMI names must be unique, so each is named
+        # after its method.
+        results = { }
+        def _worker(method):
+            try:
+                results[method] = self._make_install_image("%s (%s)" % (img_name, method), img_desc, method)
+            except Exception as e:
+                self.log.warning("Making AMI by %s failed: %s" % (method, e))
+                results[method] = e
+        threads = [ ]
+        for method in tuning_utils.IMAGE_METHODS:
+            thread = threading.Thread(target=_worker, args=(method,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return self._keep_fastest_image(results)
+
+
+    def _keep_fastest_image(self, results):
+        # results is { method: (AMI ID, seconds) or the exception it raised }
+        made = sorted([ (result[1], method, result[0]) for (method, result) in results.items()
+                        if not isinstance(result, Exception) ])
+        if not made:
+            raise results[tuning_utils.IMAGE_METHODS[0]]
+        self.log.info("Image methods in (%s): %s" % (self.region.name,
+                      ", ".join([ "%s %d seconds" % (method, seconds) for (seconds, method, ami_id) in made ])))
+        for (seconds, method, ami_id) in made[1:]:
+            try:
+                self.deregister_ami(ami_id)
+            except Exception as e:
+                self.log.warning("Unable to deregister AMI (%s) - it may be left behind: %s" % (ami_id, e))
+        return made[0][2]
+
+
+    def _snapshot_root_volume(self):
+        # The instance is stopped, so its root volume is consistent
+        root = self.instance.block_device_mapping[self.instance.root_device_name]
+        self.log.debug("Snapshotting root volume (%s) of instance (%s)" % (root.volume_id, self.instance.id))
+        return self.conn.create_snapshot(root.volume_id, 'EBSHelper snapshot of install instance %s' % (self.instance.id))
+
+
+    def _register_root_snapshot(self, snapshot, img_name, img_desc):
+        # The install AMIs boot through pvgrub, so the same AKI and ephemeral
+        # mappings register_ebs_ami() uses apply
+        return self.register_ebs_ami(snapshot.id, arch = self.instance.architecture or 'x86_64',
+                                     img_name = img_name, img_desc = img_desc)
 
-        wait_for_ec2_instance_state(self.instance, self.log, final_state='stopped', timeout=1800)
 
+    def _delete_snapshot(self, snapshot):
+        try:
+            self.conn.delete_snapshot(snapshot.id)
+        except Exception as e:
+            self.log.warning("Unable to delete snapshot (%s) - it may be left behind: %s" % (snapshot.id, e))
+
+
+    def _create_install_image(self, img_name, img_desc):
         # Snapshot
         self.log.debug("Creating a new EBS backed image from completed/stopped EBS instance")
         new_ami_id = self.conn.create_image(self.instance.id, img_name, img_desc)
         self.log.debug("boto creat_image call returned AMI ID: %s" % (new_ami_id))
-        self.log.debug("Waiting for newly generated AMI to become available")
-        # As with launching an instance we have seen occasional issues when trying to query this AMI right
-        # away - give it a moment to settle
-        sleep(10)
-        new_amis = self.conn.get_all_images([ new_ami_id ])
-        new_ami = new_amis[0]
-        timeout = 120
-        interval = 10
-        for i in range(timeout):
-            new_ami.update()
-            if new_ami.state == "available":
-                break
-            elif new_ami.state == "failed":
-                raise Exception("Amazon reports EBS image creation failed")
-            self.log.debug("AMI status (%s) - waiting for 'available' - [%d of %d seconds elapsed]" % (new_ami.state, i * interval, timeout * interval))
-            sleep(interval)
-
-        self.log.debug("Terminating/deleting instance")
-        terminate_instance(self.instance)
- 
-        if new_ami.state != "available":
-            raise Exception("Failed to produce an AMI ID")
+        return new_ami_id
 
-        self.log.debug("SUCCESS: %s is now available for launch" % (new_ami_id))
 
-        return new_ami_id
+    def deregister_ami(self, ami_id):
+        """
+        Deregister ami_id and delete the snapshot behind it
+        """
+        self.log.debug("Deregistering AMI (%s)" % (ami_id))
+        self.conn.deregister_image(ami_id, delete_snapshot = True)
+
+
+    def copy_ami_to_regions(self, ami_id, regions, timeout = 3600):
+        """
+        Copy the root snapshot of EBS AMI ami_id into each of regions and
+        register it there against that region's pvgrub AKI.  The copies run
+        concurrently.  Returns { region: AMI ID }, including this region.
+        """
+        image = self.conn.get_all_images([ ami_id ])[0]
+        try:
+            snapshot_id = image.block_device_mapping[image.root_device_name].snapshot_id
+        except (KeyError, AttributeError):
+            raise Exception("AMI (%s) is not EBS backed - unable to copy it" % (ami_id))
+        amis = self.copy_snapshot_to_regions(snapshot_id, regions, arch = image.architecture,
+                                             img_name = image.name, img_desc = image.description,
+                                             timeout = timeout)
+        amis[self.region.name] = ami_id
+        return amis
+
+
+    def copy_snapshot_to_regions(self, snapshot_id, regions, arch = 'x86_64', default_ephem_map = True,
+                                 img_name = None, img_desc = None, timeout = 3600):
+        """
+        Copy snapshot_id into each of regions and register each copy as an EBS
+        AMI there, as register_ebs_ami() does here.  Returns { region: AMI ID }
+        for the target regions.
+        """
+        amis = { }
+        errors = { }
+
+        def _worker(region):
+            try:
+                amis[region] = self._copy_and_register(region, snapshot_id, arch, default_ephem_map,
+                                                       img_name, img_desc, timeout)
+                self.log.debug("Registered AMI (%s) in region (%s)" % (amis[region], region))
+            except Exception as e:
+                self.log.error("Copy of snapshot (%s) to region (%s) failed" % (snapshot_id, region), exc_info = True)
+                errors[region] = e
+
+        threads = [ ]
+        for region in regions:
+            if region == self.region.name:
+                continue
+            thread = threading.Thread(target=_worker, args=(region,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise Exception("Copy to %d region(s) failed: %s - AMIs that were created: %s" %
+                            (len(errors), ', '.join([ "%s (%s)" % (region, e) for (region, e) in errors.items() ]), amis))
+        return amis
+
+
+    def _copy_and_register(self, region, snapshot_id, arch, default_ephem_map, img_name, img_desc, timeout):
+        if region not in PVGRUB_AKIS:
+            raise Exception("No pvgrub AKI known for region (%s)" % (region))
+        target = AMIHelper(region, self.conn.aws_access_key_id, self.conn.aws_secret_access_key)
+        self.log.debug("Copying snapshot (%s) from (%s) to (%s)" % (snapshot_id, self.region.name, region))
+        copy_id = target.conn.copy_snapshot(self.region.name, snapshot_id,
+                                            description = 'EBSHelper copy of %s from %s' % (snapshot_id, self.region.name))
+        poller = describe_poller(target.conn)
+        def _poll():
+            snapshot = poller.describe('snapshot', copy_id)
+            if not snapshot:
+                return None
+            return snapshot.status
+        wait_for_resource('snapshot', _poll, 'completed', self.log, "snapshot copy (%s) in (%s)" % (copy_id, region),
+                          timeout = timeout, initial_interval = 10, max_interval = 60)
+        return target.register_ebs_ami(copy_id, arch = arch, default_ephem_map = default_ephem_map,
+                                       img_name = img_name, img_desc = img_desc)
 
 
 class EBSHelper(object):
 
-    def __init__(self, ec2_region, access_key, secret_key, utility_ami = None, command_prefix = None, user = 'root'):
+    def __init__(self, ec2_region, access_key, secret_key, utility_ami = None, command_prefix = None, user = 'root',
+                 connection = None, instance_type = 'm1.small', history = None, policy = 'time'):
         super(EBSHelper, self).__init__()
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         try:
-            self.region = boto.ec2.get_region(ec2_region, aws_access_key_id=access_key, aws_secret_access_key=secret_key)
-            self.conn = self.region.connect(aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+            self.conn = connection or ec2_connection(ec2_region, access_key, secret_key)
+            self.region = self.conn.region
         except Exception as e:
             self.log.error("Exception while attempting to establish EC2 connection")
             raise
         if not utility_ami:
-            self.utility_ami = UTILITY_AMIS[ec2_region][0]
-            self.command_prefix = UTILITY_AMIS[ec2_region][1]
-            self.user = UTILITY_AMIS[ec2_region][2]
+            self.utility_ami = UTILITY_AMIS[self.region.name][0]
+            self.command_prefix = UTILITY_AMIS[self.region.name][1]
+            self.user = UTILITY_AMIS[self.region.name][2]
         else:
             self.utility_ami = utility_ami
             self.command_prefix = command_prefix
@@ -269,34 +966,66 @@ class EBSHelper(object):
         self.security_group = None
         self.key_name = None
         self.key_file_object = None
-
-
-    def safe_upload_and_shutdown(self, image_file):
+        self.receiver_path = None
+        # Instance type for the utility instance, or 'auto' to choose one
+        # from the timings in history by policy - 'time' or 'cost'
+        self.instance_type = instance_type
+        self.history = history
+        if instance_type == 'auto' and not history:
+            self.history = tuning_utils.InstanceHistory()
+        self.policy = policy
+        self.launched_type = None
+        self.boot_timer = None
+
+
+    def safe_upload_and_shutdown(self, image_file, **kwargs):
         """
         Launch the AMI - terminate
         upload, create volume and then terminate
+        Keyword arguments are passed through to file_to_snapshot()
         """
         if self.instance:
             raise Exception("Safe upload can only be used when the utility instance is not already running")
 
-        self.start_ami()
+        self.start_ami(self._upload_placement(image_file, kwargs), os.path.getsize(image_file))
         try:
-            snapshot = self.file_to_snapshot(image_file)
+            snapshot = self.file_to_snapshot(image_file, **kwargs)
         finally:
             self.terminate_ami()
+            self.conn.log_counters()
 
         return snapshot
 
-    def start_ami(self):
+    def _upload_placement(self, image_file, kwargs):
+        # A resumable upload needs the utility instance next to the volume left
+        # behind by the last attempt
+        if kwargs.get('resumable'):
+            return upload_utils.manifest_zone(kwargs.get('manifest_file') or upload_utils.manifest_path(image_file))
+        return None
+
+    def start_ami(self, placement=None, upload_size=None):
+        """
+        Start the utility instance, in the availability zone placement if one
+        is given.  upload_size is the number of bytes it is expected to upload,
+        which an 'auto' instance type is chosen for.
+        """
         try:
-            self._start_ami()
+            self._start_ami(placement, upload_size)
         except Exception as e:
             self.log.error("Exception while starting AMI - cleaning up")
             self.log.exception(e)
             self.terminate_ami()
 
 
-    def _start_ami(self):
+    def _start_ami(self, placement=None, upload_size=None):
+        self._launch_utility_instance(placement, upload_size)
+        #self.wait_for_ec2_instance_start(self.instance)
+        wait_for_ec2_instance_state(self.instance, self.log, final_state='running', timeout=300)
+        self.wait_for_ec2_ssh_access(self.instance.public_dns_name, self.key_file_object.name)
+        self._prepare_utility_instance()
+
+
+    def _launch_utility_instance(self, placement=None, upload_size=None):
         rand_id = random.randrange(2**32)
         # Modified from code taken from Image Factory 
         # Create security group
@@ -317,19 +1046,31 @@ class EBSHelper(object):
         self.log.debug("Temporary key is stored in (%s)" % (self.key_file_object.name))
 
         # Now launch it
-        instance_type="m1.small"
+        # The utility AMIs are i386.  Upload times are estimated from the rate
+        # of earlier uploads when the size is known.
+        instance_type = tuning_utils.resolve_instance_type(self.instance_type, self.history, 'utility',
+                                                           [ 'boot', 'upload' ], 'i386', self.policy,
+                                                           size=upload_size, log=self.log)
+        self.launched_type = instance_type
         self.log.debug("Starting ami %s in region %s with instance_type %s" % (self.utility_ami, self.region.name, instance_type))
 
-        reservation = self.conn.run_instances(self.utility_ami, max_count=1, instance_type=instance_type, key_name=self.key_name, security_groups = [ security_group_name ])
+        self.boot_timer = tuning_utils.PhaseTimer(self.history, 'utility', instance_type, 'boot')
+        reservation = self.conn.run_instances(self.utility_ami, max_count=1, instance_type=instance_type, key_name=self.key_name,
+                                              security_groups = [ security_group_name ], placement = placement)
         # I used to have a check for more than one instance here -- but that would be a profound bug in boto
         if len(reservation.instances) == 0:
             raise Exception("Attempt to start instance failed")
 
         self.instance = reservation.instances[0]
-        #self.wait_for_ec2_instance_start(self.instance)
-        wait_for_ec2_instance_state(self.instance, self.log, final_state='running', timeout=300)
-        self.wait_for_ec2_ssh_access(self.instance.public_dns_name, self.key_file_object.name)
+
+
+    def _prepare_utility_instance(self):
+        # Called once the instance is running and answering ssh
+        if self.boot_timer:
+            self.boot_timer.done()
+            self.boot_timer = None
         self.enable_root(self.instance.public_dns_name, self.key_file_object.name, self.user, self.command_prefix) 
+        self.receiver_path = self.push_receiver()
 
 
     def terminate_ami(self):
@@ -347,7 +1088,7 @@ class EBSHelper(object):
         # Remove remote copy of the key
         if self.key_name:
             try:
-                self.conn.delete_key_pair(key_name)
+                self.conn.delete_key_pair(self.key_name)
             except:
                 self.log.warning("Had local key name (%s) but failed to delete on EC2 - key may still be present" % (self.key_name))
 
@@ -355,17 +1096,8 @@ class EBSHelper(object):
         if self.instance:
             try:
                 self.terminate_instance(self.instance)
-                timeout = 60
-                interval = 5
-                for i in range(timeout):
-                    self.instance.update()
-                    if(self.instance.state == "terminated"):
-                        break
-                    elif(i < timeout):
-                        self.log.debug("Instance status (%s) - waiting for 'terminated'. [%d of %d seconds elapsed]" % (self.instance.state, i * interval, timeout * interval))
-                        sleep(interval)
-                    else:
-                        self.log.warining("Timeout waiting for instance to terminate.")
+                wait_for_resource('instance', lambda: poll_resource('instance', self.instance), 'terminated', self.log,
+                                  "instance (%s)" % (self.instance.id), timeout=300)
             except:
                 self.log.warning("Had instance object but failed to terminate - instance may still be running")
 
@@ -378,11 +1110,107 @@ class EBSHelper(object):
             except:
                 self.log.warning("Had a temporary security group but failed to delete it on EC2 - group may still be present")
 
+        # Forget everything so that the helper can start a fresh utility instance
+        self.instance = None
+        self.security_group = None
+        self.key_name = None
+        self.key_file_object = None
+        self.receiver_path = None
+
+
+    def file_to_snapshot(self, filename, compress=True, sparse=False, streams=1, codec=None, link_speed=None,
+                         resumable=False, manifest_file=None, chunk_size=upload_utils.CHUNK_SIZE, retries=3,
+                         receiver=False, direct=False, device="/dev/sdh", limiter=None, scan_zeros=False):
+        """
+        Copy filename into a new EBS volume attached to the utility instance and
+        return the ID of a snapshot of that volume.  If sparse is True only the
+        allocated extents of the file are sent and the holes are skipped on the
+        remote side - a fresh EBS volume already reads back as zeros.  With
+        scan_zeros as well the allocated extents are also scanned for zero
+        blocks, which finds the empty space in fully allocated images.
+        streams is the number of concurrent ssh connections used for the copy.
+        codec overrides compress with a named compression codec (see
+        upload_utils.Codec) such as 'zstd' or 'zstd:19'.  If codec is 'auto'
+        the image is sampled and the codec with the lowest predicted upload time
+        over a link of link_speed bytes per second is used - the link is
+        measured if no speed is given.
+        If resumable is True a manifest of chunk_size chunk hashes is kept in
+        manifest_file (by default next to the image).  After the transfer the
+        volume is hashed chunk by chunk and bad chunks are resent up to retries
+        times.  If the upload still fails the volume is kept and recorded in the
+        manifest, and the next resumable upload of the same file picks it up.
+        If receiver is True the data is written by ebs_receiver.py on the
+        utility instance instead of dd.  It writes in large blocks (bypassing
+        the page cache if direct is True), logs progress and hashes the chunks
+        it wrote, which saves resumable uploads a separate verification pass.
+        device is the name the volume is attached under.  limiter is an optional
+        upload_utils.ThroughputLimiter shared by concurrent uploads - the copy
+        only starts once the limiter lets it.
+        """
+        timer = self._upload_timer(filename)
+        (volume, manifest) = self._file_to_volume(filename, compress, sparse, streams, codec, link_speed,
+                                                  resumable, manifest_file, chunk_size, retries,
+                                                  receiver, direct, device, limiter, scan_zeros)
+        timer.done()
+        snapshot = self._create_snapshot(volume, filename)
+
+        # This can take a _long_ time - wait up to 20 minutes
+        self.log.debug("Waiting up to 1200 seconds for snapshot (%s) to become completed" % (snapshot.id))
+        try:
+            wait_for_resource('snapshot', lambda: poll_resource('snapshot', snapshot), 'completed', self.log, "snapshot (%s)" % (snapshot.id),
+                              timeout=1200, initial_interval=5, max_interval=30,
+                              progress=lambda: " progress (%s)" % (snapshot.progress))
+        except Exception as e:
+            raise Exception("Unable to snapshot volume (%s) - aborting - %s" % (volume.id, e))
+
+        self.log.debug("Successful creation of snapshot (%s)" % (snapshot.id))
+        self._delete_volume(volume, manifest)
+        return snapshot.id
+
+
+    def _upload_timer(self, filename):
+        return tuning_utils.PhaseTimer(self.history, 'utility', self.launched_type, 'upload',
+                                       size=os.path.getsize(filename))
+
+
+    def _file_to_volume(self, filename, compress=True, sparse=False, streams=1, codec=None, link_speed=None,
+                        resumable=False, manifest_file=None, chunk_size=upload_utils.CHUNK_SIZE, retries=3,
+                        receiver=False, direct=False, device="/dev/sdh", limiter=None, scan_zeros=False):
+        # Everything in file_to_snapshot up to the snapshot - returns the
+        # volume holding the image and its manifest, if any
 
-    def file_to_snapshot(self, filename, compress=True):
         # TODO: Add a conservative exception handler over the top of this to delete all remote artifacts on
         #       an exception
 
+        (extents, manifest, volume_size) = self._plan_upload(filename, sparse, resumable, manifest_file,
+                                                             chunk_size, scan_zeros)
+        volume = None
+        if manifest:
+            volume = self._resume_volume(manifest, volume_size)
+        resumed = volume is not None
+
+        if not volume:
+            volume = self._create_volume(volume_size)
+        self._record_volume(manifest, volume)
+
+        self._attach_volume(volume, device)
+        self._upload_to_volume(filename, extents, volume, manifest, resumed, compress, sparse, streams, codec,
+                               link_speed, retries, receiver, direct, device, limiter)
+        return (volume, manifest)
+
+
+    def _upload_settings(self, filename, **kwargs):
+        # file_to_snapshot() arguments by name, with the defaults filled in -
+        # _plan_upload() and _upload_to_volume() take their share of these as
+        # keywords and ignore the rest
+        settings = inspect.getcallargs(self.file_to_snapshot, filename, **kwargs)
+        del settings['self']
+        return settings
+
+
+    def _plan_upload(self, filename, sparse, resumable, manifest_file, chunk_size, scan_zeros, **settings):
+        # Returns the extents to send, the manifest if the upload is resumable
+        # and the size of volume it needs
         if not self.instance:
             raise Exception("You must start the utility instance with start_ami() before uploading files to volumes")
 
@@ -393,158 +1221,475 @@ class EBSHelper(object):
         # Gigabytes, rounded up
         volume_size = int( (filesize/(1024 ** 3)) + 1 )
 
-        self.log.debug("Creating %d GiB volume in (%s) to hold new image" % (volume_size, self.instance.placement))
-        volume = self.conn.create_volume(volume_size, self.instance.placement) 
+        if sparse:
+            extents = upload_utils.file_extents(filename, scan_zeros)
+            self.log.debug("Sparse upload - sending %d bytes in %d extents out of %d total" %
+                           (upload_utils.extents_size(extents), len(extents), filesize))
+        else:
+            extents = [ (0, filesize) ]
 
-        # Volumes can sometimes take a very long time to create
-        # Wait up to 10 minutes for now (plus the time taken for the upload above)
-        self.log.debug("Waiting up to 600 seconds for volume (%s) to become available" % (volume.id))
-        retcode = 1
-        for i in range(60):
-            volume.update()
-            if volume.status == "available":
-                retcode = 0
-                break
-            self.log.debug("Volume status (%s) - waiting for 'available': %d/600" % (volume.status, i*10))
-            sleep(10)
-
-        if retcode:
-            raise Exception("Unable to create target volume for EBS AMI - aborting")
+        manifest = None
+        if resumable:
+            manifest = upload_utils.load_manifest(manifest_file or upload_utils.manifest_path(filename),
+                                                  filename, chunk_size)
+        return (extents, manifest, volume_size)
 
-        # Volume is now available
-        # Attach it
-        self.conn.attach_volume(volume.id, self.instance.id, "/dev/sdh")
 
-        self.log.debug("Waiting up to 120 seconds for volume (%s) to become in-use" % (volume.id))
-        retcode = 1
-        for i in range(12):
-            volume.update()
-            vs = volume.attachment_state()
-            if vs == "attached":
-                retcode = 0
-                break
-            self.log.debug("Volume status (%s) - waiting for 'attached': %d/120" % (vs, i*10))
-            sleep(10)
-
-        if retcode:
-            raise Exception("Unable to attach volume (%s) to instance (%s) aborting" % (volume.id, self.instance.id))
-
-        # TODO: This may not be necessary but it helped with some funnies observed during testing
-        #         At some point run a bunch of builds without the delay to see if it breaks anything
-        self.log.debug("Waiting 20 seconds for EBS attachment to stabilize")
-        sleep(20)
+    def _record_volume(self, manifest, volume):
+        if manifest:
+            manifest.volume_id = volume.id
+            manifest.zone = volume.zone
+            manifest.save()
 
-        # Decompress image into new EBS volume
-        self.log.debug("Copying file into volume")
 
-        # This is big and hairy - it also works, and avoids temporary storage on the local and remote
-        # side of this activity
-        
-        command = 'gzip -c %s | ' % filename
-        command += 'ssh -i %s -F /dev/null  -o ServerAliveInterval=30 -o StrictHostKeyChecking=no ' % self.key_file_object.name
-        command += '-o ConnectTimeout=30 -o UserKnownHostsFile=/dev/null -o PasswordAuthentication=no '
-        command += 'root@%s "gzip -d -c | dd of=/dev/xvdh bs=4k"' % self.instance.public_dns_name
+    def _upload_to_volume(self, filename, extents, volume, manifest, resumed, compress, sparse, streams, codec,
+                          link_speed, retries, receiver, direct, device, limiter, **settings):
+        # Copy the image into the attached volume
+        local_device = guest_device(device)
 
-        self.log.debug("Command will be:\n\n%s\n\n" % command)
+        codec = self._select_codec(filename, extents, compress, codec, link_speed)
+        self.log.info("Uploading (%s) with codec %s" % (filename, codec))
 
-        self.log.debug("Running.  This may take some time.")
-        process_utils.subprocess_check_output([ command ], shell=True)
+        if receiver and not self.receiver_path:
+            raise Exception("The receiver was requested but could not be installed on the utility instance")
+        options = upload_utils.UploadOptions(codec, streams, receiver=self.receiver_path if receiver else None,
+                                             direct=direct, sparse=sparse)
 
+        # Decompress image into new EBS volume
+        self.log.debug("Copying file into volume")
+        if limiter:
+            options.meter = limiter.add
+            limiter.acquire()
+        try:
+            if manifest:
+                try:
+                    self._upload_verified(filename, extents, local_device, options, manifest, resumed, retries)
+                except:
+                    self.log.warning("Upload failed - keeping volume (%s) so that the upload of (%s) can be resumed" % (volume.id, filename))
+                    try:
+                        self._detach_volume(volume)
+                    except:
+                        self.log.warning("Failed to detach volume (%s) - it may need to be detached by hand before resuming" % (volume.id))
+                    raise
+            else:
+                self._upload_extents(filename, extents, local_device, options, zero_filter=sparse)
+        finally:
+            if limiter:
+                limiter.release()
+
+
+    def _create_snapshot(self, volume, filename):
         # Sync before snapshot
         process_utils.ssh_execute_command(self.instance.public_dns_name, self.key_file_object.name, "sync")
 
         # Snapshot EBS volume
         self.log.debug("Taking snapshot of volume (%s)" % (volume.id))
-        snapshot = self.conn.create_snapshot(volume.id, 'EBSHelper snapshot of file "%s"' % filename)
+        return self.conn.create_snapshot(volume.id, 'EBSHelper snapshot of file "%s"' % filename)
 
-        # This can take a _long_ time - wait up to 20 minutes
-        self.log.debug("Waiting up to 1200 seconds for snapshot (%s) to become completed" % (snapshot.id))
-        retcode = 1
-        for i in range(120):
-            snapshot.update()
-            if snapshot.status == "completed":
-                retcode = 0
-                break
-            self.log.debug("Snapshot progress(%s) -  status (%s) - waiting for 'completed': %d/1200" % (str(snapshot.progress), snapshot.status, i*10))
-            sleep(10)
-
-        if retcode:
-            raise Exception("Unable to snapshot volume (%s) - aborting" % (volume.id))
 
-        self.log.debug("Successful creation of snapshot (%s)" % (snapshot.id))
+    def _delete_volume(self, volume, manifest):
+        self._detach_volume(volume)
+
+        self.log.debug("Deleting volume")
+        self.conn.delete_volume(volume.id)
+        # TODO: Verify delete
+
+        if manifest:
+            manifest.delete()
+
+
+    def files_to_snapshots(self, filenames, max_concurrent=None, **kwargs):
+        """
+        Copy several files into their own volumes on the utility instance at the
+        same time and return the snapshot IDs in the same order.  The volumes
+        are attached as /dev/sdh to /dev/sdp.  The number of copies running at
+        once starts at one and grows for as long as that keeps raising the
+        aggregate throughput, up to max_concurrent.  Other keyword arguments
+        are passed to file_to_snapshot().
+        """
+        if not self.instance:
+            raise Exception("You must start the utility instance with start_ami() before uploading files to volumes")
+
+        devices = BATCH_DEVICES[:len(filenames)]
+        limiter = upload_utils.ThroughputLimiter(min(max_concurrent or len(devices), len(devices)), self.log)
+        pending = Queue.Queue()
+        for item in enumerate(filenames):
+            pending.put(item)
+        snapshots = { }
+        errors = { }
+
+        # One worker per device - each one keeps its device busy until the
+        # queue is empty, so volume creation and snapshots overlap with copies
+        def _worker(device):
+            while True:
+                try:
+                    (index, filename) = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    snapshots[index] = self.file_to_snapshot(filename, device=device, limiter=limiter, **kwargs)
+                    self.log.debug("Snapshot (%s) created from (%s)" % (snapshots[index], filename))
+                except Exception as e:
+                    self.log.error("Upload of (%s) on device (%s) failed" % (filename, device), exc_info = True)
+                    errors[filename] = e
+
+        threads = [ ]
+        for device in devices:
+            thread = threading.Thread(target=_worker, args=(device,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise Exception("%d of %d uploads failed: %s" % (len(errors), len(filenames),
+                            ', '.join([ "%s (%s)" % (filename, e) for (filename, e) in errors.items() ])))
+        return [ snapshots[index] for index in range(len(filenames)) ]
+
+
+    def _create_volume(self, volume_size):
+        volume = self._request_volume(volume_size)
+
+        # Volumes can sometimes take a very long time to create
+        # Wait up to 10 minutes for now (plus the time taken for the upload above)
+        self.log.debug("Waiting up to 600 seconds for volume (%s) to become available" % (volume.id))
+        try:
+            wait_for_resource('volume', lambda: poll_resource('volume', volume), 'available', self.log, "volume (%s)" % (volume.id), timeout=600)
+        except Exception as e:
+            raise Exception("Unable to create target volume for EBS AMI - aborting - %s" % (e))
+
+        return volume
+
+
+    def _request_volume(self, volume_size):
+        self.log.debug("Creating %d GiB volume in (%s) to hold new image" % (volume_size, self.instance.placement))
+        return self.conn.create_volume(volume_size, self.instance.placement) 
+
+
+    def _resume_volume(self, manifest, volume_size):
+        # Find the volume left behind by an earlier failed upload, if it is still usable
+        if not manifest.volume_id:
+            return None
+        try:
+            volume = self.conn.get_all_volumes([ manifest.volume_id ])[0]
+        except EC2ResponseError:
+            self.log.debug("Volume (%s) from upload manifest no longer exists - starting over" % (manifest.volume_id))
+            return None
+        if volume.zone != self.instance.placement or volume.status != "available" or volume.size != volume_size:
+            self.log.warning("Volume (%s) from upload manifest is not usable (zone %s, status %s, size %s) - starting over" %
+                             (volume.id, volume.zone, volume.status, volume.size))
+            return None
+        self.log.info("Resuming upload of (%s) into volume (%s)" % (manifest.filename, volume.id))
+        return volume
+
+
+    def _attach_volume(self, volume, device):
+        self._request_attach(volume, device)
+
+        self.log.debug("Waiting up to 120 seconds for volume (%s) to become in-use" % (volume.id))
+        def _attachment_state():
+            poll_resource('volume', volume)
+            return volume.attachment_state()
+        try:
+            wait_for_resource('attachment', _attachment_state, 'attached', self.log, "volume (%s) attachment" % (volume.id), timeout=120)
+        except Exception as e:
+            raise Exception("Unable to attach volume (%s) to instance (%s) aborting - %s" % (volume.id, self.instance.id, e))
+
+        # EC2 reports the attachment before the guest kernel has the device -
+        # wait for the block device itself rather than for a fixed time
+        local_device = guest_device(device)
+        self.log.debug("Waiting up to 120 seconds for (%s) to appear on the instance" % (local_device))
+        wait_for(lambda: self._device_present(local_device), self.log, "device (%s)" % (local_device), [ True ],
+                 timeout=120, initial_interval=0.5, max_interval=5, retry_errors=(Exception,))
+
+
+    def _request_attach(self, volume, device):
+        # Volume is now available
+        # Attach it
+        self.conn.attach_volume(volume.id, self.instance.id, device)
+
+
+    def _device_present(self, local_device):
+        process_utils.ssh_execute_command(self.instance.public_dns_name, self.key_file_object.name,
+                                          "test -b %s" % (local_device))
+        return True
 
+
+    def _detach_volume(self, volume):
         self.log.debug("Detaching volume (%s)" % volume.id)
-        volume.detach()
+        self.conn.detach_volume(volume.id)
 
         self.log.debug("Waiting up to 120 seconds for volume (%s) to become detached (available)" % (volume.id))
-        retcode = 1
-        for i in range(12):
-            volume.update()
-            if volume.status == "available":
-                retcode = 0
-                break
-            self.log.debug("Volume status (%s) - waiting for 'available': %d/120" % (volume.status, i*10))
-            sleep(10)
-
-        if retcode:
-            raise Exception("Unable to detach volume - WARNING - volume may persist and cost money!")
+        try:
+            wait_for_resource('volume', lambda: poll_resource('volume', volume), 'available', self.log, "volume (%s)" % (volume.id), timeout=120)
+        except Exception as e:
+            raise Exception("Unable to detach volume - WARNING - volume may persist and cost money! - %s" % (e))
+
+
+    def _upload_verified(self, filename, extents, device, options, manifest, resumed, retries):
+        # A fresh volume gets all of the data straight away, hashing it on the
+        # way through - a resumed one is checked first so that only the missing
+        # chunks are sent
+        first = not resumed
+        pending = None
+        for attempt in range(retries + 1):
+            if first:
+                to_send = extents
+            else:
+                if pending is None:
+                    if not manifest.hashes:
+                        self.log.debug("Hashing (%s) for verification" % (filename))
+                        manifest.compute(extents)
+                        manifest.save()
+                    pending = self._verify_chunks(manifest, device)
+                if not pending:
+                    return
+                self.log.info("%d of %d chunks of (%s) are missing or damaged on the volume - resending" %
+                              (len(pending), manifest.chunk_count(), filename))
+                # Resend whole chunks, holes included, as a damaged chunk may
+                # have stray data where the image has none
+                to_send = upload_utils.chunk_extents([ (0, manifest.size) ], pending, manifest.chunk_size)
+
+            hash_chunks = None
+            if not manifest.hashes:
+                hash_chunks = (manifest.chunk_size, manifest.size)
+            pending = None
+            try:
+                (local_hashes, remote_hashes) = self._upload_extents(filename, to_send, device, options,
+                                                                     hash_chunks, zero_filter=first and options.sparse)
+                if hash_chunks:
+                    manifest.set_hashes(local_hashes)
+                    manifest.save()
+                if options.receiver:
+                    # The receiver hashed everything it wrote - anything it did
+                    # not write is either verified already or untouched zeros
+                    pending = [ index for index in upload_utils.extent_chunks(to_send, manifest.chunk_size)
+                                if remote_hashes.get(index) != manifest.hashes[index] ]
+            except Exception as e:
+                self.log.warning("Upload attempt %d of %d failed - will verify and resend: %s" % (attempt + 1, retries + 1, e))
+            first = False
 
-        self.log.debug("Deleting volume")
-        volume.delete()
-        # TODO: Verify delete
+        if pending is None:
+            if not manifest.hashes:
+                manifest.compute(extents)
+                manifest.save()
+            pending = self._verify_chunks(manifest, device)
+        if pending:
+            raise Exception("%d chunks of (%s) still failed verification after %d attempts" % (len(pending), filename, retries + 1))
 
-        return snapshot.id
 
+    def _verify_chunks(self, manifest, device):
+        """
+        Hash the volume chunk by chunk on the utility instance and return the
+        indexes of the chunks that do not match the manifest
+        """
+        guestaddr = self.instance.public_dns_name
+        keyfile = self.key_file_object.name
+        script = "/tmp/ebs-helper-hash-%x.sh" % (random.randrange(2**32))
+        process_utils.ssh_upload_data(guestaddr, keyfile, upload_utils.remote_hash_script(manifest, device), script)
+        self.log.debug("Verifying %d chunks of (%s) on the volume" % (manifest.chunk_count(), device))
+        stdout, stderr, retcode = process_utils.ssh_execute_command(guestaddr, keyfile, "sh %s" % script)
+        return upload_utils.mismatched_chunks(manifest, stdout)
+
+
+    def _select_codec(self, filename, extents, compress, codec, link_speed):
+        if codec is None:
+            return upload_utils.Codec('gzip' if compress else 'none')
+        if codec != 'auto':
+            return upload_utils.get_codec(codec)
+
+        # Only consider codecs that can run on both ends of the pipe
+        remote = self.remote_programs(upload_utils.Codec.PROGRAMS.keys())
+        candidates = [ ]
+        for candidate in upload_utils.local_codecs():
+            if all([ program in remote for program in candidate.programs() ]):
+                candidates.append(candidate)
+        if not link_speed:
+            link_speed = self.measure_link_speed()
+        return upload_utils.choose_codec(filename, extents, link_speed, candidates, self.log)
+
+
+    def remote_programs(self, programs):
+        """
+        Return the subset of programs that are in the PATH of the utility instance
+        """
+        command = "for p in %s; do which $p >/dev/null 2>&1 && echo $p; done; true" % (' '.join(programs))
+        stdout, stderr, retcode = process_utils.ssh_execute_command(self.instance.public_dns_name, self.key_file_object.name, command)
+        return [ line.strip() for line in stdout.splitlines() if line.strip() in programs ]
 
-    def wait_for_ec2_ssh_access(self, guestaddr, sshprivkey):
-        self.log.debug("Waiting for SSH access to EC2 instance (User: %s)" % self.user)
-        for i in range(300):
-            if i % 10 == 0:
-                self.log.debug("Waiting for EC2 ssh access: %d/300" % (i))
 
+    def measure_link_speed(self, sample_size=8 * 1024 * 1024):
+        """
+        Return the rate in bytes per second at which incompressible data can be
+        pushed over ssh to the utility instance
+        """
+        guestaddr = self.instance.public_dns_name
+        keyfile = self.key_file_object.name
+        # Time an empty push as well so that connection setup is not counted
+        start = time()
+        process_utils.ssh_upload_data(guestaddr, keyfile, '', '/dev/null')
+        setup = time() - start
+        start = time()
+        process_utils.ssh_upload_data(guestaddr, keyfile, os.urandom(sample_size), '/dev/null')
+        elapsed = max(time() - start - setup, 0.001)
+        speed = sample_size / elapsed
+        self.log.debug("Measured link speed to (%s): %.2f MiB/s" % (guestaddr, speed / (1024 ** 2)))
+        return speed
+
+
+    def _upload_extents(self, filename, extents, device, options, hash_chunks=None, zero_filter=False):
+        # A single ssh connection is limited by one cipher thread and one gzip
+        # process - split the data into byte ranges and push each one over its
+        # own connection
+        # If hash_chunks is a (chunk_size, file_size) tuple the data is also
+        # hashed in chunks as it goes, and with the receiver the chunks are
+        # hashed again on the device once written.  Streams are then split on
+        # chunk boundaries so that each chunk is seen by exactly one of them.
+        # Returns dicts of chunk index to local and remote digest.
+        if hash_chunks:
+            groups = upload_utils.split_extents(extents, options.streams, align=hash_chunks[0])
+        else:
+            groups = upload_utils.split_extents(extents, options.streams)
+        local_hashes = { }
+        remote_hashes = { }
+        if len(groups) == 1:
+            (local, remote) = self._upload_stream(filename, groups[0], device, options, 0, hash_chunks, zero_filter)
+            return (local, remote)
+
+        self.log.debug("Uploading with %d concurrent streams" % (len(groups)))
+        errors = [ ]
+        def _worker(stream_id, stream_extents):
             try:
-                process_utils.ssh_execute_command(guestaddr, sshprivkey, "/bin/true", user=self.user)
-                break
-            except:
-                pass
+                (local, remote) = self._upload_stream(filename, stream_extents, device, options, stream_id, hash_chunks, zero_filter)
+                local_hashes.update(local)
+                remote_hashes.update(remote)
+            except Exception as e:
+                self.log.error("Upload stream %d failed" % (stream_id), exc_info = True)
+                errors.append(e)
+
+        threads = [ ]
+        for (i, group) in enumerate(groups):
+            thread = threading.Thread(target=_worker, args=(i, group))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise Exception("%d of %d upload streams failed - first error: %s" % (len(errors), len(groups), errors[0]))
+        return (local_hashes, remote_hashes)
+
+
+    def _upload_stream(self, filename, extents, device, options, stream_id, hash_chunks=None, zero_filter=False):
+        guestaddr = self.instance.public_dns_name
+        keyfile = self.key_file_object.name
+
+        transforms = [ ]
+        line_callback = None
+        if options.receiver:
+            # Offsets travel with the data, so all-zero blocks can be dropped too
+            if zero_filter:
+                transforms.append(pipeline_utils.SparseFilterStage())
+            remote_command = options.receiver_command(device)
+            def line_callback(line):
+                if line.startswith("PROGRESS") or line.startswith("DONE"):
+                    fields = line.split()
+                    self.log.debug("Stream %d: %s %d bytes written in %s seconds" % (stream_id, fields[0].lower(), int(fields[1]), fields[2]))
+        else:
+            # The extents are concatenated into a single stream that the remote script
+            # below splits back up with dd - this avoids temporary storage on both the
+            # local and the remote side of this activity
+            script = "/tmp/ebs-helper-extents-%x.sh" % (random.randrange(2**32))
+            process_utils.ssh_upload_data(guestaddr, keyfile, upload_utils.dd_extent_script(extents, device), script)
+            remote_command = "sh %s" % script
+
+        commands = [ ]
+        codec = options.codec
+        compressor = codec.compress_stage()
+        if compressor or codec.compress_command():
+            remote_command = "%s | %s" % (codec.decompress_command(), remote_command)
+            if not compressor:
+                commands.append(codec.compress_command())
+        commands.append(process_utils.ssh_command(guestaddr, keyfile, remote_command))
+
+        if options.meter:
+            transforms.insert(0, pipeline_utils.MeterStage(options.meter))
+        if hash_chunks:
+            hasher = pipeline_utils.ChunkHashStage(*hash_chunks)
+            transforms.append(hasher)
+        if options.receiver:
+            hash_ranges = [ ]
+            if hash_chunks:
+                for index in upload_utils.extent_chunks(extents, hash_chunks[0]):
+                    offset = index * hash_chunks[0]
+                    hash_ranges.append( (offset, min(hash_chunks[0], hash_chunks[1] - offset)) )
+            transforms.append(pipeline_utils.RecordFramer(hash_ranges))
+        if compressor:
+            # Last, so that it compresses exactly what the remote side reads
+            transforms.append(compressor)
+        sink = pipeline_utils.CommandSink(commands, line_callback)
+        pipeline = pipeline_utils.Pipeline(pipeline_utils.ExtentReader(filename, extents), transforms, sink, self.log)
+
+        self.log.debug("Stream %d command will be:\n\n%s\n\n" % (stream_id, " | ".join([ " ".join(cmd) for cmd in commands ])))
+        self.log.debug("Stream %d running.  This may take some time." % (stream_id))
+        sent = pipeline.run()
+        elapsed = max(pipeline.elapsed, 0.001)
+        self.log.debug("Stream %d sent %d bytes in %.1f seconds (%.2f MiB/s)" %
+                       (stream_id, sent, elapsed, sent / elapsed / (1024 ** 2)))
+        pipeline.log_counters("Stream %d " % (stream_id))
+
+        local_hashes = { }
+        remote_hashes = { }
+        if hash_chunks:
+            local_hashes = hasher.hashes
+            if options.receiver:
+                remote_hashes = upload_utils.parse_receiver_hashes(sink.lines, hash_chunks[0])
+        return (local_hashes, remote_hashes)
+
+
+    def push_receiver(self):
+        """
+        Copy ebs_receiver.py to the utility instance.  Returns the remote path,
+        or None if the copy failed - uploads then fall back to dd.
+        """
+        guestaddr = self.instance.public_dns_name
+        keyfile = self.key_file_object.name
+        local_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ebs_receiver.py")
+        remote_path = "/tmp/ebs_receiver.py"
+        try:
+            f = open(local_path, "r")
+            try:
+                process_utils.ssh_upload_data(guestaddr, keyfile, f.read(), remote_path)
+            finally:
+                f.close()
+            process_utils.ssh_execute_command(guestaddr, keyfile, "python %s --help" % (remote_path))
+        except Exception as e:
+            self.log.warning("Unable to install the upload receiver on (%s): %s" % (guestaddr, e))
+            return None
+        return remote_path
+
+
+    def wait_for_ec2_ssh_access(self, guestaddr, sshprivkey):
+        self.log.debug("Waiting for SSH access to EC2 instance (User: %s)" % self.user)
+        try:
+            wait_for(lambda: self._ssh_ready(guestaddr, sshprivkey), self.log, "ssh access to (%s)" % (guestaddr), [ True ], timeout=300,
+                     max_interval=5, retry_errors=(Exception,))
+        except Exception as e:
+            raise Exception("Unable to gain ssh access after 300 seconds - aborting - %s" % (e))
 
-            sleep(1)
 
-        if i == 299:
-            raise Exception("Unable to gain ssh access after 300 seconds - aborting")
+    def _ssh_ready(self, guestaddr, sshprivkey):
+        process_utils.ssh_execute_command(guestaddr, sshprivkey, "/bin/true", user=self.user)
+        return True
 
 
     def wait_for_ec2_instance_start(self, instance):
         self.log.debug("Waiting for EC2 instance to become active")
-        for i in range(300):
-            if i % 10 == 0:
-                self.log.debug("Waiting for EC2 instance to start: %d/300" % (i))
-            try:
-                instance.update()
-            except EC2ResponseError, e:
-                # We occasionally get errors when querying an instance that has just started - ignore them and hope for the best
-                self.log.warning("EC2ResponseError encountered when querying EC2 instance (%s) - trying to continue" % (instance.id), exc_info = True)
-            except:
-                self.log.error("Exception encountered when updating status of instance (%s)" % (instance.id), exc_info = True)
-                self.status="FAILED"
-                try:
-                    self.terminate_instance(instance)
-                except:
-                    self.log.warning("WARNING: Instance (%s) failed to start and will not terminate - it may still be running" % (instance.id), exc_info = True)
-                    raise Exception("Instance (%s) failed to fully start or terminate - it may still be running" % (instance.id))
-                raise Exception("Exception encountered when waiting for instance (%s) to start" % (instance.id))
-            if instance.state == u'running':
-                break
-            sleep(1)
-
-        if instance.state != u'running':
+        try:
+            wait_for_ec2_instance_state(instance, self.log, final_state='running', timeout=300)
+        except:
             self.status="FAILED"
-            try:
-                self.terminate_instance(instance)
-            except:
-                self.log.warning("WARNING: Instance (%s) failed to start and will not terminate - it may still be running" % (instance.id), exc_info = True)
-                raise Exception("Instance (%s) failed to fully start or terminate - it may still be running" % (instance.id))
-            raise Exception("Instance failed to start after 300 seconds - stopping")
+            raise
 
 
     def terminate_instance(self, instance):
@@ -572,3 +1717,254 @@ class EBSHelper(object):
                 raise Exception('Running /bin/id on %s as root: %s' % (guestaddr, stdout))
         except Exception as e:
             raise Exception('Transfer of authorized_keys to root from %s must have failed - Aborting - %s' % (user, e))
+
+
+class UtilityPool(object):
+    """
+    Keeps started EBSHelper utility instances warm and hands them out to
+    successive uploads, so that a batch of images pays the security group,
+    key pair, boot and enable_root cost once.  Instances are kept per
+    availability zone, at most max_size in total, and are terminated once they
+    have been idle for idle_ttl seconds.  idle_hook, if given, is called with 1
+    when an instance goes idle and with -1 once an idle one is handed out again
+    or terminated, so that the caller can count idle instances that no upload
+    is accounting for.  Extra keyword arguments are passed to the EBSHelper
+    constructor.
+    """
+
+    def __init__(self, ec2_region, access_key, secret_key, max_size=1, idle_ttl=600, idle_hook=None,
+                 **helper_kwargs):
+        super(UtilityPool, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.ec2_region = ec2_region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.idle_hook = idle_hook
+        # Bytes in the last upload, the size new instances are chosen for when
+        # none is given
+        self.last_upload_size = None
+        self.helper_kwargs = helper_kwargs
+        # zone -> list of (helper, time it became idle)
+        self.idle = { }
+        self.busy = [ ]
+        self.starting = 0
+        self.closed = False
+        self.lock = threading.Condition()
+        self.reaper = threading.Thread(target=self._reap_loop)
+        self.reaper.daemon = True
+        self.reaper.start()
+        # Never leave instances running behind us
+        atexit.register(self.shutdown)
+
+    def size(self):
+        return sum([ len(helpers) for helpers in self.idle.values() ]) + len(self.busy) + self.starting
+
+    def acquire(self, zone=None, upload_size=None):
+        """
+        Return a started EBSHelper, in zone if one is given.  Blocks while the
+        pool is at max_size and nothing suitable is idle.  An instance started
+        for the caller is chosen for an upload of upload_size bytes, or the
+        size of the last upload if none is given.
+        """
+        self.lock.acquire()
+        try:
+            while True:
+                if self.closed:
+                    raise Exception("Utility instance pool has been shut down")
+                helper = self._take_idle(zone)
+                if helper:
+                    break
+                if self.size() < self.max_size:
+                    self.starting += 1
+                    helper = None
+                    break
+                if zone and self.idle:
+                    # Make room by dropping an idle instance in another zone
+                    other = self._take_idle(None)
+                    self.lock.release()
+                    try:
+                        self._terminate(other)
+                    finally:
+                        self.lock.acquire()
+                    continue
+                self.lock.wait(5)
+        finally:
+            self.lock.release()
+
+        if helper:
+            if self._healthy(helper):
+                self._mark_busy(helper)
+                return helper
+            self._terminate(helper)
+            self.lock.acquire()
+            self.starting += 1
+            self.lock.release()
+
+        try:
+            helper = self._start(zone, upload_size or self.last_upload_size)
+        finally:
+            self.lock.acquire()
+            self.starting -= 1
+            self.lock.notify_all()
+            self.lock.release()
+        self._mark_busy(helper)
+        return helper
+
+    def release(self, helper, healthy=True):
+        """
+        Return a helper to the pool.  Pass healthy=False to terminate it instead,
+        for instance after an upload failed in a way that may have broken it.
+        """
+        self.lock.acquire()
+        try:
+            if helper in self.busy:
+                self.busy.remove(helper)
+            keep = healthy and not self.closed
+            if keep:
+                self.idle.setdefault(helper.instance.placement, [ ]).append( (helper, time()) )
+                self._idle_changed(1)
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+        if not keep:
+            self._terminate(helper)
+
+    def file_to_snapshot(self, filename, zone=None, **kwargs):
+        """
+        Upload filename on a pooled utility instance - arguments are as for
+        EBSHelper.file_to_snapshot
+        """
+        if kwargs.get('resumable') and not zone:
+            zone = upload_utils.manifest_zone(kwargs.get('manifest_file') or upload_utils.manifest_path(filename))
+        self.last_upload_size = os.path.getsize(filename)
+        helper = self.acquire(zone, self.last_upload_size)
+        healthy = False
+        try:
+            snapshot = helper.file_to_snapshot(filename, **kwargs)
+            healthy = True
+        finally:
+            self.release(helper, healthy)
+        return snapshot
+
+    def files_to_snapshots(self, filenames, zone=None, **kwargs):
+        """
+        Upload several files at once on one pooled utility instance and return
+        the snapshot IDs in the same order - arguments are as for
+        EBSHelper.files_to_snapshots
+        """
+        if kwargs.get('resumable') and not zone:
+            # Resume on the zone of the first file that has a manifest
+            for filename in filenames:
+                zone = upload_utils.manifest_zone(kwargs.get('manifest_file') or upload_utils.manifest_path(filename))
+                if zone:
+                    break
+        # The whole batch goes through the one instance
+        self.last_upload_size = sum([ os.path.getsize(filename) for filename in filenames ])
+        helper = self.acquire(zone, self.last_upload_size)
+        healthy = False
+        try:
+            snapshots = helper.files_to_snapshots(filenames, **kwargs)
+            healthy = True
+        finally:
+            self.release(helper, healthy)
+        return snapshots
+
+    def reap(self):
+        """
+        Terminate instances that have been idle for longer than idle_ttl
+        """
+        expired = [ ]
+        self.lock.acquire()
+        try:
+            now = time()
+            for zone in self.idle.keys():
+                keep = [ ]
+                for (helper, since) in self.idle[zone]:
+                    if now - since >= self.idle_ttl:
+                        expired.append(helper)
+                    else:
+                        keep.append( (helper, since) )
+                if keep:
+                    self.idle[zone] = keep
+                else:
+                    del self.idle[zone]
+            if expired:
+                self.lock.notify_all()
+        finally:
+            self.lock.release()
+        for helper in expired:
+            self.log.debug("Utility instance (%s) idle for %d seconds - terminating" % (helper.instance.id, self.idle_ttl))
+            self._terminate(helper)
+            self._idle_changed(-1)
+
+    def shutdown(self):
+        """
+        Terminate every idle instance and stop handing out new ones.  Busy
+        instances are terminated as they are released.
+        """
+        self.lock.acquire()
+        try:
+            self.closed = True
+            helpers = [ ]
+            for zone in self.idle.keys():
+                helpers.extend([ helper for (helper, since) in self.idle[zone] ])
+            self.idle = { }
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+        for helper in helpers:
+            self._terminate(helper)
+            self._idle_changed(-1)
+
+    def _take_idle(self, zone):
+        # Called with the lock held - most recently used first, so that the
+        # others age out
+        zones = [ zone ] if zone else self.idle.keys()
+        for candidate in zones:
+            if self.idle.get(candidate):
+                (helper, since) = self.idle[candidate].pop()
+                if not self.idle[candidate]:
+                    del self.idle[candidate]
+                self._idle_changed(-1)
+                return helper
+        return None
+
+    def _idle_changed(self, count):
+        if self.idle_hook:
+            self.idle_hook(count)
+
+    def _mark_busy(self, helper):
+        self.lock.acquire()
+        try:
+            self.busy.append(helper)
+        finally:
+            self.lock.release()
+
+    def _healthy(self, helper):
+        try:
+            process_utils.ssh_execute_command(helper.instance.public_dns_name, helper.key_file_object.name, "/bin/true")
+            return True
+        except Exception:
+            self.log.warning("Pooled utility instance (%s) is not answering - replacing it" % (helper.instance.id))
+            return False
+
+    def _start(self, zone, upload_size):
+        helper = EBSHelper(self.ec2_region, self.access_key, self.secret_key, **self.helper_kwargs)
+        helper.start_ami(zone, upload_size)
+        if not helper.instance:
+            raise Exception("Unable to start a utility instance for the pool in region (%s)" % (self.ec2_region))
+        self.log.debug("Started pooled utility instance (%s) in (%s)" % (helper.instance.id, helper.instance.placement))
+        return helper
+
+    def _terminate(self, helper):
+        try:
+            helper.terminate_ami()
+        except Exception:
+            self.log.warning("Failed to terminate pooled utility instance - it may still be running", exc_info = True)
+
+    def _reap_loop(self):
+        while not self.closed:
+            sleep(max(1, min(60, self.idle_ttl / 4)))
+            self.reap()
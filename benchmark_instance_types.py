@@ -0,0 +1,57 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os.path
+import sys
+from aws_utils import AMIHelper
+from pvgrub_utils import do_pw_sub
+from tuning_utils import InstanceHistory, INSTANCE_TYPES, benchmark_instance_types
+
+if len(sys.argv) != 8:
+    print
+    print "Run the same install on several instance types at once and record how long each takes"
+    print
+    print "usage: %s <ec2_region> <ec2_key> <ec2_secret> <install_ami> <install_script> <root_pw> <instance_types>" % sys.argv[0]
+    print
+    print "instance_types is a comma separated list such as m1.small,m1.medium,c1.medium"
+    print "The timings are kept for instance_type 'auto' to choose from"
+    print
+    sys.exit(1)
+
+region = sys.argv[1]
+key = sys.argv[2]
+secret = sys.argv[3]
+install_ami = sys.argv[4]
+install_script = sys.argv[5]
+root_pw = sys.argv[6]
+instance_types = sys.argv[7].split(',')
+
+logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+
+history = InstanceHistory()
+ami_helper = AMIHelper(region, key, secret)
+user_data = do_pw_sub(install_script, root_pw)
+results = benchmark_instance_types(ami_helper, install_ami, user_data, os.path.basename(install_script),
+                                   instance_types, history)
+
+print
+print "%-12s %10s %10s  %s" % ("type", "seconds", "cost", "result")
+for (instance_type, (seconds, error)) in sorted(results.items(), key=lambda item: item[1][0]):
+    cost = ""
+    if instance_type in INSTANCE_TYPES:
+        cost = "%.3f" % (seconds / 3600.0 * INSTANCE_TYPES[instance_type][0])
+    print "%-12s %10d %10s  %s" % (instance_type, seconds, cost, error or "ok")
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import sys
+from matrix_utils import load_matrix, MatrixBuild, format_results
+
+if len(sys.argv) != 6:
+    print
+    print "Build every combination of install script, arch and region in a build matrix"
+    print
+    print "usage: %s <matrix_file> <ec2_key> <ec2_secret> <root_pw> <work_dir>" % sys.argv[0]
+    print
+    sys.exit(1)
+
+matrix = load_matrix(sys.argv[1])
+key = sys.argv[2]
+secret = sys.argv[3]
+root_pw = sys.argv[4]
+work_dir = sys.argv[5]
+
+logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+
+results = MatrixBuild(matrix, key, secret, root_pw, work_dir).run()
+
+print
+print format_results(results)
+
+if [ result for result in results if result['status'] != 'done' ]:
+    sys.exit(1)
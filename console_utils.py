@@ -0,0 +1,187 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Watch an installer through the EC2 console output
+#
+# EC2 only refreshes the console output every few minutes and only keeps the
+# tail of it, so this works on whatever new text each fetch brings and does
+# not rely on seeing every line.
+
+import re
+import logging
+from time import time
+
+# Install phases in the order they happen, with the console lines that start
+# them - Anaconda and debian-installer
+INSTALL_PHASES = [ ('booting',   [ "Linux version" ]),
+                   ('installer', [ "Starting installer", "Running anaconda", "Starting anaconda",
+                                   "Loading additional components" ]),
+                   ('setup',     [ "Retrieving", "Starting automated install", "Checking software selection",
+                                   "Partitioning", "Creating ext4 filesystem", "Detecting disks" ]),
+                   ('packages',  [ "Starting package installation", "Installing the base system",
+                                   "Select and install software", "Installing \S+ \(\d+/\d+\)" ]),
+                   ('bootloader', [ "Installing bootloader", "Installing GRUB" ]),
+                   ('post',      [ "Running post-installation scripts", "Performing post-installation setup tasks",
+                                   "Finishing the installation" ]),
+                   ('complete',  [ "Installation complete", "reboot: Power down", "Power down\." ]) ]
+
+# Console lines that mean the install has failed or is waiting for someone to
+# answer it
+FAILURE_PATTERNS = [ "Traceback \(most recent call last\)",
+                     "An unknown error has occurred",
+                     "Kernel panic",
+                     "The following problem occurred",
+                     "The following error was found while parsing the kickstart",
+                     "Unable to read package metadata",
+                     "Error downloading packages",
+                     "Error populating transaction",
+                     "Please make your choice from above",
+                     "Press ENTER to exit",
+                     "Installation step failed",
+                     "!! ERROR" ]
+
+# Package progress from Anaconda text mode: "Installing bash (143/412)"
+PACKAGE_PROGRESS = "Installing \S+ \((\d+)/(\d+)\)"
+
+
+class InstallMonitor(object):
+    """
+    Follows the console output of an install instance.  check() fetches any
+    new output, works out the phase, and raises as soon as the console shows
+    a failure.  EC2 buffers console output, so a long healthy install can go
+    a while without any - the monitor only gives up on an unchanged console
+    after stall_timeout seconds if one is given.  The whole console seen so
+    far is kept, and written to log_file if one is given.
+    """
+
+    def __init__(self, conn, instance, log=None, log_file=None, stall_timeout=None, fetch_interval=60):
+        super(InstallMonitor, self).__init__()
+        self.log = log or logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.conn = conn
+        self.instance = instance
+        self.log_file = log_file
+        self.stall_timeout = stall_timeout
+        self.fetch_interval = fetch_interval
+        self.console = ""
+        self.last_output = ""
+        self.phase = None
+        self.packages = None
+        self.package_start = None
+        self.start = time()
+        self.last_fetch = 0
+        self.last_change = time()
+
+    def check(self):
+        """
+        Fetch new console output if it is due and raise if the install has
+        failed or stalled
+        """
+        if time() - self.last_fetch < self.fetch_interval:
+            return
+        self.last_fetch = time()
+        output = self.conn.get_console_output(self.instance.id).output or ""
+        new = self.new_text(output)
+        if new:
+            self.last_change = time()
+            self.console += new
+            self.save()
+            self.parse(new)
+        elif self.stall_timeout is not None and time() - self.last_change > self.stall_timeout and \
+                self.phase != 'complete':
+            raise Exception("Install on instance (%s) stalled - no console output for %d seconds in phase (%s)" %
+                            (self.instance.id, time() - self.last_change, self.phase))
+
+    def new_text(self, output):
+        """
+        Return the part of output that has not been seen before.  EC2 returns
+        a window of the most recent output, so the old window may have been
+        partly scrolled off the front.
+        """
+        previous = self.last_output
+        self.last_output = output
+        if output == previous:
+            return ""
+        if output.startswith(previous):
+            return output[len(previous):]
+        # Anything new follows the end of what we had - look for the longest
+        # tail of the old window that is still there
+        for size in (4096, 1024, 256, 64, 16):
+            tail = previous[-size:]
+            index = output.find(tail)
+            if tail and index >= 0:
+                return output[index + len(tail):]
+        return output
+
+    def parse(self, text):
+        for pattern in FAILURE_PATTERNS:
+            m = re.search(pattern, text)
+            if m:
+                line = text[text.rfind('\n', 0, m.start()) + 1:].split('\n')[0]
+                raise Exception("Install on instance (%s) failed in phase (%s): %s" %
+                                (self.instance.id, self.phase, line.strip()))
+        for (index, (phase, patterns)) in enumerate(INSTALL_PHASES):
+            if self.phase and index <= self.phase_index():
+                continue
+            for pattern in patterns:
+                if re.search(pattern, text):
+                    self.phase = phase
+                    self.log.debug("Install on instance (%s) entered phase (%s) after %d seconds" %
+                                   (self.instance.id, phase, time() - self.start))
+                    break
+        progress = re.findall(PACKAGE_PROGRESS, text)
+        if progress:
+            (done, total) = [ int(value) for value in progress[-1] ]
+            if self.package_start is None:
+                self.package_start = (time(), done)
+            self.packages = (done, total)
+
+    def phase_index(self):
+        return [ phase for (phase, patterns) in INSTALL_PHASES ].index(self.phase)
+
+    def eta(self):
+        """
+        Seconds until the package installation is done, going by the rate so
+        far, or None if there is nothing to go on
+        """
+        if not self.packages or not self.package_start:
+            return None
+        (started, first) = self.package_start
+        (done, total) = self.packages
+        if done <= first:
+            return None
+        rate = (done - first) / (time() - started)
+        return (total - done) / rate
+
+    def progress(self):
+        """
+        Progress summary for wait_for() log lines
+        """
+        text = " phase (%s)" % (self.phase)
+        if self.packages:
+            text += " packages %d/%d" % self.packages
+        eta = self.eta()
+        if eta is not None:
+            text += " ETA %d seconds" % (eta)
+        return text
+
+    def save(self):
+        if not self.log_file:
+            return
+        f = open(self.log_file, 'w')
+        try:
+            f.write(self.console)
+        finally:
+            f.close()
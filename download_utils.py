@@ -0,0 +1,901 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Cached downloads of install tree content
+#
+# Kernels and initrds are kept in an on disk cache keyed by URL, along with
+# the ETag, Last-Modified and length the server sent and the SHA256 of the
+# content.  A cached file is revalidated with a conditional GET, so a tree
+# that has not changed costs one request and no data.
+#
+# Checksums are computed as the data arrives, so checking a download against
+# the checksum the tree publishes costs no extra read.  Content that does not
+# match is never linked out and is dropped from the cache.
+
+import os
+import os.path
+import json
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import ctypes
+import ctypes.util
+import pycurl
+from time import time
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.ebshelper/content_cache")
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Files of at least this size are fetched in segments of at least
+# MIN_SEGMENT bytes by a DownloadManager with segments set
+SEGMENT_THRESHOLD = 32 * 1024 * 1024
+MIN_SEGMENT = 4 * 1024 * 1024
+
+# From linux/fs.h - share the blocks of one file with another on filesystems
+# that can, such as btrfs and XFS
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dest):
+    """
+    Make dest a hardlink to src, or a reflink or plain copy where src is on
+    another filesystem.  Anything that changes dest in place will change a
+    hardlinked src as well.
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    src_file = open(src, 'rb')
+    try:
+        dest_file = open(dest, 'wb')
+        try:
+            try:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            except IOError:
+                shutil.copyfileobj(src_file, dest_file, 1024 * 1024)
+        finally:
+            dest_file.close()
+    finally:
+        src_file.close()
+
+
+class Transfer(object):
+    """
+    One download of url into the cache.  start() sets up the pycurl handle
+    that fetches it - as a conditional GET if entry holds validators from an
+    earlier download - done() is called as the handle finishes and finish()
+    stores the result.  With segment_threshold set, a response of at least
+    that many bytes from a server that takes range requests is cut off at
+    the headers and promote is set, so the caller can fetch it again as a
+    SegmentedTransfer.  expected is the (hashlib algorithm, hex digest) the
+    content must match, if known.
+    """
+
+    def __init__(self, cache, url, entry, segment_threshold=None, expected=None):
+        super(Transfer, self).__init__()
+        self.cache = cache
+        self.url = url
+        self.entry = entry
+        self.segment_threshold = segment_threshold
+        self.expected = expected
+        self.promote = False
+        self.headers = { }
+        self.status = None
+        self.code = None
+        self.error = None
+        self.digests = _digests(expected)
+        self.length = 0
+        self.curls = [ ]
+        self.tmp = None
+        self.stats = None
+
+    def start(self, handle):
+        """
+        Set up the transfer on handles from handle() and return them
+        """
+        (fd, self.tmp_path) = tempfile.mkstemp(suffix='.tmp', dir=self.cache.cache_dir)
+        self.tmp = os.fdopen(fd, 'wb')
+        curl = handle()
+        self.setup(curl)
+        self.curls = [ curl ]
+        return self.curls
+
+    def setup(self, curl):
+        curl.setopt(curl.URL, self.url)
+        curl.setopt(curl.CONNECTTIMEOUT, 5)
+        curl.setopt(curl.FOLLOWLOCATION, 1)
+        curl.setopt(curl.WRITEFUNCTION, self._data)
+        curl.setopt(curl.HEADERFUNCTION, self._header)
+        conditions = [ ]
+        if self.entry:
+            if self.entry.get('etag'):
+                conditions.append("If-None-Match: %s" % (self.entry['etag']))
+            if self.entry.get('last_modified'):
+                conditions.append("If-Modified-Since: %s" % (self.entry['last_modified']))
+        curl.setopt(curl.HTTPHEADER, conditions)
+
+    def _header(self, buf):
+        line = buf.strip()
+        if line.startswith("HTTP/"):
+            # Start of a new response - after a redirect, only the last counts
+            self.headers = { }
+            self.status = _status(line)
+        elif ':' in line:
+            (name, value) = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+        elif not line and self.segment_threshold and self.status == 200:
+            length = self.headers.get('content-length')
+            if length and int(length) >= self.segment_threshold and self.headers.get('accept-ranges') == 'bytes':
+                self.promote = True
+
+    def _data(self, buf):
+        if self.promote:
+            # A short count makes libcurl abandon the transfer
+            return 0
+        self.tmp.write(buf)
+        for digest in self.digests.values():
+            digest.update(buf)
+        self.length += len(buf)
+
+    def done(self, curl, error):
+        """
+        Note that curl has finished, with error if it failed.  Returns True
+        once every handle of the transfer has.
+        """
+        self.code = curl.getinfo(curl.HTTP_CODE)
+        self.curls.remove(curl)
+        if error and not self.error:
+            self.error = error
+        return not self.curls
+
+    def abort(self):
+        if self.tmp:
+            self.tmp.close()
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+
+    def finish(self):
+        """
+        Store the download in the cache.  Returns True if new content was
+        downloaded and False if the cached copy was confirmed as current.
+        """
+        if self.error:
+            self.abort()
+            raise Exception("Download of %s failed: %s" % (self.url, self.error))
+        self.tmp.close()
+        if self.code == 304 and self.entry:
+            os.unlink(self.tmp_path)
+            self._verify(dict(self.entry))
+            self.cache._touch(self.url)
+            return False
+        # file:// URLs report 0
+        if self.code not in (0, 200):
+            os.unlink(self.tmp_path)
+            raise Exception("Download of %s failed with HTTP code %d" % (self.url, self.code))
+        expected = self.headers.get('content-length')
+        if expected is not None and self.code == 200 and int(expected) != self.length:
+            os.unlink(self.tmp_path)
+            raise Exception("Download of %s was cut short: %d of %s bytes" % (self.url, self.length, expected))
+        entry = { 'size': self.length, 'etag': self.headers.get('etag'), 'last_modified': self.headers.get('last-modified') }
+        entry.update(_hexdigests(self.digests))
+        try:
+            self._verify(entry)
+        except Exception:
+            os.unlink(self.tmp_path)
+            raise
+        self.cache._store(self.url, self.tmp_path, entry)
+        return True
+
+    def _verify(self, entry):
+        # entry holds the digests of the content.  A mismatch drops any copy
+        # of url from the cache.
+        if not self.expected:
+            return
+        (algorithm, expected) = self.expected
+        if algorithm not in entry:
+            # Cached before this checksum was asked for
+            entry[algorithm] = self.cache.digest(self.url, algorithm)
+        if entry[algorithm].lower() != expected.lower():
+            self.cache.evict(self.url)
+            raise Exception("Checksum mismatch for %s: expected %s %s but got %s" %
+                            (self.url, algorithm, expected, entry[algorithm]))
+
+
+def _digests(expected):
+    # SHA256 is always kept for the cache index, along with the algorithm of
+    # the expected checksum if that is something else
+    digests = { 'sha256': hashlib.sha256() }
+    if expected and expected[0] not in digests:
+        digests[expected[0]] = hashlib.new(expected[0])
+    return digests
+
+
+def _hexdigests(digests):
+    return dict([ (algorithm, digest.hexdigest()) for (algorithm, digest) in digests.items() ])
+
+
+def _status(line):
+    # "HTTP/1.1 206 Partial Content" -> 206
+    try:
+        return int(line.split()[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def preallocate(fd, size):
+    """
+    Reserve size bytes for the file open on fd, so that segments written
+    out of order do not fragment it.  Falls back to a sparse file.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.posix_fallocate(fd, ctypes.c_longlong(0), ctypes.c_longlong(size)) == 0:
+            return
+    except (OSError, AttributeError):
+        pass
+    os.ftruncate(fd, size)
+
+
+class Segment(object):
+    """
+    One range of a SegmentedTransfer, written through its own descriptor
+    positioned at the start of the range
+    """
+
+    def __init__(self, transfer, path, start, end):
+        super(Segment, self).__init__()
+        self.transfer = transfer
+        self.start = start
+        self.end = end
+        self.written = 0
+        self.status = None
+        self.fd = os.open(path, os.O_WRONLY)
+        os.lseek(self.fd, start, os.SEEK_SET)
+
+    def header(self, buf):
+        line = buf.strip()
+        if line.startswith("HTTP/"):
+            self.status = _status(line)
+
+    def write(self, buf):
+        # Anything but the range asked for is refused, which fails the transfer
+        if self.status != 206 or self.written + len(buf) > self.end - self.start:
+            return 0
+        position = 0
+        while position < len(buf):
+            position += os.write(self.fd, buf[position:])
+        self.transfer._stream(self.start + self.written, buf)
+        self.written += len(buf)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SegmentedTransfer(Transfer):
+    """
+    A download of a large file as several range requests at once, which
+    gets past the per-connection limit of a slow mirror.  The file is
+    preallocated beside its cache entry and the completed ranges are
+    recorded next to it, so an interrupted download picks up with just the
+    missing ranges as long as the server still reports the same validators.
+    headers are those of a full response for url.
+    """
+
+    def __init__(self, cache, url, entry, headers, segments, min_segment=MIN_SEGMENT, expected=None):
+        super(SegmentedTransfer, self).__init__(cache, url, entry, expected=expected)
+        self.headers = headers
+        self.size = int(headers['content-length'])
+        self.segments = segments
+        self.min_segment = min_segment
+        self.part_path = cache.data_path(url) + ".part"
+        self.state_path = self.part_path + ".json"
+        self.ranges = self._load_state()
+        self.active = { }
+        # The checksums take the data in order as it arrives.  Data that
+        # arrives ahead of its turn is read back from the file once the
+        # ranges before it are in - usually from the page cache.
+        self.hashed = 0
+
+    def _validators(self):
+        return { 'size': self.size, 'etag': self.headers.get('etag'), 'last_modified': self.headers.get('last-modified') }
+
+    def _load_state(self):
+        # Completed [ start, end ) ranges of an earlier attempt at the same content
+        if not (os.path.exists(self.part_path) and os.path.exists(self.state_path)):
+            return [ ]
+        f = open(self.state_path)
+        try:
+            state = json.load(f)
+        except ValueError:
+            return [ ]
+        finally:
+            f.close()
+        if state.get('validators') != self._validators() or os.path.getsize(self.part_path) != self.size:
+            return [ ]
+        return [ tuple(byte_range) for byte_range in state['ranges'] ]
+
+    def _save_state(self):
+        f = open(self.state_path + ".tmp", 'w')
+        try:
+            json.dump({ 'validators': self._validators(), 'ranges': self.ranges }, f)
+        finally:
+            f.close()
+        os.rename(self.state_path + ".tmp", self.state_path)
+
+    def missing(self):
+        gaps = [ ]
+        position = 0
+        for (start, end) in sorted(self.ranges):
+            if start > position:
+                gaps.append((position, start))
+            position = max(position, end)
+        if position < self.size:
+            gaps.append((position, self.size))
+        return gaps
+
+    def _split(self, gaps):
+        # Halve the largest piece until there is one per segment
+        pieces = list(gaps)
+        while len(pieces) < self.segments:
+            pieces.sort(key=lambda piece: piece[1] - piece[0])
+            (start, end) = pieces[-1]
+            if end - start < 2 * self.min_segment:
+                break
+            middle = start + (end - start) / 2
+            pieces[-1:] = [ (start, middle), (middle, end) ]
+        return pieces
+
+    def start(self, handle):
+        if self.ranges:
+            self.cache.log.debug("Resuming %s with %d of %d bytes missing" %
+                                 (self.url, sum([ end - start for (start, end) in self.missing() ]), self.size))
+        else:
+            fd = os.open(self.part_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
+            try:
+                preallocate(fd, self.size)
+            finally:
+                os.close(fd)
+            self._save_state()
+        for (start, end) in self._split(self.missing()):
+            curl = handle()
+            segment = Segment(self, self.part_path, start, end)
+            curl.setopt(curl.URL, self.url)
+            curl.setopt(curl.CONNECTTIMEOUT, 5)
+            curl.setopt(curl.FOLLOWLOCATION, 1)
+            curl.setopt(curl.RANGE, "%d-%d" % (start, end - 1))
+            curl.setopt(curl.WRITEFUNCTION, segment.write)
+            curl.setopt(curl.HEADERFUNCTION, segment.header)
+            self.active[curl] = segment
+        self.curls = list(self.active.keys())
+        self.cache.log.debug("Fetching %s in %d segments" % (self.url, len(self.curls)))
+        return self.curls
+
+    def done(self, curl, error):
+        segment = self.active.pop(curl)
+        segment.close()
+        self.curls.remove(curl)
+        if not error and segment.status != 206:
+            error = "server answered a range request with %s" % (segment.status)
+        if not error and segment.written != segment.end - segment.start:
+            error = "range %d-%d was cut short" % (segment.start, segment.end - 1)
+        if segment.written:
+            self.ranges.append((segment.start, segment.start + segment.written))
+            self._save_state()
+        if error and not self.error:
+            self.error = error
+        self._catch_up()
+        return not self.curls
+
+    def abort(self):
+        # The partial file and its state stay for the next attempt to resume
+        for segment in self.active.values():
+            segment.close()
+
+    def finish(self):
+        if self.error or self.missing():
+            self.abort()
+            raise Exception("Download of %s failed: %s - the %d bytes fetched are kept to resume from" %
+                            (self.url, self.error or "ranges missing", self.size - sum([ end - start for (start, end) in self.missing() ])))
+        self._catch_up()
+        entry = self._validators()
+        entry.update(_hexdigests(self.digests))
+        try:
+            self._verify(entry)
+        except Exception:
+            # Nothing of this content is worth resuming
+            for path in (self.part_path, self.state_path):
+                os.unlink(path)
+            raise
+        self.cache._store(self.url, self.part_path, entry)
+        os.unlink(self.state_path)
+        return True
+
+    def _stream(self, offset, buf):
+        if offset == self.hashed:
+            for digest in self.digests.values():
+                digest.update(buf)
+            self.hashed += len(buf)
+
+    def _catch_up(self):
+        # Hash whatever is on disk from the hashed position on
+        written = sorted(self.ranges + [ (segment.start, segment.start + segment.written)
+                                         for segment in self.active.values() ])
+        end = self.hashed
+        for (start, stop) in written:
+            if start <= end:
+                end = max(end, stop)
+        if end <= self.hashed:
+            return
+        f = open(self.part_path, 'rb')
+        try:
+            f.seek(self.hashed)
+            while self.hashed < end:
+                data = f.read(min(1024 * 1024, end - self.hashed))
+                if not data:
+                    break
+                for digest in self.digests.values():
+                    digest.update(data)
+                self.hashed += len(data)
+        finally:
+            f.close()
+
+
+class ContentCache(object):
+    """
+    On disk cache of downloaded files keyed by URL, with the least recently
+    used files dropped once it passes max_size.  The index is kept in
+    memory and only read again when another process has replaced it.
+    Changes to it are made under a lock file as well as a thread lock, so
+    separate builds can share one cache directory.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        super(ContentCache, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.index = { }
+        # (inode, size, mtime) of the index file self.index was read from
+        self.index_stat = None
+        # url -> last use not yet written to the index file
+        self.touched = { }
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Partial downloads left behind by builds that died.  Segmented ones
+        # can be resumed, so they are given longer.
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            age = time() - os.path.getmtime(path)
+            if (name.endswith('.tmp') and age > 86400) or (name.endswith(('.part', '.part.json')) and age > 7 * 86400):
+                os.unlink(path)
+
+    def fetch(self, url, dest):
+        """
+        Download url to dest through the cache.  dest is linked to the cached
+        copy where possible, so it must not be changed in place.  Returns
+        True if the content had to be downloaded.
+        """
+        transfer = self.transfer(url)
+        curl = pycurl.Curl()
+        try:
+            transfer.start(lambda: curl)
+            error = None
+            try:
+                curl.perform()
+            except pycurl.error as e:
+                error = e.args[-1]
+            transfer.done(curl, error)
+            downloaded = transfer.finish()
+        finally:
+            curl.close()
+        self.log.debug("%s %s" % ("Downloaded" if downloaded else "Cached copy is current for", url))
+        self.link(url, dest)
+        return downloaded
+
+    def transfer(self, url, segment_threshold=None, expected=None):
+        entry = self.entry(url)
+        if entry and not os.path.exists(self.data_path(url)):
+            entry = None
+        return Transfer(self, url, entry, segment_threshold, expected)
+
+    def entry(self, url):
+        """
+        The index entry for url - size, sha256, etag and last_modified - or
+        None if it is not cached
+        """
+        self.lock.acquire()
+        try:
+            entry = self._read_index().get(url)
+            return dict(entry) if entry else None
+        finally:
+            self.lock.release()
+
+    def digest(self, url, algorithm):
+        """
+        Hash the cached copy of url with algorithm and keep the result in
+        the index
+        """
+        digest = hashlib.new(algorithm)
+        f = open(self.data_path(url), 'rb')
+        try:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                digest.update(data)
+        finally:
+            f.close()
+        def _record(index):
+            if url in index:
+                index[url][algorithm] = digest.hexdigest()
+        self._update_index(_record)
+        return digest.hexdigest()
+
+    def link(self, url, dest):
+        link_or_copy(self.data_path(url), dest)
+
+    def evict(self, url):
+        def _evict(index):
+            if url in index:
+                del index[url]
+                self._remove(url)
+        self._update_index(_evict)
+
+    def data_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def _touch(self, url):
+        # Only a change of content is worth a write - the use is saved with
+        # the next one
+        self.lock.acquire()
+        try:
+            index = self._read_index()
+            if url in index:
+                self.touched[url] = index[url]['used'] = time()
+        finally:
+            self.lock.release()
+
+    def _store(self, url, tmp_path, entry):
+        def _store(index):
+            entry['used'] = time()
+            os.rename(tmp_path, self.data_path(url))
+            index[url] = entry
+            self._evict_lru(index, url)
+        self._update_index(_store)
+
+    def _evict_lru(self, index, keep):
+        size = sum([ entry['size'] for entry in index.values() ])
+        for (used, url) in sorted([ (entry['used'], url) for (url, entry) in index.items() ]):
+            if size <= self.max_size:
+                break
+            if url == keep:
+                continue
+            self.log.debug("Evicting (%s) from the content cache" % (url))
+            size -= index.pop(url)['size']
+            self._remove(url)
+
+    def _remove(self, url):
+        try:
+            os.unlink(self.data_path(url))
+        except OSError:
+            pass
+
+    def _read_index(self):
+        # Called with the thread lock held.  Returns the in memory index,
+        # reading the file again only if it has been replaced since.
+        try:
+            st = os.stat(self.index_path)
+            stat = (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            stat = None
+        if stat == self.index_stat:
+            return self.index
+        index = { }
+        if stat:
+            f = open(self.index_path)
+            try:
+                index = json.load(f)
+            except ValueError:
+                self.log.warning("Content cache index (%s) is not valid JSON - starting a new one" % (self.index_path))
+            finally:
+                f.close()
+        for (url, used) in self.touched.items():
+            if url in index:
+                index[url]['used'] = max(used, index[url].get('used', 0))
+        self.index = index
+        self.index_stat = stat
+        return index
+
+    def _update_index(self, func):
+        # Call func on an up to date index and write it back if it changed,
+        # holding both locks.  Returns whatever func does.
+        self.lock.acquire()
+        try:
+            lock_file = open(os.path.join(self.cache_dir, "index.lock"), 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                index = self._read_index()
+                before = json.dumps(index, sort_keys=True)
+                result = func(index)
+                if self.touched or json.dumps(index, sort_keys=True) != before:
+                    f = open(self.index_path + ".tmp", 'w')
+                    try:
+                        json.dump(index, f, indent=1, sort_keys=True)
+                    finally:
+                        f.close()
+                    os.rename(self.index_path + ".tmp", self.index_path)
+                    st = os.stat(self.index_path)
+                    self.index_stat = (st.st_ino, st.st_size, st.st_mtime)
+                    self.touched = { }
+                return result
+            finally:
+                # Closing the file drops the flock
+                lock_file.close()
+        finally:
+            self.lock.release()
+
+
+class _Batch(object):
+    # The downloads of one fetch_all() call and what has become of them
+
+    def __init__(self, downloads, optional, expected):
+        super(_Batch, self).__init__()
+        self.downloads = downloads
+        self.optional = optional
+        self.expected = expected
+        self.remaining = len(downloads)
+        self.results = { }
+        self.errors = [ ]
+        self.start = time()
+
+
+class DownloadManager(object):
+    """
+    Runs batches of cached downloads at once on one pycurl multi handle.
+    The multi handle keeps its connections open between batches and the
+    easy handles are reused, so each server is connected to once however
+    many files and batches come from it.  DNS and SSL sessions are shared
+    between the handles as well.
+
+    Batches from several threads run together: whichever caller finds the
+    multi handle idle drives it for everyone until its own batch is done,
+    and the others wait for theirs.  The lock only covers the queue and the
+    batches, never a transfer.
+    """
+
+    def __init__(self, cache=None, max_transfers=8, max_host_connections=4, segments=4,
+                 segment_threshold=SEGMENT_THRESHOLD):
+        super(DownloadManager, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.cache = cache or content_cache()
+        self.max_transfers = max_transfers
+        # Large files from servers that take range requests are fetched as
+        # this many ranges at once - 1 turns this off
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # (batch, url, dest) not started yet
+        self.pending = [ ]
+        # Set while a thread is driving the multi handle - only that thread
+        # touches it, the easy handles and active
+        self.driving = False
+        self.active = { }
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, max_host_connections)
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self.handles = [ ]
+
+    def fetch_all(self, downloads, optional=(), expected=None):
+        """
+        Download each (url, dest) in downloads through the cache at once.
+        dest may be None to only bring the cache up to date.  expected maps
+        URLs to the (hashlib algorithm, hex digest) their content must have.
+        A failed download raises once the rest have finished, unless its URL
+        is in optional.  Returns { url: stats } - see _add_stats().
+        """
+        batch = _Batch(list(downloads), optional, expected or { })
+        self.cond.acquire()
+        try:
+            self.pending.extend([ (batch, url, dest) for (url, dest) in batch.downloads ])
+            while batch.remaining:
+                if self.driving:
+                    self.cond.wait(1.0)
+                    continue
+                self.driving = True
+                self.cond.release()
+                try:
+                    self._drive(batch)
+                finally:
+                    self.cond.acquire()
+                    self.driving = False
+                    # Someone else's batch may still need a driver
+                    self.cond.notify_all()
+        finally:
+            self.cond.release()
+        self.log.debug("Fetched %d files in %.1f seconds" % (len(batch.results), time() - batch.start))
+        if batch.errors:
+            raise Exception("; ".join(batch.errors))
+        return batch.results
+
+    def _drive(self, batch):
+        # Run the multi handle until batch is done, starting queued
+        # transfers from any batch as there is room
+        while batch.remaining:
+            while len(self.active) < self.max_transfers:
+                self.cond.acquire()
+                try:
+                    if not self.pending:
+                        break
+                    (queued, url, dest) = self.pending.pop(0)
+                finally:
+                    self.cond.release()
+                try:
+                    transfer = self.cache.transfer(url, self.segment_threshold if self.segments > 1 else None,
+                                                   queued.expected.get(url))
+                    self._start(transfer, queued, dest)
+                except Exception as e:
+                    self._done(queued, url, None, e)
+            while True:
+                (ret, running) = self.multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                (queued, done, failed) = self.multi.info_read()
+                for curl in done:
+                    self._finish(curl, None)
+                for (curl, code, message) in failed:
+                    self._finish(curl, message)
+                if not queued:
+                    break
+            if self.active and batch.remaining:
+                self.multi.select(1.0)
+
+    def _start(self, transfer, batch, dest):
+        for curl in transfer.start(self._handle):
+            self.multi.add_handle(curl)
+            self.active[curl] = (transfer, batch, dest)
+
+    def _finish(self, curl, error):
+        (transfer, batch, dest) = self.active.pop(curl)
+        self.multi.remove_handle(curl)
+        self._add_stats(transfer, curl)
+        finished = transfer.done(curl, error)
+        self.handles.append(curl)
+        if not finished:
+            return
+        if transfer.promote:
+            # Large enough to be worth fetching in segments - start it again
+            transfer.abort()
+            self._start(SegmentedTransfer(self.cache, transfer.url, transfer.entry, transfer.headers, self.segments,
+                                          expected=transfer.expected), batch, dest)
+            return
+        try:
+            transfer.stats['downloaded'] = transfer.finish()
+            if dest:
+                self.cache.link(transfer.url, dest)
+            self.log.debug("%s: %s" % (transfer.url, self.format_stats(transfer.stats)))
+            self._done(batch, transfer.url, transfer.stats, None)
+        except Exception as e:
+            self._done(batch, transfer.url, None, e)
+
+    def _done(self, batch, url, stats, error):
+        self.cond.acquire()
+        try:
+            if error is None:
+                batch.results[url] = stats
+            elif url in batch.optional:
+                self.log.debug("Optional download %s" % (error))
+            else:
+                batch.errors.append(str(error))
+            batch.remaining -= 1
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _handle(self):
+        if self.handles:
+            # reset() clears the options but the handle stays shared
+            curl = self.handles.pop()
+            curl.reset()
+        else:
+            curl = pycurl.Curl()
+            curl.setopt(pycurl.SHARE, self.share)
+        return curl
+
+    def _add_stats(self, transfer, curl):
+        # Times are seconds from the start of each request, the largest of
+        # any segment.  new_connections is 0 when connections left open by
+        # earlier transfers were used.
+        stats = { 'bytes': int(curl.getinfo(pycurl.SIZE_DOWNLOAD)),
+                  'new_connections': curl.getinfo(pycurl.NUM_CONNECTS),
+                  'segments': 1,
+                  'dns': curl.getinfo(pycurl.NAMELOOKUP_TIME),
+                  'connect': curl.getinfo(pycurl.CONNECT_TIME),
+                  'tls': curl.getinfo(pycurl.APPCONNECT_TIME),
+                  'first_byte': curl.getinfo(pycurl.STARTTRANSFER_TIME),
+                  'total': curl.getinfo(pycurl.TOTAL_TIME) }
+        if not transfer.stats:
+            transfer.stats = stats
+            return
+        for name in ('bytes', 'new_connections', 'segments'):
+            transfer.stats[name] += stats[name]
+        for name in ('dns', 'connect', 'tls', 'first_byte', 'total'):
+            transfer.stats[name] = max(transfer.stats[name], stats[name])
+
+    def format_stats(self, stats):
+        return "%s %d bytes in %.2fs with %d request(s) and %d new connection(s) " \
+               "(dns %.3fs, connect %.3fs, tls %.3fs, first byte %.3fs)" % \
+               ("downloaded" if stats['downloaded'] else "cached,", stats['bytes'], stats['total'], stats['segments'],
+                stats['new_connections'], stats['dns'], stats['connect'], stats['tls'], stats['first_byte'])
+
+    def close(self):
+        for curl in self.handles:
+            curl.close()
+        self.handles = [ ]
+        self.multi.close()
+        self.share.close()
+
+
+_CONTENT_CACHES = { }
+_CONTENT_CACHES_LOCK = threading.Lock()
+
+def content_cache(cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+    """
+    Return the ContentCache shared by everything in this process that uses
+    cache_dir
+    """
+    _CONTENT_CACHES_LOCK.acquire()
+    try:
+        if cache_dir not in _CONTENT_CACHES:
+            _CONTENT_CACHES[cache_dir] = ContentCache(cache_dir, max_size)
+        return _CONTENT_CACHES[cache_dir]
+    finally:
+        _CONTENT_CACHES_LOCK.release()
+
+
+_DOWNLOAD_MANAGER = [ ]
+_DOWNLOAD_MANAGER_LOCK = threading.Lock()
+
+def download_manager():
+    """
+    Return the DownloadManager shared by everything in this process, so
+    that a run of builds reuses its connections
+    """
+    _DOWNLOAD_MANAGER_LOCK.acquire()
+    try:
+        if not _DOWNLOAD_MANAGER:
+            _DOWNLOAD_MANAGER.append(DownloadManager())
+        return _DOWNLOAD_MANAGER[0]
+    finally:
+        _DOWNLOAD_MANAGER_LOCK.release()
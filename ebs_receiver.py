@@ -0,0 +1,199 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Block device receiver for EBSHelper uploads
+#
+# This file is copied to the utility instance and run there, so it must stay
+# self-contained - standard library only, and runnable by whatever python the
+# utility AMI ships.
+#
+# It reads a stream of records on stdin.  Each record starts with a header of
+# one type byte, a 64 bit offset and a 64 bit length, all big endian:
+#
+#   'D' - length bytes of data follow, to be written to the device at offset
+#   'H' - report the SHA256 of length bytes of the device at offset once the
+#         stream is done
+#   'E' - end of stream
+#
+# Anything not covered by a 'D' record is skipped, which leaves the zeros of a
+# fresh EBS volume in place.  Status is written to stdout one line at a time:
+#
+#   PROGRESS <bytes written> <seconds elapsed>
+#   HASH <offset> <length> <sha256>
+#   DONE <bytes written> <seconds elapsed>
+
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import optparse
+from time import time
+
+HEADER = struct.Struct('!cQQ')
+ALIGNMENT = 4096
+
+try:
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
+
+def read_exact(fd, length):
+    pieces = [ ]
+    while length > 0:
+        data = os.read(fd, min(length, 1024 * 1024))
+        if not data:
+            raise Exception("Unexpected end of stream with %d bytes outstanding" % (length))
+        pieces.append(data)
+        length -= len(data)
+    return b''.join(pieces)
+
+
+class Writer(object):
+    """
+    Writes data to the device in large blocks.  With direct set the aligned
+    part of each write is copied into a page aligned buffer and bypasses the
+    page cache - only an unaligned head or tail goes through a normal
+    descriptor.
+    """
+
+    def __init__(self, device, block_size, direct):
+        self.block_size = block_size
+        self.fd = os.open(device, os.O_WRONLY)
+        self.direct_fd = None
+        self.buf = None
+        if direct and hasattr(os, 'O_DIRECT'):
+            try:
+                self.direct_fd = os.open(device, os.O_WRONLY | os.O_DIRECT)
+                # Anonymous mmaps are page aligned, which is what O_DIRECT wants
+                self.buf = mmap.mmap(-1, block_size)
+            except (OSError, EnvironmentError):
+                self.direct_fd = None
+        self.written = 0
+
+    def write(self, offset, data):
+        if self.direct_fd is None:
+            self._pwrite(self.fd, offset, data)
+        else:
+            end = offset + len(data)
+            aligned_start = min(offset + (-offset % ALIGNMENT), end)
+            aligned_end = max(aligned_start, end - end % ALIGNMENT)
+            if aligned_start > offset:
+                self._pwrite(self.fd, offset, data[:aligned_start - offset])
+            position = aligned_start
+            while position < aligned_end:
+                length = min(self.block_size, aligned_end - position)
+                self.buf.seek(0)
+                self.buf.write(data[position - offset:position - offset + length])
+                self._direct_write(position, length)
+                position += length
+            if end > aligned_end:
+                self._pwrite(self.fd, aligned_end, data[aligned_end - offset:])
+        self.written += len(data)
+
+    def _pwrite(self, fd, offset, data):
+        os.lseek(fd, offset, os.SEEK_SET)
+        position = 0
+        while position < len(data):
+            position += os.write(fd, data[position:position + self.block_size])
+
+    def _direct_write(self, offset, length):
+        # Slicing would copy the data out of the aligned buffer, so hand the
+        # buffer itself to write
+        os.lseek(self.direct_fd, offset, os.SEEK_SET)
+        position = 0
+        while position < length:
+            position += os.write(self.direct_fd, _buffer(self.buf, position, length - position))
+
+    def close(self):
+        os.fsync(self.fd)
+        os.close(self.fd)
+        if self.direct_fd is not None:
+            os.close(self.direct_fd)
+            self.buf.close()
+
+
+def hash_range(device, offset, length):
+    digest = hashlib.sha256()
+    f = open(device, 'rb')
+    try:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(length, 4 * 1024 * 1024))
+            if not data:
+                break
+            digest.update(data)
+            length -= len(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def report(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog --device DEVICE [options] < stream")
+    parser.add_option('--device', help="block device to write to")
+    parser.add_option('--block-size', type='int', default=4 * 1024 * 1024,
+                      help="size of each write in bytes - a multiple of 4096")
+    parser.add_option('--direct', action='store_true', default=False,
+                      help="bypass the page cache with O_DIRECT")
+    parser.add_option('--progress', type='float', default=5.0,
+                      help="seconds between progress reports")
+    (options, args) = parser.parse_args()
+    if not options.device:
+        parser.error("--device is required")
+    if options.block_size % ALIGNMENT:
+        parser.error("--block-size must be a multiple of %d" % (ALIGNMENT))
+
+    writer = Writer(options.device, options.block_size, options.direct)
+    stdin = sys.stdin.fileno()
+    hash_requests = [ ]
+    start = time()
+    last_report = start
+    try:
+        while True:
+            (kind, offset, length) = HEADER.unpack(read_exact(stdin, HEADER.size))
+            if kind == b'E':
+                break
+            elif kind == b'H':
+                hash_requests.append( (offset, length) )
+            elif kind == b'D':
+                while length > 0:
+                    data = read_exact(stdin, min(length, options.block_size))
+                    writer.write(offset, data)
+                    offset += len(data)
+                    length -= len(data)
+                    if time() - last_report >= options.progress:
+                        last_report = time()
+                        report("PROGRESS %d %.1f" % (writer.written, last_report - start))
+            else:
+                raise Exception("Unknown record type %r" % (kind))
+    finally:
+        writer.close()
+
+    for (offset, length) in hash_requests:
+        report("HASH %d %d %s" % (offset, length, hash_range(options.device, offset, length)))
+    report("DONE %d %.1f" % (writer.written, time() - start))
+
+
+if __name__ == "__main__":
+    main()
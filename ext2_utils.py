@@ -0,0 +1,419 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Build small bootable ext2 disk images without a libguestfs appliance
+#
+# The image gets an msdos partition table with a single bootable Linux
+# partition, and the filesystem in that partition is created and filled from
+# a staging directory in one step - by "mke2fs -d" where e2fsprogs is new
+# enough (1.43 or later), and otherwise by Ext2Writer below.  Both lay the
+# filesystem out with 4 KiB blocks and 128 byte inodes, so that files up to
+# 4 GiB need no more than double indirect blocks, which is as far as the
+# grub legacy code in pv-grub goes.
+
+import os
+import os.path
+import re
+import stat
+import struct
+import uuid
+import logging
+from time import time
+from process_utils import subprocess_check_output
+
+SECTOR_SIZE = 512
+# Leave the first MiB for the partition table, as parted does
+PARTITION_START = 2048
+MBR_ID_LINUX = 0x83
+
+BLOCK_SIZE = 4096
+INODE_SIZE = 128
+INODE_RATIO = 16384
+
+EXT2_MAGIC = 0xEF53
+ROOT_INO = 2
+FIRST_INO = 11
+FEATURE_INCOMPAT_FILETYPE = 0x0002
+FEATURE_RO_COMPAT_SPARSE_SUPER = 0x0001
+FT_REG_FILE = 1
+FT_DIR = 2
+
+GROUP_DESC = struct.Struct('<IIIHHH14x')
+DIR_ENTRY = struct.Struct('<IHBB')
+INODE = struct.Struct('<HHIIIIIHHIII15IIIII12x')
+
+
+def _chs(lba):
+    # Cylinder/head/sector bytes for an MBR partition entry, using the usual
+    # 255 head, 63 sector geometry and saturating past the end of CHS space
+    (heads, sectors) = (255, 63)
+    cylinder = lba / (heads * sectors)
+    if cylinder > 1023:
+        return '\xfe\xff\xff'
+    head = (lba / sectors) % heads
+    sector = (lba % sectors) + 1
+    return struct.pack('<BBB', head, sector | ((cylinder >> 2) & 0xc0), cylinder & 0xff)
+
+
+def write_msdos_label(image_file, start_sector, sectors, mbr_id=MBR_ID_LINUX, bootable=True):
+    """
+    Write an msdos partition table with a single partition of sectors
+    sectors, starting at start_sector, to image_file
+    """
+    entry = struct.pack('<B3sB3sII', bootable and 0x80 or 0x00, _chs(start_sector), mbr_id,
+                        _chs(start_sector + sectors - 1), start_sector, sectors)
+    f = open(image_file, 'r+b')
+    try:
+        f.seek(446)
+        f.write(entry + '\0' * 48 + '\x55\xaa')
+    finally:
+        f.close()
+
+
+def mke2fs_can_populate():
+    """
+    True if the mke2fs on this system can fill a new filesystem from a
+    directory with -d
+    """
+    try:
+        (stdout, stderr, retcode) = subprocess_check_output([ 'mke2fs', '-V' ])
+    except Exception:
+        return False
+    m = re.search('mke2fs (\d+)\.(\d+)', stdout)
+    return bool(m) and (int(m.group(1)), int(m.group(2))) >= (1, 43)
+
+
+def mke2fs_populate(image_file, offset, size, staging_dir):
+    """
+    Create an ext2 filesystem of size bytes at offset in image_file holding
+    the contents of staging_dir
+    """
+    subprocess_check_output([ 'mke2fs', '-q', '-F', '-t', 'ext2', '-b', str(BLOCK_SIZE), '-I', str(INODE_SIZE),
+                              '-d', staging_dir, '-E', 'offset=%d,root_owner=0:0' % (offset),
+                              image_file, str(size / BLOCK_SIZE) ])
+
+
+def create_boot_image(image_file, staging_dir, image_size=(1024*1024*200), method=None):
+    """
+    Create image_file as a disk of image_size bytes holding one bootable
+    ext2 partition with the contents of staging_dir.  method is 'mke2fs' or
+    'python', or None to use mke2fs when it supports -d.
+    """
+    log = logging.getLogger(__name__)
+    if not method:
+        method = mke2fs_can_populate() and 'mke2fs' or 'python'
+    start = time()
+
+    raw_fs_image = open(image_file, "w")
+    raw_fs_image.truncate(image_size)
+    raw_fs_image.close()
+
+    sectors = image_size / SECTOR_SIZE - PARTITION_START
+    write_msdos_label(image_file, PARTITION_START, sectors)
+    offset = PARTITION_START * SECTOR_SIZE
+    size = sectors * SECTOR_SIZE
+    if method == 'mke2fs':
+        mke2fs_populate(image_file, offset, size, staging_dir)
+    elif method == 'python':
+        Ext2Writer(image_file, offset, size).populate(staging_dir)
+    else:
+        raise Exception("Unknown boot image method (%s) - use mke2fs or python" % (method))
+    log.debug("Created boot image %s with %s in %.2f seconds" % (image_file, method, time() - start))
+
+
+class Ext2Writer(object):
+    """
+    Write a new ext2 filesystem holding a copy of a directory tree into
+    size bytes at offset of image_file, which must read as zeros there.
+    Only regular files and directories are copied.
+
+    Blocks and inodes are handed out in order from the start of the
+    filesystem, so each group's bitmaps are just a count of what has been
+    used in it.
+    """
+
+    def __init__(self, image_file, offset, size, block_size=BLOCK_SIZE, inode_ratio=INODE_RATIO):
+        super(Ext2Writer, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.image_file = image_file
+        self.offset = offset
+        self.block_size = block_size
+        self.first_data_block = block_size == 1024 and 1 or 0
+        self.blocks_per_group = block_size * 8
+        self.blocks_count = size / block_size
+        self.group_count = self._ceil(self.blocks_count - self.first_data_block, self.blocks_per_group)
+        self.gdt_blocks = self._ceil(self.group_count * GROUP_DESC.size, block_size)
+
+        inodes_per_block = block_size / INODE_SIZE
+        inodes_per_group = self._ceil(size / inode_ratio, self.group_count)
+        inodes_per_group = self._ceil(max(inodes_per_group, 16), inodes_per_block) * inodes_per_block
+        self.inodes_per_group = min(inodes_per_group, block_size * 8)
+        self.inode_table_blocks = self.inodes_per_group / inodes_per_block
+
+        # A last group too small for its own metadata is left off, as mke2fs does
+        last = self.blocks_count - self._group_start(self.group_count - 1)
+        if last < self._metadata_blocks(self.group_count - 1) + 50:
+            self.blocks_count -= last
+            self.group_count -= 1
+        if self.group_count < 1:
+            raise Exception("%d bytes is too small for an ext2 filesystem" % (size))
+
+        # Per group - the next free block and the number of inodes and directories used
+        self.next_block = [ self._group_start(g) + self._metadata_blocks(g) for g in range(self.group_count) ]
+        self.inodes_used = [ 0 ] * self.group_count
+        self.dirs_used = [ 0 ] * self.group_count
+        self.alloc_group = 0
+        self.next_ino = FIRST_INO
+        self.inodes = { }
+        self.now = int(time())
+        self.image = None
+
+    def populate(self, staging_dir):
+        self.image = open(self.image_file, 'r+b')
+        try:
+            # The reserved inodes below FIRST_INO, including the root, are all in use
+            self.inodes_used[0] = FIRST_INO - 1
+            self.dirs_used[0] += 1
+            self._add_directory(staging_dir, ROOT_INO, ROOT_INO)
+            self._write_inodes()
+            self._write_bitmaps()
+            self._write_superblocks()
+        finally:
+            self.image.close()
+            self.image = None
+        self.log.debug("Wrote %d inodes and %d of %d blocks" % (self.next_ino - 1, self._used_blocks(),
+                                                               self.blocks_count))
+
+    def _add_directory(self, path, ino, parent_ino):
+        entries = [ ('.', ino, FT_DIR), ('..', parent_ino, FT_DIR) ]
+        if ino == ROOT_INO:
+            lost_found = self._new_inode(directory=True)
+            self._write_directory(lost_found, [ ('.', lost_found, FT_DIR), ('..', ino, FT_DIR) ], 0700, 2)
+            entries.append(('lost+found', lost_found, FT_DIR))
+        for name in sorted(os.listdir(path)):
+            child = os.path.join(path, name)
+            st = os.stat(child)
+            if stat.S_ISDIR(st.st_mode):
+                child_ino = self._new_inode(directory=True)
+                self._add_directory(child, child_ino, ino)
+                entries.append((name, child_ino, FT_DIR))
+            elif stat.S_ISREG(st.st_mode):
+                child_ino = self._new_inode()
+                self._write_file(child, child_ino, st)
+                entries.append((name, child_ino, FT_REG_FILE))
+            else:
+                raise Exception("Only files and directories can be copied into an ext2 image - %s is neither" % (child))
+        subdirs = len([ entry for entry in entries[2:] if entry[2] == FT_DIR ])
+        self._write_directory(ino, entries, stat.S_IMODE(os.stat(path).st_mode), 2 + subdirs)
+
+    def _write_directory(self, ino, entries, perms, links):
+        blocks = [ [ ] ]
+        used = 0
+        for (name, child_ino, file_type) in entries:
+            rec_len = DIR_ENTRY.size + self._ceil(len(name), 4) * 4
+            if used + rec_len > self.block_size:
+                blocks.append([ ])
+                used = 0
+            blocks[-1].append([ name, child_ino, file_type, rec_len ])
+            used += rec_len
+        data = [ ]
+        for block in blocks:
+            # The last entry in each block runs to the end of it
+            block[-1][3] += self.block_size - sum([ entry[3] for entry in block ])
+            for (name, child_ino, file_type, rec_len) in block:
+                data.append(DIR_ENTRY.pack(child_ino, rec_len, len(name), file_type))
+                data.append(name + '\0' * (rec_len - DIR_ENTRY.size - len(name)))
+        (data_blocks, i_block, i_blocks) = self._map_blocks(len(blocks))
+        self._write_blocks(data_blocks, [ ''.join(data) ])
+        self._set_inode(ino, stat.S_IFDIR | perms, len(blocks) * self.block_size, links, i_block, i_blocks)
+
+    def _write_file(self, path, ino, st):
+        if st.st_size >= 2 ** 31:
+            raise Exception("%s is too large to copy into an ext2 image" % (path))
+        (data_blocks, i_block, i_blocks) = self._map_blocks(self._ceil(st.st_size, self.block_size))
+        f = open(path, 'rb')
+        try:
+            self._write_blocks(data_blocks, iter(lambda: f.read(1024 * 1024), ''))
+        finally:
+            f.close()
+        self._set_inode(ino, stat.S_IFREG | stat.S_IMODE(st.st_mode), st.st_size, 1, i_block, i_blocks)
+
+    def _map_blocks(self, count):
+        """
+        Allocate count data blocks and any indirect blocks needed to map
+        them.  Returns the data blocks, the inode's i_block array and its
+        i_blocks count of 512 byte sectors.
+        """
+        data_blocks = [ self._alloc_block() for i in range(count) ]
+        per_block = self.block_size / 4
+        i_block = data_blocks[:12] + [ 0 ] * max(0, 12 - count)
+        remaining = data_blocks[12:]
+        meta_blocks = 0
+        if remaining:
+            indirect = self._alloc_block()
+            meta_blocks += 1
+            self._write_pointers(indirect, remaining[:per_block])
+            remaining = remaining[per_block:]
+            i_block.append(indirect)
+        else:
+            i_block.append(0)
+        if remaining:
+            double_indirect = self._alloc_block()
+            meta_blocks += 1
+            pointers = [ ]
+            while remaining:
+                indirect = self._alloc_block()
+                meta_blocks += 1
+                self._write_pointers(indirect, remaining[:per_block])
+                remaining = remaining[per_block:]
+                pointers.append(indirect)
+            if len(pointers) > per_block:
+                raise Exception("File needs triple indirect blocks, which are not supported")
+            self._write_pointers(double_indirect, pointers)
+            i_block.append(double_indirect)
+        else:
+            i_block.append(0)
+        i_block.append(0)
+        return (data_blocks, i_block, (count + meta_blocks) * (self.block_size / 512))
+
+    def _write_pointers(self, block, pointers):
+        self._write_blocks([ block ], [ struct.pack('<%dI' % (len(pointers)), *pointers) ])
+
+    def _write_blocks(self, blocks, chunks):
+        """
+        Write the data in chunks, an iterable of strings, to blocks in
+        order, seeking only where the blocks are not contiguous
+        """
+        position = 0
+        for chunk in chunks:
+            while chunk:
+                index = position / self.block_size
+                # Extend over as many following blocks as are contiguous
+                run = 1
+                while index + run < len(blocks) and blocks[index + run] == blocks[index] + run:
+                    run += 1
+                within = position % self.block_size
+                length = min(len(chunk), run * self.block_size - within)
+                self.image.seek(self.offset + blocks[index] * self.block_size + within)
+                self.image.write(chunk[:length])
+                chunk = chunk[length:]
+                position += length
+
+    def _set_inode(self, ino, mode, size, links, i_block, i_blocks):
+        self.inodes[ino] = INODE.pack(mode, 0, size, self.now, self.now, self.now, 0, 0, links, i_blocks,
+                                      0, 0, *(i_block + [ 0, 0, 0, 0 ]))
+
+    def _new_inode(self, directory=False):
+        ino = self.next_ino
+        group = (ino - 1) / self.inodes_per_group
+        if group >= self.group_count:
+            raise Exception("Out of inodes in the ext2 image")
+        self.next_ino += 1
+        self.inodes_used[group] += 1
+        if directory:
+            self.dirs_used[group] += 1
+        return ino
+
+    def _alloc_block(self):
+        while self.next_block[self.alloc_group] >= self._group_end(self.alloc_group):
+            self.alloc_group += 1
+            if self.alloc_group >= self.group_count:
+                raise Exception("Out of space in the ext2 image")
+        block = self.next_block[self.alloc_group]
+        self.next_block[self.alloc_group] += 1
+        return block
+
+    def _write_inodes(self):
+        for (ino, inode) in self.inodes.items():
+            group = (ino - 1) / self.inodes_per_group
+            index = (ino - 1) % self.inodes_per_group
+            table = self._group_start(group) + self._metadata_blocks(group) - self.inode_table_blocks
+            self.image.seek(self.offset + table * self.block_size + index * INODE_SIZE)
+            self.image.write(inode)
+
+    def _write_bitmaps(self):
+        for group in range(self.group_count):
+            bitmap = self._group_start(group) + self._metadata_blocks(group) - self.inode_table_blocks - 2
+            # Blocks past the end of a short last group are marked as in use
+            used = self.next_block[group] - self._group_start(group)
+            missing = self.blocks_per_group - (self._group_end(group) - self._group_start(group))
+            block_bitmap = self._bitmap(used, self.blocks_per_group - used - missing)
+            inode_bitmap = self._bitmap(self.inodes_used[group], self.inodes_per_group - self.inodes_used[group])
+            self._write_blocks([ bitmap, bitmap + 1 ], [ block_bitmap, inode_bitmap ])
+
+    def _bitmap(self, used, free):
+        # used bits set, then free bits clear, with the rest of the block set
+        bits = '1' * used + '0' * free
+        bits += '1' * (self.block_size * 8 - len(bits))
+        return ''.join([ chr(int(bits[i:i + 8][::-1], 2)) for i in range(0, len(bits), 8) ])
+
+    def _write_superblocks(self):
+        descriptors = [ ]
+        free_blocks = 0
+        for group in range(self.group_count):
+            bitmap = self._group_start(group) + self._metadata_blocks(group) - self.inode_table_blocks - 2
+            free = self._group_end(group) - self.next_block[group]
+            free_blocks += free
+            descriptors.append(GROUP_DESC.pack(bitmap, bitmap + 1, bitmap + 2, free,
+                                               self.inodes_per_group - self.inodes_used[group], self.dirs_used[group]))
+        inodes_count = self.inodes_per_group * self.group_count
+        fs_uuid = uuid.uuid4().bytes
+        for group in range(self.group_count):
+            if not self._has_super(group):
+                continue
+            superblock = struct.pack('<13IHh4H4I2HI2H3I16s', inodes_count, self.blocks_count,
+                                     self.blocks_count / 20, free_blocks, inodes_count - (self.next_ino - 1),
+                                     self.first_data_block, self.block_size >> 11, self.block_size >> 11,
+                                     self.blocks_per_group, self.blocks_per_group, self.inodes_per_group,
+                                     0, self.now, 0, -1, EXT2_MAGIC, 1, 1, 0, self.now, 0, 0, 1, 0, 0,
+                                     FIRST_INO, INODE_SIZE, group, 0, FEATURE_INCOMPAT_FILETYPE,
+                                     FEATURE_RO_COMPAT_SPARSE_SUPER, fs_uuid)
+            start = self._group_start(group)
+            # The primary superblock is always 1024 bytes in, whatever the block size
+            self.image.seek(self.offset + max(start * self.block_size, 1024))
+            self.image.write(superblock)
+            self._write_blocks([ start + 1 + i for i in range(self.gdt_blocks) ], [ ''.join(descriptors) ])
+
+    def _used_blocks(self):
+        return sum([ self.next_block[g] - self._group_start(g) for g in range(self.group_count) ])
+
+    def _group_start(self, group):
+        return self.first_data_block + group * self.blocks_per_group
+
+    def _group_end(self, group):
+        return min(self._group_start(group + 1), self.blocks_count)
+
+    def _metadata_blocks(self, group):
+        # Superblock and descriptor copies, two bitmaps and the inode table
+        blocks = 2 + self.inode_table_blocks
+        if self._has_super(group):
+            blocks += 1 + self.gdt_blocks
+        return blocks
+
+    def _has_super(self, group):
+        # sparse_super - copies only in groups 0, 1 and powers of 3, 5 and 7
+        if group <= 1:
+            return True
+        for base in (3, 5, 7):
+            power = base
+            while power < group:
+                power *= base
+            if power == group:
+                return True
+        return False
+
+    def _ceil(self, value, unit):
+        return (value + unit - 1) / unit
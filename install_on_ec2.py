@@ -19,11 +19,13 @@ import sys
 from aws_utils import EBSHelper, AMIHelper
 from pvgrub_utils import do_pw_sub
 
-if len(sys.argv) != 7:
+if len(sys.argv) not in (7, 8):
     print
     print "Create an AMI on EC2 by running a native installer contained in a pre-existing AMI"
     print
-    print "usage: %s <ec2_region> <ec2_key> <ec2_secret> <install_ami> <install_script> <root_pw>" % sys.argv[0]
+    print "usage: %s <ec2_region> <ec2_key> <ec2_secret> <install_ami> <install_script> <root_pw> [<copy_to_regions>]" % sys.argv[0]
+    print
+    print "copy_to_regions is an optional comma separated list of regions to copy the finished AMI to"
     print
     sys.exit(1)
 
@@ -33,6 +35,9 @@ secret = sys.argv[3]
 install_ami = sys.argv[4]
 install_script = sys.argv[5]
 root_pw = sys.argv[6]
+copy_regions = [ ]
+if len(sys.argv) == 8:
+    copy_regions = sys.argv[7].split(',')
 
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
@@ -42,3 +47,7 @@ user_data = do_pw_sub(install_script, root_pw)
 install_ami = ami_helper.launch_wait_snapshot(install_ami, user_data, 10)
 
 print "Got AMI: %s" % install_ami
+
+if copy_regions:
+    for (copy_region, copy_ami) in sorted(ami_helper.copy_ami_to_regions(install_ami, copy_regions).items()):
+        print "Got AMI: %s in %s" % (copy_ami, copy_region)
@@ -0,0 +1,735 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Caching HTTP proxy for install trees
+#
+# Concurrent installs of the same distro fetch the same repodata, packages and
+# images/ content.  This proxy fetches each file from the real install tree
+# once, keeps it on disk and serves every later request, ranged or not, from
+# there.  The least recently used files are dropped once the cache passes its
+# size limit.
+#
+# Like ebs_receiver.py this is standard library only, so it can be copied to
+# and run on a helper instance as well as started in-process.
+#
+# Files are requested by mapping the upstream URL into the path:
+#
+#   http://<proxy>/http/download.example.com/pub/fedora/...
+#
+# which is what rewrite_install_urls() in pvgrub_utils writes into kickstarts.
+# Plain forward proxy requests ("GET http://host/path"), as debian-installer
+# makes with mirror/http/proxy, work as well.
+#
+# This is not an open proxy.  Only hosts on the allow list - the install tree
+# hosts rewrite_install_urls() found, or --allow-host - are fetched from, and
+# loopback and link-local addresses (the EC2 instance metadata service among
+# them) are refused whatever the list says.
+
+import os
+import os.path
+import re
+import json
+import errno
+import socket
+import hashlib
+import logging
+import optparse
+import threading
+from time import time
+from email.utils import formatdate
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import build_opener, Request, HTTPRedirectHandler, HTTPError, URLError
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import build_opener, Request, HTTPRedirectHandler
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlparse
+
+# Files an install tree changes in place - these are fetched again once they
+# are older than the metadata TTL.  Everything else (packages, checksum named
+# repodata, images) is cached until it is evicted.
+MUTABLE_FILES = "(repomd\.xml|repomd\.xml\.asc|\.treeinfo|treeinfo|\.discinfo|Release|Release\.gpg|InRelease|" \
+                "Packages(\.gz|\.bz2|\.xz)?|Sources(\.gz|\.bz2|\.xz)?|Index)$"
+
+UPSTREAM_SCHEMES = ('http', 'https', 'ftp')
+BLOCK_SIZE = 256 * 1024
+
+# Headers passed back from upstream on requests that bypass the cache
+FORWARDED_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Last-Modified', 'Accept-Ranges')
+
+# The EC2 instance metadata service's IPv6 address, which is not link-local
+EC2_METADATA_V6 = "fd00:ec2::254"
+
+
+def proxy_url(proxy, url):
+    """
+    Return the address of url through the proxy at proxy - eg
+    http://10.0.0.5:8090/
+    """
+    m = re.match("(%s)://(.*)$" % ("|".join(UPSTREAM_SCHEMES)), url)
+    if not m:
+        return url
+    return "%s/%s/%s" % (proxy.rstrip('/'), m.group(1), m.group(2))
+
+
+def upstream_url(path):
+    """
+    Return the upstream URL for a request path, in either the mapped or the
+    forward proxy form, or None if it is neither
+    """
+    for scheme in UPSTREAM_SCHEMES:
+        if path.startswith("%s://" % (scheme)):
+            return path
+    parts = path.lstrip('/').split('/', 2)
+    if len(parts) < 2 or parts[0] not in UPSTREAM_SCHEMES or not parts[1]:
+        return None
+    return "%s://%s/%s" % (parts[0], parts[1], parts[2] if len(parts) > 2 else "")
+
+
+def upstream_host(url):
+    """
+    Return the lower case host name of url, without any port or user
+    """
+    return (urlparse(url).hostname or "").lower()
+
+
+def local_address(host):
+    """
+    Return True if host is, or resolves to, a loopback, link-local or
+    unspecified address - somewhere the proxy must never be pointed at
+    """
+    try:
+        addresses = [ info[4][0] for info in socket.getaddrinfo(host, None) ]
+    except socket.error:
+        # Unresolvable - the fetch will fail on its own
+        return False
+    for address in addresses:
+        address = address.split('%')[0]
+        if ':' in address:
+            octets = bytearray(socket.inet_pton(socket.AF_INET6, address))
+            if octets == bytearray(socket.inet_pton(socket.AF_INET6, EC2_METADATA_V6)):
+                return True
+            if octets[:15] == bytearray(15) and octets[15] in (0, 1):
+                return True
+            if octets[0] == 0xfe and octets[1] & 0xc0 == 0x80:
+                return True
+            if octets[:12] != bytearray(10) + bytearray(b'\xff\xff'):
+                continue
+            # IPv4 mapped
+            octets = octets[12:]
+        else:
+            octets = bytearray(socket.inet_aton(address))
+        if octets[0] in (0, 127) or (octets[0] == 169 and octets[1] == 254):
+            return True
+    return False
+
+
+def forbidden_upstream(url, allowed_hosts):
+    """
+    Return the reason url may not be fetched through the proxy, or None if
+    it may.  allowed_hosts is None to skip the allow list, as for redirects
+    from a host that is on it.
+    """
+    host = upstream_host(url)
+    if not host:
+        return "No host in %s" % (url)
+    if allowed_hosts is not None and host not in allowed_hosts:
+        return "%s is not an install tree host" % (host)
+    if local_address(host):
+        return "%s is a local address" % (host)
+    return None
+
+
+class UpstreamRedirectHandler(HTTPRedirectHandler):
+    """
+    Follow upstream redirects - mirror redirectors send installs anywhere -
+    but never to a local address
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        reason = forbidden_upstream(newurl, None)
+        if reason:
+            raise HTTPError(newurl, 403, reason, headers, fp)
+        return HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+
+
+def upstream_open(request, timeout):
+    return build_opener(UpstreamRedirectHandler).open(request, timeout=timeout)
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single range Range header, None to
+    send the whole file, or False if the range cannot be satisfied
+    """
+    m = re.match("bytes=(\d*)-(\d*)$", (header or "").strip())
+    if not m or not (m.group(1) or m.group(2)):
+        # Missing, malformed or multiple ranges - the whole file is a valid answer
+        return None
+    if not m.group(1):
+        length = int(m.group(2))
+        if length == 0:
+            return False
+        return (max(0, size - length), size - 1)
+    start = int(m.group(1))
+    end = int(m.group(2)) if m.group(2) else size - 1
+    if start >= size or end < start:
+        return False
+    return (start, min(end, size - 1))
+
+
+class InstallCache(object):
+    """
+    On disk cache of upstream files.  Each file is stored under the SHA256 of
+    its URL with a .meta JSON file beside it.  Only one request fetches a
+    given URL at a time - others asking for it wait and then read the cached
+    copy.
+    """
+
+    def __init__(self, cache_dir, max_size, metadata_ttl=300, timeout=60, log=None):
+        super(InstallCache, self).__init__()
+        self.log = log or logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.metadata_ttl = metadata_ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # key -> meta dict, including the time it was last used
+        self.entries = { }
+        # URL -> threading.Event set when its fetch finishes
+        self.fetching = { }
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.upstream_bytes = 0
+        self.served_bytes = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._load()
+
+    def _load(self):
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                os.unlink(path)
+                continue
+            if not name.endswith('.meta'):
+                continue
+            key = name[:-len('.meta')]
+            try:
+                f = open(path)
+                try:
+                    meta = json.load(f)
+                finally:
+                    f.close()
+                meta['used'] = os.path.getmtime(path)
+                if os.path.getsize(self.data_path(key)) != meta['size']:
+                    raise ValueError("size mismatch")
+            except (ValueError, KeyError, OSError, IOError):
+                self.log.warning("Dropping damaged cache entry (%s)" % (key))
+                self._remove(key)
+                continue
+            self.entries[key] = meta
+            self.size += meta['size']
+        self.log.info("Install cache (%s) holds %d files, %d bytes" % (self.cache_dir, len(self.entries), self.size))
+
+    def key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def data_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _mutable(self, url):
+        return re.search(MUTABLE_FILES, url.split('?')[0]) is not None
+
+    def lookup(self, url):
+        """
+        Return the meta of a fresh cached copy of url, or None, without
+        starting a fetch
+        """
+        key = self.key(url)
+        self.lock.acquire()
+        try:
+            meta = self.entries.get(key)
+            if meta and not (self._mutable(url) and time() - meta['fetched'] > self.metadata_ttl):
+                meta['used'] = time()
+                self.hits += 1
+                return meta
+            return None
+        finally:
+            self.lock.release()
+
+    def fetching_event(self, url):
+        """
+        Return the event set when the fetch of url in progress ends, or None
+        """
+        self.lock.acquire()
+        try:
+            return self.fetching.get(url)
+        finally:
+            self.lock.release()
+
+    def claim(self, url):
+        """
+        Return ('hit', meta) if a fresh copy of url is cached, ('wait', event)
+        if another request is fetching it, or ('fetch', meta or None) if the
+        caller should fetch it, revalidating meta if one is given.  A fetch
+        must be ended with finish().
+        """
+        key = self.key(url)
+        self.lock.acquire()
+        try:
+            meta = self.entries.get(key)
+            if meta and not (self._mutable(url) and time() - meta['fetched'] > self.metadata_ttl):
+                meta['used'] = time()
+                self.hits += 1
+                return ('hit', meta)
+            if url in self.fetching:
+                return ('wait', self.fetching[url])
+            self.fetching[url] = threading.Event()
+            self.misses += 1
+            return ('fetch', meta)
+        finally:
+            self.lock.release()
+
+    def open_tmp(self, url):
+        key = self.key(url)
+        return open(self.data_path(key) + ".%d.tmp" % (threading.current_thread().ident), 'wb')
+
+    def finish(self, url, tmp=None, headers=None, revalidated=False):
+        """
+        End the fetch of url.  tmp is the completed download to add to the
+        cache, and revalidated marks a cached copy confirmed as current.
+        Anything else leaves the cache as it was.
+        """
+        key = self.key(url)
+        self.lock.acquire()
+        try:
+            if tmp:
+                size = os.path.getsize(tmp.name)
+                self.upstream_bytes += size
+                if key in self.entries:
+                    self.size -= self.entries.pop(key)['size']
+                meta = { 'url': url, 'size': size, 'fetched': time(), 'used': time(),
+                         'content_type': headers.get('Content-Type', 'application/octet-stream'),
+                         'last_modified': headers.get('Last-Modified') }
+                os.rename(tmp.name, self.data_path(key))
+                self._write_meta(key, meta)
+                self.entries[key] = meta
+                self.size += size
+                self._evict()
+            elif revalidated and key in self.entries:
+                self.entries[key]['fetched'] = time()
+                self._write_meta(key, self.entries[key])
+            self.fetching.pop(url).set()
+        finally:
+            self.lock.release()
+
+    def _write_meta(self, key, meta):
+        # Called with the lock held
+        path = self.data_path(key) + ".meta"
+        f = open(path + ".tmp", 'w')
+        try:
+            json.dump(dict([ (name, value) for (name, value) in meta.items() if name != 'used' ]), f)
+        finally:
+            f.close()
+        os.rename(path + ".tmp", path)
+
+    def _evict(self):
+        # Called with the lock held.  Files being served stay readable after
+        # they are unlinked, so nothing needs to wait for readers.
+        if self.size <= self.max_size:
+            return
+        for (used, key) in sorted([ (meta['used'], key) for (key, meta) in self.entries.items() ]):
+            if self.size <= self.max_size:
+                break
+            self.log.debug("Evicting (%s) from the install cache" % (self.entries[key]['url']))
+            self.size -= self.entries.pop(key)['size']
+            self._remove(key)
+
+    def _remove(self, key):
+        for path in (self.data_path(key), self.data_path(key) + ".meta"):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def served(self, length):
+        self.lock.acquire()
+        try:
+            self.served_bytes += length
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return { 'files': len(self.entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                     'upstream_bytes': self.upstream_bytes, 'served_bytes': self.served_bytes }
+        finally:
+            self.lock.release()
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def log_message(self, format, *args):
+        self.server.cache.log.debug("%s - %s" % (self.client_address[0], format % args))
+
+    def _serve(self, body):
+        cache = self.server.cache
+        if self.path == "/stats":
+            return self._send_data(200, json.dumps(cache.stats()), "application/json", body)
+        url = upstream_url(self.path)
+        if not url:
+            return self._send_data(404, "Not a proxied URL\n", "text/plain", body)
+        reason = forbidden_upstream(url, self.server.allowed_hosts)
+        if reason:
+            cache.log.warning("Refused (%s) from %s: %s" % (url, self.client_address[0], reason))
+            return self._send_data(403, "%s\n" % (reason), "text/plain", body)
+        if not body:
+            # HEAD never fills the cache - answer from it or ask upstream.  A
+            # fetch in progress may only be moments from finishing, as its
+            # client has all of its bytes before the copy is cached.
+            event = cache.fetching_event(url)
+            if event:
+                event.wait(cache.timeout)
+            meta = cache.lookup(url)
+            if meta:
+                return self._send_cached(meta, body)
+            return self._forward(url, body)
+        while True:
+            (state, value) = cache.claim(url)
+            if state == 'hit':
+                return self._send_cached(value, body)
+            elif state == 'wait':
+                if self.headers.get('Range'):
+                    # Do not hold a ranged read up behind the whole file
+                    return self._forward(url, body)
+                value.wait(cache.timeout * 10)
+            else:
+                return self._fetch(url, value)
+
+    def _forward(self, url, body):
+        """
+        Pass a HEAD or ranged GET for url straight through to upstream
+        """
+        cache = self.server.cache
+        request = Request(url)
+        if not body:
+            request.get_method = lambda: 'HEAD'
+        if body and self.headers.get('Range'):
+            request.add_header('Range', self.headers.get('Range'))
+        try:
+            response = upstream_open(request, cache.timeout)
+        except HTTPError as e:
+            return self._send_data(e.code, "Upstream returned %d for %s\n" % (e.code, url), "text/plain", body)
+        except (URLError, socket.error) as e:
+            return self._send_data(502, "Unable to fetch %s: %s\n" % (url, e), "text/plain", body)
+        try:
+            info = response.info()
+            self.send_response(response.getcode())
+            for name in FORWARDED_HEADERS:
+                if info.get(name) is not None:
+                    self.send_header(name, info.get(name))
+            self.send_header("Date", formatdate(usegmt=True))
+            if not body:
+                self.end_headers()
+                return
+            if info.get('Content-Length') is None:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            while True:
+                data = response.read(BLOCK_SIZE)
+                if not data:
+                    break
+                self.wfile.write(data)
+                cache.served(len(data))
+        except socket.error:
+            self.close_connection = True
+        finally:
+            response.close()
+
+    def _fetch(self, url, meta):
+        cache = self.server.cache
+        request = Request(url)
+        if meta and meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            response = upstream_open(request, cache.timeout)
+        except HTTPError as e:
+            if e.code == 304:
+                cache.finish(url, revalidated=True)
+                return self._send_cached(meta, True)
+            cache.finish(url)
+            return self._send_data(e.code, "Upstream returned %d for %s\n" % (e.code, url), "text/plain", True)
+        except (URLError, socket.error) as e:
+            cache.finish(url)
+            return self._send_data(502, "Unable to fetch %s: %s\n" % (url, e), "text/plain", True)
+
+        # The client is sent its bytes as they download - all of them, or
+        # just its range once the length is known.  Without a length a
+        # ranged request waits for the download and is served from the cache.
+        length = response.info().get('Content-Length')
+        byte_range = None
+        if self.headers.get('Range') and length is not None:
+            byte_range = parse_range(self.headers.get('Range'), int(length))
+        tee = not self.headers.get('Range') or length is not None
+        tmp = None
+        try:
+            tmp = cache.open_tmp(url)
+            if tee:
+                self._send_fetch_headers(response.info(), length, byte_range)
+            if byte_range:
+                (start, end) = byte_range
+            else:
+                (start, end) = (0, None)
+            client = tee and byte_range is not False
+            offset = 0
+            while True:
+                data = response.read(BLOCK_SIZE)
+                if not data:
+                    break
+                tmp.write(data)
+                if client:
+                    # The part of this block that falls in the range
+                    first = max(start - offset, 0)
+                    last = len(data) if end is None else min(end + 1 - offset, len(data))
+                    try:
+                        if last > first:
+                            self.wfile.write(data[first:last])
+                            cache.served(last - first)
+                        if end is not None and offset + len(data) > end:
+                            # Done with the client - the fetch carries on for the cache
+                            self.wfile.flush()
+                            client = False
+                    except socket.error:
+                        # Carry on so the next client finds it cached
+                        client = False
+                        self.close_connection = True
+                offset += len(data)
+            tmp.close()
+            if length is not None and os.path.getsize(tmp.name) != int(length):
+                raise Exception("Short read of %s: %d of %s bytes" % (url, os.path.getsize(tmp.name), length))
+        except Exception as e:
+            cache.log.warning("Fetch of (%s) failed: %s" % (url, e))
+            if tmp:
+                tmp.close()
+                try:
+                    os.unlink(tmp.name)
+                except OSError:
+                    pass
+            cache.finish(url)
+            if not tee:
+                self._send_data(502, "Unable to fetch %s: %s\n" % (url, e), "text/plain", True)
+            self.close_connection = True
+            return
+        finally:
+            response.close()
+        cache.finish(url, tmp, response.info())
+        if not tee:
+            (state, meta) = cache.claim(url)
+            if state != 'hit':
+                # Evicted already, or a mutable file with a zero TTL
+                if state == 'fetch':
+                    cache.finish(url)
+                return self._send_data(503, "Cache too small for %s\n" % (url), "text/plain", True)
+            self._send_cached(meta, True)
+
+    def _send_fetch_headers(self, info, length, byte_range):
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%s" % (length))
+            self.send_header("Content-Length", "0")
+        else:
+            if byte_range:
+                (start, end) = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%s" % (start, end, length))
+            else:
+                self.send_response(200)
+            self._send_common_headers(info.get('Content-Type', 'application/octet-stream'), info.get('Last-Modified'))
+            if byte_range:
+                self.send_header("Content-Length", str(end - start + 1))
+            elif length is None:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            else:
+                self.send_header("Content-Length", length)
+        if byte_range is not None:
+            # This thread keeps downloading after the answer is sent, so the
+            # client's next request should come in on a new connection
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+
+    def _send_cached(self, meta, body):
+        cache = self.server.cache
+        try:
+            f = open(cache.data_path(cache.key(meta['url'])), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Evicted between the lookup and here
+            return self._send_data(503, "Evicted %s\n" % (meta['url']), "text/plain", body)
+        try:
+            size = meta['size']
+            byte_range = parse_range(self.headers.get('Range'), size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % (size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range:
+                (start, end) = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            else:
+                (start, end) = (0, size - 1)
+                self.send_response(200)
+            self._send_common_headers(meta['content_type'], meta.get('last_modified'))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if not body:
+                return
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+                cache.served(len(data))
+        finally:
+            f.close()
+
+    def _send_common_headers(self, content_type, last_modified):
+        self.send_header("Content-Type", content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Date", formatdate(usegmt=True))
+        if last_modified:
+            self.send_header("Last-Modified", last_modified)
+
+    def _send_data(self, code, data, content_type, body):
+        data = data.encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class ProxyServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Lower case names of the upstream hosts the proxy will fetch from
+    allowed_hosts = frozenset()
+
+
+class InstallProxy(object):
+    """
+    Caching install tree proxy listening on address:port, started in a
+    background thread by start().  url is the base address to hand to
+    rewrite_install_urls() once it is running - pass public_host if the
+    installs reach this machine by some other name.  Only allowed_hosts, and
+    any added later with allow_hosts(), are fetched from.
+    """
+
+    def __init__(self, cache_dir, max_size=20 * 1024 * 1024 * 1024, address='', port=8090, metadata_ttl=300,
+                 public_host=None, allowed_hosts=()):
+        super(InstallProxy, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.cache = InstallCache(cache_dir, max_size, metadata_ttl, log=self.log)
+        self.server = ProxyServer((address, port), ProxyHandler)
+        self.server.cache = self.cache
+        self.allowed_lock = threading.Lock()
+        self.server.allowed_hosts = frozenset()
+        self.allow_hosts(allowed_hosts)
+        self.url = "http://%s:%d/" % (public_host or address or socket.getfqdn(), self.server.server_address[1])
+        self.thread = None
+
+    def allow_hosts(self, hosts):
+        """
+        Add hosts to those the proxy will fetch from
+        """
+        self.allowed_lock.acquire()
+        try:
+            self.server.allowed_hosts = self.server.allowed_hosts.union([ host.lower() for host in hosts ])
+        finally:
+            self.allowed_lock.release()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.log.info("Install proxy listening at %s" % (self.url))
+        return self.url
+
+    def stop(self):
+        if self.thread:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+        stats = self.cache.stats()
+        self.log.info("Install proxy served %d bytes with %d from upstream - %d hits, %d misses" %
+                      (stats['served_bytes'], stats['upstream_bytes'], stats['hits'], stats['misses']))
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog --cache-dir DIR [options]")
+    parser.add_option('--cache-dir', help="directory to keep cached files in")
+    parser.add_option('--max-size', type='int', default=20 * 1024,
+                      help="cache size limit in MiB (default %default)")
+    parser.add_option('--address', default='', help="address to listen on (default all)")
+    parser.add_option('--port', type='int', default=8090, help="port to listen on (default %default)")
+    parser.add_option('--metadata-ttl', type='int', default=300,
+                      help="seconds before repository metadata is fetched again (default %default)")
+    parser.add_option('--allow-host', action='append', default=[ ],
+                      help="install tree host to fetch from - repeat for each host")
+    (options, args) = parser.parse_args()
+    if not options.cache_dir:
+        parser.error("--cache-dir is required")
+    if not options.allow_host:
+        parser.error("at least one --allow-host is required")
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    proxy = InstallProxy(options.cache_dir, options.max_size * 1024 * 1024, options.address, options.port,
+                         options.metadata_ttl, allowed_hosts=options.allow_host)
+    try:
+        proxy.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    proxy.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Build matrix scheduling
+#
+# A matrix is a JSON file listing install scripts, architectures and regions:
+#
+#   { "builds":  [ { "kickstart": "examples/fedora-18-jeos.ks" },
+#                  { "kickstart": "my-f18-server.ks",
+#                    "installer": "examples/fedora-18-jeos.ks" } ],
+#     "arches":  [ "x86_64" ],
+#     "regions": [ "us-east-1", "us-west-2" ],
+#     "img_size": 10,
+#     "instance_type": "auto",
+#     "policy": "cost",
+#     "image_method": "auto",
+#     "boot_image": "guestfs",
+#     "stall_timeout": 3600,
+#     "proxy": { "cache_dir": "/var/cache/install-proxy", "public_host": "203.0.113.10" },
+#     "limits":  { "stages":  { "image": 2, "upload": 2, "copy": 4, "install": 4 },
+#                  "regions": { "instances": 4, "volumes": 4, "snapshots": 4 } } }
+#
+# Every build, arch and region combination is one build.  "installer" is the
+# script whose install tree is used to make the installer image and defaults
+# to "kickstart".  ${arch} in either script is replaced with the architecture.
+# "instance_type" is the type the installs run on, or "auto" to choose one by
+# "policy" ("time" or "cost") from the timings of earlier installs of the same
+# script, and defaults to m1.small.
+# "image_method" is how finished installs become AMIs - see AMIHelper.
+# "boot_image" is how installer images are built - "mke2fs" or "python" (see
+# ext2_utils.py), or "guestfs" to build all of them in one libguestfs appliance.
+# It defaults to mke2fs where that can fill a filesystem, and python otherwise.
+# "stall_timeout" gives up on an install whose console output has not changed
+# for that many seconds.  EC2 buffers console output, so this is off unless set.
+# "proxy" sends the installs' package downloads through a caching install tree
+# proxy (see install_proxy.py): either the URL of one that is already running
+# or the settings for one to start here for the length of the build -
+# "cache_dir", and optionally "port", "max_size" in MiB and "public_host", the
+# address the install instances can reach this machine at.  A proxy started
+# here fetches only from the install tree hosts named in the scripts; one
+# already running needs them passed with --allow-host.
+#
+# Builds are broken into tasks that share whatever they can: one installer
+# image per installer script and arch, uploaded once in the first region and
+# copied to the others, and one installer AMI per region that every build
+# using that installer launches.
+
+import json
+import logging
+import os
+import os.path
+import threading
+from string import Template
+from time import time
+
+# Defaults for the limits section of a matrix
+STAGE_LIMITS = { 'image': 2, 'upload': 2, 'copy': 4, 'install': 4 }
+REGION_LIMITS = { 'instances': 4, 'volumes': 4, 'snapshots': 4 }
+
+# What each stage holds in its region while it runs
+STAGE_RESOURCES = { 'image':   { },
+                    'upload':  { 'instances': 1, 'volumes': 1, 'snapshots': 1 },
+                    'copy':    { 'snapshots': 1 },
+                    'install': { 'instances': 1, 'snapshots': 1 } }
+
+
+class Task(object):
+    """
+    One node of the build DAG.  func is called with the results of deps, in
+    order, once they have all succeeded.
+    """
+
+    def __init__(self, name, stage, func, deps=None, region=None):
+        super(Task, self).__init__()
+        self.name = name
+        self.stage = stage
+        self.func = func
+        self.deps = deps or [ ]
+        self.region = region
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    def elapsed(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class Scheduler(object):
+    """
+    Runs a DAG of Tasks, each in its own thread, as soon as its dependencies
+    are done and both the limit for its stage and the resource limits for its
+    region allow it.  A failed task fails everything that depends on it;
+    unrelated tasks carry on.
+    """
+
+    def __init__(self, stage_limits=None, region_limits=None):
+        super(Scheduler, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.stage_limits = dict(STAGE_LIMITS)
+        self.stage_limits.update(stage_limits or { })
+        self.region_limits = dict(REGION_LIMITS)
+        self.region_limits.update(region_limits or { })
+        self.tasks = [ ]
+        self.by_name = { }
+        self.running = { }
+        self.in_use = { }
+        self.cond = threading.Condition()
+
+    def add(self, task):
+        if task.name in self.by_name:
+            raise Exception("Duplicate task (%s)" % (task.name))
+        for dep in task.deps:
+            if dep not in self.by_name:
+                raise Exception("Task (%s) depends on unknown task (%s)" % (task.name, dep))
+        self.tasks.append(task)
+        self.by_name[task.name] = task
+        return task
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def run(self):
+        """
+        Run every task and return once none are left to run
+        """
+        self.cond.acquire()
+        try:
+            while True:
+                started = False
+                for task in self.tasks:
+                    if task.status != 'pending':
+                        continue
+                    deps = [ self.by_name[dep] for dep in task.deps ]
+                    failed = [ dep.name for dep in deps if dep.status in ('failed', 'skipped') ]
+                    if failed:
+                        task.status = 'skipped'
+                        task.error = "dependency failed: %s" % (', '.join(failed))
+                        self.log.warning("Skipping (%s) - %s" % (task.name, task.error))
+                        started = True
+                    elif [ dep for dep in deps if dep.status != 'done' ]:
+                        continue
+                    elif self._available(task):
+                        self._start(task, [ dep.result for dep in deps ])
+                        started = True
+                if started:
+                    continue
+                if not [ task for task in self.tasks if task.status in ('pending', 'running') ]:
+                    break
+                self.cond.wait(1)
+        finally:
+            self.cond.release()
+
+    def hold(self, region, resource, count):
+        """
+        Count count more (or fewer, if negative) of resource as in use in
+        region, for resources held outside any task
+        """
+        self.cond.acquire()
+        try:
+            key = (region, resource)
+            self.in_use[key] = self.in_use.get(key, 0) + count
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _available(self, task):
+        # Called with the lock held
+        if self.running.get(task.stage, 0) >= self.stage_limits.get(task.stage, 1):
+            return False
+        for (resource, count) in STAGE_RESOURCES.get(task.stage, { }).items():
+            if self.in_use.get( (task.region, resource), 0) + count > self.region_limits[resource]:
+                return False
+        return True
+
+    def _hold(self, task, sign):
+        # Called with the lock held
+        self.running[task.stage] = self.running.get(task.stage, 0) + sign
+        for (resource, count) in STAGE_RESOURCES.get(task.stage, { }).items():
+            key = (task.region, resource)
+            self.in_use[key] = self.in_use.get(key, 0) + sign * count
+
+    def _start(self, task, args):
+        # Called with the lock held
+        self._hold(task, 1)
+        task.status = 'running'
+        task.start = time()
+        self.log.debug("Starting (%s)" % (task.name))
+        thread = threading.Thread(target=self._run_task, args=(task, args))
+        thread.daemon = True
+        thread.start()
+
+    def _run_task(self, task, args):
+        try:
+            result = task.func(*args)
+            status = 'done'
+            error = None
+        except Exception as e:
+            self.log.error("Task (%s) failed" % (task.name), exc_info = True)
+            result = None
+            status = 'failed'
+            error = str(e)
+        self.cond.acquire()
+        try:
+            task.end = time()
+            task.result = result
+            task.error = error
+            task.status = status
+            self._hold(task, -1)
+            self.log.debug("Finished (%s) - %s in %.1f seconds" % (task.name, status, task.elapsed()))
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+
+def load_matrix(path):
+    f = open(path)
+    try:
+        matrix = json.load(f)
+    finally:
+        f.close()
+    for key in ('builds', 'arches', 'regions'):
+        if not matrix.get(key):
+            raise Exception("Build matrix (%s) must list at least one entry in (%s)" % (path, key))
+    return matrix
+
+
+def substitute_script(script, values):
+    """
+    Return the content of script with the ${name} variables in values filled
+    in.  Everything is substituted in one pass, so $$ becomes $ exactly once.
+    """
+    f = open(script)
+    try:
+        return Template(f.read()).safe_substitute(values)
+    finally:
+        f.close()
+
+
+def rendered_name(script, arch):
+    (base, ext) = os.path.splitext(os.path.basename(script))
+    return "%s-%s%s" % (base, arch, ext)
+
+
+def render_script(script, arch, work_dir):
+    """
+    Write a copy of script with ${arch} filled in to work_dir and return its
+    path.  Other substitutions such as ${adminpw} are left alone.
+    """
+    content = substitute_script(script, { 'arch': arch })
+    rendered = os.path.join(work_dir, rendered_name(script, arch))
+    f = open(rendered, 'w')
+    try:
+        f.write(content)
+    finally:
+        f.close()
+    return rendered
+
+
+class MatrixBuild(object):
+    """
+    Turns a build matrix into tasks on a Scheduler, runs them and reports a
+    result for each build
+    """
+
+    def __init__(self, matrix, access_key, secret_key, root_pw, work_dir):
+        super(MatrixBuild, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.matrix = matrix
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.root_pw = root_pw
+        self.work_dir = work_dir
+        limits = matrix.get('limits', { })
+        self.scheduler = Scheduler(limits.get('stages'), limits.get('regions'))
+        self.pools = { }
+        self.pools_lock = threading.Lock()
+        self.builds = [ ]
+        self.history = None
+        self.proxy = None
+        self.proxy_url = matrix.get('proxy') if not isinstance(matrix.get('proxy'), dict) else None
+        # Installer images still to be built by the shared libguestfs task - task name -> (installer, arch)
+        self.boot_images = { }
+        if matrix.get('instance_type') == 'auto':
+            from tuning_utils import InstanceHistory
+            self.history = InstanceHistory()
+        self._plan()
+
+    def _plan(self):
+        regions = self.matrix['regions']
+        home = regions[0]
+        img_size = self.matrix.get('img_size', 10)
+        for build in self.matrix['builds']:
+            kickstart = build['kickstart']
+            installer = build.get('installer', kickstart)
+            for arch in self.matrix['arches']:
+                image = self._installer_image(installer, arch)
+                home_ami = self._installer_ami(image, installer, arch, home, None)
+                for region in regions:
+                    if region == home:
+                        installer_ami = home_ami
+                    else:
+                        installer_ami = self._installer_ami(image, installer, arch, region, home_ami)
+                    name = "install:%s:%s:%s" % (kickstart, arch, region)
+                    if not self.scheduler.get(name):
+                        self.scheduler.add(Task(name, 'install', self._install_func(kickstart, arch, region, img_size),
+                                                [ installer_ami ], region))
+                        # Any shared image build comes first so that its time counts towards the image stage
+                        tasks = self.scheduler.get(image).deps + [ image, home_ami ]
+                        if installer_ami != home_ami:
+                            tasks.append(installer_ami)
+                        self.builds.append( { 'kickstart': kickstart, 'arch': arch, 'region': region,
+                                              'installer_ami': installer_ami, 'tasks': tasks + [ name ] } )
+
+    def _installer_image(self, installer, arch):
+        name = "image:%s:%s" % (installer, arch)
+        if self.scheduler.get(name):
+            return name
+        method = self.matrix.get('boot_image')
+        if method == 'guestfs':
+            # Each image task just picks its file out of the results of the one shared build
+            self.boot_images[name] = (installer, arch)
+            def _image(image_files):
+                return image_files[name]
+            self.scheduler.add(Task(name, 'image', _image, [ self._guestfs_images() ]))
+        else:
+            def _image():
+                # Imported here so that planning and dry runs do not need the boot image tools
+                from pvgrub_utils import generate_install_image
+                (script, image_file) = self._image_file(installer, arch)
+                generate_install_image(script, image_file, method=method)
+                return image_file
+            self.scheduler.add(Task(name, 'image', _image))
+        return name
+
+    def _guestfs_images(self):
+        name = "images:guestfs"
+        if not self.scheduler.get(name):
+            def _images():
+                from pvgrub_utils import generate_install_images
+                image_files = { }
+                images = [ ]
+                for (image, (installer, arch)) in self.boot_images.items():
+                    (script, image_file) = self._image_file(installer, arch)
+                    image_files[image] = image_file
+                    images.append( (script, image_file) )
+                generate_install_images(images)
+                return image_files
+            self.scheduler.add(Task(name, 'image', _images))
+        return name
+
+    def _image_file(self, installer, arch):
+        script = render_script(installer, arch, self.work_dir)
+        return (script, os.path.join(self.work_dir, "%s.raw" % (os.path.basename(script))))
+
+    def _installer_ami(self, image, installer, arch, region, home_ami):
+        name = "installer-ami:%s:%s:%s" % (installer, arch, region)
+        if self.scheduler.get(name):
+            return name
+        if home_ami is None:
+            def _upload(image_file):
+                snapshot = self._pool(region).file_to_snapshot(image_file, sparse=True)
+                return self._ami_helper(region).register_ebs_ami(snapshot, arch=arch)
+            self.scheduler.add(Task(name, 'upload', _upload, [ image ], region))
+        else:
+            home_region = self.matrix['regions'][0]
+            def _copy(ami):
+                return self._ami_helper(home_region).copy_ami_to_regions(ami, [ region ])[region]
+            self.scheduler.add(Task(name, 'copy', _copy, [ home_ami ], region))
+        return name
+
+    def _install_func(self, kickstart, arch, region, img_size):
+        def _install(installer_ami):
+            # ${arch} and ${adminpw} together, so that the script is only substituted once
+            user_data = substitute_script(kickstart, { 'arch': arch, 'adminpw': self.root_pw })
+            if self.proxy_url:
+                from pvgrub_utils import rewrite_install_urls
+                hosts = set()
+                user_data = rewrite_install_urls(user_data, self.proxy_url, hosts)
+                if self.proxy:
+                    self.proxy.allow_hosts(hosts)
+            console_log = os.path.join(self.work_dir, "%s-%s.console" % (rendered_name(kickstart, arch), region))
+            return self._ami_helper(region).launch_wait_snapshot(installer_ami, user_data, img_size,
+                                                                 console_log=console_log,
+                                                                 distro=os.path.basename(kickstart), arch=arch,
+                                                                 stall_timeout=self.matrix.get('stall_timeout'))
+        return _install
+
+    def _ami_helper(self, region):
+        from aws_utils import AMIHelper
+        return AMIHelper(region, self.access_key, self.secret_key,
+                         instance_type=self.matrix.get('instance_type', 'm1.small'), history=self.history,
+                         policy=self.matrix.get('policy', 'time'),
+                         image_method=self.matrix.get('image_method', 'create_image'))
+
+    def _pool(self, region):
+        from aws_utils import UtilityPool
+        self.pools_lock.acquire()
+        try:
+            if region not in self.pools:
+                # An upload task holds an instance while it uses one from the
+                # pool, and the idle ones hold one each until they are reaped
+                self.pools[region] = UtilityPool(region, self.access_key, self.secret_key,
+                                                 max_size=self.scheduler.stage_limits['upload'],
+                                                 idle_hook=lambda count: self.scheduler.hold(region, 'instances', count))
+            return self.pools[region]
+        finally:
+            self.pools_lock.release()
+
+    def _start_proxy(self):
+        settings = self.matrix.get('proxy')
+        if not isinstance(settings, dict):
+            return
+        from install_proxy import InstallProxy
+        self.proxy = InstallProxy(settings['cache_dir'], settings.get('max_size', 20 * 1024) * 1024 * 1024,
+                                  port=settings.get('port', 8090), public_host=settings.get('public_host'))
+        self.proxy_url = self.proxy.start()
+
+    def run(self):
+        self._start_proxy()
+        try:
+            self.scheduler.run()
+        finally:
+            for pool in self.pools.values():
+                pool.shutdown()
+            if self.proxy:
+                self.proxy.stop()
+        return self.results()
+
+    def results(self):
+        """
+        Return one dict per build with its status, installer AMI, AMI, error
+        and the seconds spent in each stage it depends on
+        """
+        results = [ ]
+        for build in self.builds:
+            tasks = [ self.scheduler.get(name) for name in build['tasks'] ]
+            install = tasks[-1]
+            errors = [ "%s: %s" % (task.name, task.error) for task in tasks if task.status == 'failed' ]
+            timings = { }
+            for task in tasks:
+                elapsed = task.elapsed()
+                if elapsed is None:
+                    # Skipped or never finished - keep any time from earlier tasks
+                    timings.setdefault(task.stage, None)
+                    continue
+                if timings.get(task.stage) is not None:
+                    elapsed += timings[task.stage]
+                timings[task.stage] = elapsed
+            results.append( { 'kickstart': build['kickstart'], 'arch': build['arch'], 'region': build['region'],
+                              'status': install.status, 'ami': install.result,
+                              'installer_ami': self.scheduler.get(build['installer_ami']).result,
+                              'error': '; '.join(errors) or install.error, 'timings': timings } )
+        return results
+
+
+def format_results(results):
+    """
+    Format build results as a plain text table
+    """
+    stages = [ 'image', 'upload', 'copy', 'install' ]
+    header = [ 'kickstart', 'arch', 'region', 'status', 'ami' ] + stages
+    rows = [ header ]
+    for result in results:
+        timings = [ ]
+        for stage in stages:
+            elapsed = result['timings'].get(stage)
+            timings.append("-" if elapsed is None else "%.0fs" % (elapsed))
+        rows.append([ result['kickstart'], result['arch'], result['region'], result['status'],
+                      result['ami'] or '-' ] + timings)
+    widths = [ max([ len(str(row[column])) for row in rows ]) for column in range(len(header)) ]
+    lines = [ '  '.join([ str(value).ljust(width) for (value, width) in zip(row, widths) ]).rstrip() for row in rows ]
+    for result in results:
+        if result['error']:
+            lines.append("%s/%s/%s: %s" % (result['kickstart'], result['arch'], result['region'], result['error']))
+    return '\n'.join(lines)
@@ -0,0 +1,497 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# A small in-process streaming pipeline used to move image data
+#
+# A pipeline is a reader, any number of transform stages and a sink.  The
+# reader produces (offset, buffer) pairs, where offset is the position of the
+# data in the source file.  Each transform takes a pair and returns a list of
+# pairs to hand to the next stage, and the sink writes the buffers out.  Every
+# stage counts the bytes going in and coming out.
+#
+# Buffers belong to the reader and are reused as soon as the pipeline is done
+# with them - stages that need to hold on to data must copy it.
+
+import os
+import errno
+import struct
+import zlib
+import hashlib
+import logging
+import threading
+import subprocess
+import Queue
+from tempfile import TemporaryFile
+from time import time
+
+BUFFER_SIZE = 4 * 1024 * 1024
+BUFFER_COUNT = 4
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _splice = _libc.splice
+    _splice.restype = ctypes.c_ssize_t
+    _splice.argtypes = [ ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint ]
+except (ImportError, OSError, AttributeError):
+    _splice = None
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+
+# Record header understood by ebs_receiver.py - type, offset, length
+RECORD_HEADER = struct.Struct('!cQQ')
+
+
+class Stage(object):
+    """
+    Base class for pipeline stages - passes data through unchanged
+    """
+
+    def __init__(self, name=None):
+        super(Stage, self).__init__()
+        self.name = name or self.__class__.__name__
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def process(self, offset, buf):
+        self.bytes_in += len(buf)
+        result = self.transform(offset, buf)
+        for (out_offset, out_buf) in result:
+            self.bytes_out += len(out_buf)
+        return result
+
+    def transform(self, offset, buf):
+        return [ (offset, buf) ]
+
+    def finish(self):
+        """
+        Called once all data has been processed - returns any trailing data
+        """
+        result = self.flush()
+        for (out_offset, out_buf) in result:
+            self.bytes_out += len(out_buf)
+        return result
+
+    def flush(self):
+        return [ ]
+
+    def counters(self):
+        return (self.name, self.bytes_in, self.bytes_out)
+
+
+class ExtentReader(Stage):
+    """
+    Reads the listed (offset, length) extents of a file into a small pool of
+    reusable buffers.  Reading is done in a background thread so that it
+    overlaps with the work done by the rest of the pipeline.
+    """
+
+    def __init__(self, filename, extents, buffer_size=BUFFER_SIZE, buffer_count=BUFFER_COUNT):
+        super(ExtentReader, self).__init__('read')
+        self.filename = filename
+        self.extents = extents
+        self.buffer_size = buffer_size
+        self.buffer_count = buffer_count
+
+    def __iter__(self):
+        free = Queue.Queue()
+        filled = Queue.Queue()
+        for i in range(self.buffer_count):
+            free.put(bytearray(self.buffer_size))
+        stop = threading.Event()
+
+        def _reader():
+            try:
+                f = open(self.filename, 'rb')
+                try:
+                    for (offset, length) in self.extents:
+                        f.seek(offset)
+                        while length > 0 and not stop.is_set():
+                            buf = free.get()
+                            view = memoryview(buf)[:min(self.buffer_size, length)]
+                            count = f.readinto(view)
+                            if count == 0:
+                                raise Exception("Unexpected end of file reading (%s) at offset %d" % (self.filename, f.tell()))
+                            filled.put( (offset, buf, view[:count]) )
+                            offset += count
+                            length -= count
+                finally:
+                    f.close()
+                filled.put(None)
+            except Exception as e:
+                filled.put(e)
+
+        thread = threading.Thread(target=_reader)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = filled.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                (offset, buf, view) = item
+                self.bytes_in += len(view)
+                self.bytes_out += len(view)
+                yield (offset, view)
+                # The consumer is done with the buffer once it asks for the next one
+                free.put(buf)
+        finally:
+            stop.set()
+            # Unblock the reader if it is waiting for a buffer
+            free.put(bytearray(self.buffer_size))
+            thread.join()
+
+    def splice_to(self, fd):
+        """
+        Move the extents straight into fd without copying them through user
+        space.  Returns False without moving anything if splice is unavailable.
+        """
+        if _splice is None:
+            return False
+        src = os.open(self.filename, os.O_RDONLY)
+        try:
+            first = True
+            for (offset, length) in self.extents:
+                position = ctypes.c_longlong(offset)
+                while length > 0:
+                    count = _splice(src, ctypes.byref(position), fd, None, min(length, self.buffer_size),
+                                    SPLICE_F_MOVE | SPLICE_F_MORE)
+                    if count < 0:
+                        err = ctypes.get_errno()
+                        if err == errno.EINTR:
+                            continue
+                        if first and err in (errno.EINVAL, errno.ENOSYS):
+                            # Nothing has moved yet so the caller can fall back
+                            return False
+                        raise OSError(err, os.strerror(err))
+                    if count == 0:
+                        raise Exception("Unexpected end of file reading (%s) at offset %d" % (self.filename, position.value))
+                    first = False
+                    length -= count
+                    self.bytes_in += count
+                    self.bytes_out += count
+        finally:
+            os.close(src)
+        return True
+
+
+class MeterStage(Stage):
+    """
+    Reports the size of everything passing through to callback
+    """
+
+    def __init__(self, callback):
+        super(MeterStage, self).__init__('meter')
+        self.callback = callback
+
+    def transform(self, offset, buf):
+        self.callback(len(buf))
+        return [ (offset, buf) ]
+
+
+class ChunkHashStage(Stage):
+    """
+    Computes the SHA256 of every chunk_size piece of the source file from the
+    data passing through.  The gaps between extents are hashed as zeros.
+    Chunks that no data fell into are left out of hashes - they are all holes.
+    """
+
+    def __init__(self, chunk_size, size):
+        super(ChunkHashStage, self).__init__('hash')
+        self.chunk_size = chunk_size
+        self.size = size
+        self.hashes = { }
+        self._digest = None
+        self._index = None
+        self._position = 0
+
+    def transform(self, offset, buf):
+        start = offset
+        self._advance(offset)
+        view = memoryview(buf)
+        while len(view) > 0:
+            index = offset / self.chunk_size
+            if index != self._index:
+                self._finish_chunk()
+                self._index = index
+                self._digest = hashlib.sha256()
+                # Zeros from the start of the chunk up to the data
+                self._zeros(offset - index * self.chunk_size)
+            piece = min(len(view), (index + 1) * self.chunk_size - offset)
+            self._digest.update(view[:piece])
+            offset += piece
+            view = view[piece:]
+            if offset == min((index + 1) * self.chunk_size, self.size):
+                self._finish_chunk()
+        self._position = offset
+        return [ (start, buf) ]
+
+    def flush(self):
+        self._advance(self.size)
+        self._finish_chunk()
+        return [ ]
+
+    def _advance(self, offset):
+        # Pad the chunk in progress with zeros up to offset or its end
+        if self._index is not None and offset > self._position:
+            chunk_end = min((self._index + 1) * self.chunk_size, self.size)
+            self._zeros(min(offset, chunk_end) - self._position)
+            if offset >= chunk_end:
+                self._finish_chunk()
+        self._position = max(self._position, offset)
+
+    def _zeros(self, length):
+        zeros = '\0' * min(length, 1024 * 1024)
+        while length > 0:
+            self._digest.update(zeros[:min(len(zeros), length)])
+            length -= len(zeros)
+
+    def _finish_chunk(self):
+        if self._index is not None:
+            self.hashes[self._index] = self._digest.hexdigest()
+        self._index = None
+        self._digest = None
+
+
+class SparseFilterStage(Stage):
+    """
+    Drops block_size pieces that are entirely zero.  Only useful in front of a
+    RecordFramer, as the offsets of the remaining data have to travel with it.
+    """
+
+    def __init__(self, block_size=64 * 1024):
+        super(SparseFilterStage, self).__init__('sparse')
+        self.block_size = block_size
+        self._zeros = '\0' * block_size
+
+    def transform(self, offset, buf):
+        view = memoryview(buf) if not isinstance(buf, memoryview) else buf
+        result = [ ]
+        start = None
+        for i in range(0, len(view), self.block_size):
+            block = view[i:i + self.block_size]
+            if block.tobytes() == self._zeros[:len(block)]:
+                if start is not None:
+                    result.append( (offset + start, view[start:i]) )
+                    start = None
+            elif start is None:
+                start = i
+        if start is not None:
+            result.append( (offset + start, view[start:]) )
+        return result
+
+
+class RecordFramer(Stage):
+    """
+    Wraps each piece of data in a record carrying its offset, for the remote
+    ebs_receiver.py.  hash_ranges is a list of (offset, length) ranges of the
+    device that the receiver should hash once all of the data is written.
+    """
+
+    def __init__(self, hash_ranges=None):
+        super(RecordFramer, self).__init__('frame')
+        self.hash_ranges = hash_ranges or [ ]
+
+    def transform(self, offset, buf):
+        return [ (None, RECORD_HEADER.pack('D', offset, len(buf))), (offset, buf) ]
+
+    def flush(self):
+        result = [ ]
+        for (offset, length) in self.hash_ranges:
+            result.append( (None, RECORD_HEADER.pack('H', offset, length)) )
+        result.append( (None, RECORD_HEADER.pack('E', 0, 0)) )
+        return result
+
+
+class GzipStage(Stage):
+    """
+    In-process gzip compression - the output can be read by 'gzip -d'
+    """
+
+    def __init__(self, level=6):
+        super(GzipStage, self).__init__('gzip')
+        # wbits of 16 + MAX_WBITS selects the gzip container
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def transform(self, offset, buf):
+        # zlib in python 2 does not take memoryviews
+        out = self._compressor.compress(buf.tobytes() if isinstance(buf, memoryview) else buf)
+        if out:
+            return [ (None, out) ]
+        return [ ]
+
+    def flush(self):
+        return [ (None, self._compressor.flush()) ]
+
+
+class CommandSink(Stage):
+    """
+    Writes the stream into a chain of piped commands.  commands is a list of
+    argv lists - the first reads from the pipeline, each one feeds the next and
+    the output of the last is collected for error reporting.  If line_callback
+    is set it is also called with each line of output from the last command as
+    it arrives.
+    """
+
+    def __init__(self, commands, line_callback=None):
+        super(CommandSink, self).__init__('sink')
+        self.commands = commands
+        self.line_callback = line_callback
+        self.processes = [ ]
+        self.output = None
+        self.lines = [ ]
+        self._line_thread = None
+
+    def start(self):
+        self.output = TemporaryFile()
+        stdin = subprocess.PIPE
+        for (i, cmd) in enumerate(self.commands):
+            last = i == len(self.commands) - 1
+            if last and not self.line_callback:
+                stdout = self.output
+            else:
+                stdout = subprocess.PIPE
+            p = subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=self.output)
+            if self.processes:
+                # Only the downstream process should hold the read end
+                self.processes[-1].stdout.close()
+            self.processes.append(p)
+            stdin = p.stdout
+
+        if self.line_callback:
+            self._line_thread = threading.Thread(target=self._read_lines, args=(self.processes[-1].stdout,))
+            self._line_thread.daemon = True
+            self._line_thread.start()
+
+    def _read_lines(self, stdout):
+        for line in iter(stdout.readline, ''):
+            self.lines.append(line)
+            try:
+                self.line_callback(line.rstrip('\n'))
+            except Exception:
+                logging.getLogger(__name__).warning("Exception in output line callback", exc_info = True)
+
+    def fileno(self):
+        return self.processes[0].stdin.fileno()
+
+    def transform(self, offset, buf):
+        fd = self.fileno()
+        view = memoryview(buf) if not isinstance(buf, memoryview) else buf
+        while len(view) > 0:
+            count = os.write(fd, view)
+            self.bytes_out += count
+            view = view[count:]
+        return [ ]
+
+    def close(self):
+        """
+        Close our end of the pipe, wait for the commands and raise if any failed
+        """
+        if self.processes and not self.processes[0].stdin.closed:
+            try:
+                self.processes[0].stdin.close()
+            except IOError:
+                pass
+        for p in self.processes:
+            p.wait()
+        if self._line_thread:
+            self._line_thread.join()
+
+        out = ''.join(self.lines)
+        if self.output:
+            self.output.seek(0, 0)
+            out += self.output.read()
+            self.output.close()
+        # Report every failure, furthest downstream first - upstream ones are
+        # usually just the broken pipe that it caused
+        failed = [ "'%s' failed(%d)" % (' '.join(cmd), p.returncode)
+                   for (cmd, p) in reversed(zip(self.commands, self.processes)) if p.returncode ]
+        if failed:
+            raise Exception("%s: %s" % (', '.join(failed), out))
+        return out
+
+
+class Pipeline(object):
+    """
+    Connects a reader, a list of transform stages and a sink
+    """
+
+    def __init__(self, reader, transforms, sink, log=None):
+        super(Pipeline, self).__init__()
+        self.reader = reader
+        self.transforms = transforms
+        self.sink = sink
+        self.log = log or logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.elapsed = None
+
+    def stages(self):
+        return [ self.reader ] + self.transforms + [ self.sink ]
+
+    def counters(self):
+        """
+        List of (stage name, bytes in, bytes out) tuples
+        """
+        return [ stage.counters() for stage in self.stages() ]
+
+    def run(self):
+        """
+        Move all of the data and return the number of bytes read from the source
+        """
+        start = time()
+        broken_pipe = None
+        self.sink.start()
+        try:
+            try:
+                # With nothing to do in between, let the kernel move the data
+                if not self.transforms and self.reader.splice_to(self.sink.fileno()):
+                    self.sink.bytes_in = self.sink.bytes_out = self.reader.bytes_out
+                else:
+                    for (offset, buf) in self.reader:
+                        self._push(0, [ (offset, buf) ])
+                    for i in range(len(self.transforms)):
+                        self._push(i + 1, self.transforms[i].finish())
+            except (IOError, OSError) as e:
+                # EPIPE means the far end died - report that below instead
+                if e.errno != errno.EPIPE:
+                    raise
+                broken_pipe = e
+        finally:
+            self.sink.close()
+        if broken_pipe:
+            # Every command exited cleanly, but one stopped reading early -
+            # whatever it passed on is truncated
+            raise Exception("Pipeline stopped taking data after %d of %d bytes: %s" %
+                            (self.sink.bytes_out, self.reader.bytes_out, broken_pipe))
+        self.elapsed = time() - start
+        return self.reader.bytes_out
+
+    def _push(self, first, items):
+        for stage in self.transforms[first:]:
+            result = [ ]
+            for (offset, buf) in items:
+                result.extend(stage.process(offset, buf))
+            items = result
+        for (offset, buf) in items:
+            self.sink.process(offset, buf)
+
+    def log_counters(self, prefix=''):
+        for (name, bytes_in, bytes_out) in self.counters():
+            self.log.debug("%s%s: %d bytes in, %d bytes out" % (prefix, name, bytes_in, bytes_out))
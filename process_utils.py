@@ -78,6 +78,35 @@ def ssh_execute_command(guestaddr, sshprivkey, command, timeout=10, user='root',
     else:
         return subprocess_check_output(cmd)
 
+def ssh_command(guestaddr, sshprivkey, command, timeout=30, user='root'):
+    """
+    Function to build an ssh argv suitable for streaming binary data to or from
+    a command on the guest.  Unlike ssh_execute_command no tty is allocated, as
+    that would mangle the data.
+    """
+    return ["ssh", "-i", sshprivkey,
+            "-F", "/dev/null",
+            "-o", "ServerAliveInterval=30",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "ConnectTimeout=" + str(timeout),
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "PasswordAuthentication=no",
+            "%s@%s" % (user, guestaddr), command]
+
+def ssh_upload_data(guestaddr, sshprivkey, data, destination, timeout=30, user='root'):
+    """
+    Function to write the string data to the file destination on the guest
+    """
+    cmd = ssh_command(guestaddr, sshprivkey, "cat > %s" % destination, timeout=timeout, user=user)
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    stdout, stderr = process.communicate(data)
+    retcode = process.poll()
+
+    if retcode:
+        raise Exception("Upload of %s to %s failed(%d): %s" % (destination, guestaddr, retcode, stdout))
+    return (stdout, stderr, retcode)
+
 def enable_root(guestaddr, sshprivkey, user, prefix):
     for cmd in ('mkdir /root/.ssh',
                 'chmod 600 /root/.ssh',
@@ -14,8 +14,11 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import guestfs
 import ozutil
+import download_utils
+import ext2_utils
+import ConfigParser
+import hashlib
 import re
 import shutil
 import sys
@@ -23,26 +26,98 @@ import logging
 import os
 import os.path
 from tempfile import mkdtemp
+from time import time
 from string import Template
+from install_proxy import proxy_url, upstream_host
 
-def create_ext2_image(image_file, image_size=(1024*1024*200)):
-    raw_fs_image=open(image_file,"w")
-    raw_fs_image.truncate(image_size)
-    raw_fs_image.close()
+# libguestfs is only needed by BootImageSession and the functions that use it -
+# generate_install_image() builds its image with ext2_utils by default
+try:
+    import guestfs
+except ImportError:
+    guestfs = None
 
-    g = guestfs.GuestFS()
+def _guestfs():
+    if not guestfs:
+        raise Exception("libguestfs python bindings are not installed - try 'yum install python-libguestfs'")
+    return guestfs.GuestFS()
 
-    g.add_drive(image_file)
+def create_ext2_image(image_file, image_size=(1024*1024*200)):
+    session = BootImageSession()
+    session.add(image_file, None, image_size)
+    session.build()
 
-    g.launch()
 
-    g.part_disk("/dev/sda","msdos")
-    g.part_set_mbr_id("/dev/sda",1,0x83)
-    g.mkfs("ext2", "/dev/sda1")
-    g.part_set_bootable("/dev/sda", 1, 1)
-    g.sync()
-    
-    #g.shutdown()
+class BootImageSession(object):
+    """
+    Builds any number of boot images in a single libguestfs appliance.  Each
+    image added gets one bootable partition holding a filesystem of fs_type
+    and a copy of a content directory.  build() launches the appliance with
+    every image attached, fills them all and shuts it down again.
+    """
+
+    def __init__(self, fs_type="ext2"):
+        super(BootImageSession, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.fs_type = fs_type
+        self.images = [ ]
+
+    def add(self, image_file, contentdir, image_size=(1024*1024*200)):
+        """
+        Create image_file, to be filled with the contents of contentdir - or
+        left empty if that is None - by build()
+        """
+        raw_fs_image = open(image_file, "w")
+        raw_fs_image.truncate(image_size)
+        raw_fs_image.close()
+        self.images.append( (image_file, contentdir) )
+
+    def build(self):
+        g = _guestfs()
+        try:
+            # More images than the appliance can attach take more than one launch
+            max_disks = g.max_disks()
+        finally:
+            g.close()
+        for i in range(0, len(self.images), max_disks):
+            self._build(self.images[i:i + max_disks])
+        self.images = [ ]
+
+    def _build(self, images):
+        start = time()
+        g = _guestfs()
+        try:
+            for (image_file, contentdir) in images:
+                g.add_drive_opts(image_file, format="raw")
+            g.launch()
+            try:
+                for ((image_file, contentdir), device) in zip(images, g.list_devices()):
+                    _make_boot_filesystem(g, device, self.fs_type)
+                    if contentdir:
+                        _copy_tree_to_image(g, device + "1", contentdir)
+                g.sync()
+            finally:
+                g.shutdown()
+        finally:
+            g.close()
+        self.log.debug("Built %d boot images in one appliance in %.1f seconds" % (len(images), time() - start))
+
+
+def _make_boot_filesystem(g, device, fs_type):
+    g.part_disk(device, "msdos")
+    g.part_set_mbr_id(device, 1, 0x83)
+    g.mkfs(fs_type, device + "1")
+    g.part_set_bootable(device, 1, 1)
+
+
+def _copy_tree_to_image(g, partition, contentdir):
+    g.mount_options("", partition, "/")
+    for (dirpath, dirnames, filenames) in os.walk(contentdir):
+        target = os.path.normpath(os.path.join("/", os.path.relpath(dirpath, contentdir)))
+        g.mkdir_p(target)
+        for filename in filenames:
+            g.upload(os.path.join(dirpath, filename), os.path.join(target, filename))
+    g.umount_all()
 
 
 def generate_boot_content(url, dest_dir, distro, create_volume):
@@ -55,6 +130,8 @@ def generate_boot_content(url, dest_dir, distro, create_volume):
     if distro == "rpm":
         kernel_url = url + "images/pxeboot/vmlinuz"
         initrd_url = url + "images/pxeboot/initrd.img"
+        sum_urls = [ url + ".treeinfo" ]
+        sum_names = { kernel_url: "images/pxeboot/vmlinuz", initrd_url: "images/pxeboot/initrd.img" }
         if create_volume:
             # NOTE: RHEL5 and other older Anaconda versions do not support specifying the CDROM device - use with caution
             cmdline = "ks=http://169.254.169.254/latest/user-data repo=cdrom:/dev/vdb"
@@ -63,13 +140,23 @@ def generate_boot_content(url, dest_dir, distro, create_volume):
     elif distro == "ubuntu":
         kernel_url = url + "main/installer-amd64/current/images/netboot/ubuntu-installer/amd64/linux"
         initrd_url = url + "main/installer-amd64/current/images/netboot/ubuntu-installer/amd64/initrd.gz"
+        # Older releases only publish MD5SUMS
+        sum_urls = [ url + "main/installer-amd64/current/images/SHA256SUMS",
+                     url + "main/installer-amd64/current/images/MD5SUMS" ]
+        sum_names = { kernel_url: "./netboot/ubuntu-installer/amd64/linux",
+                      initrd_url: "./netboot/ubuntu-installer/amd64/initrd.gz" }
         cmdline = "append preseed/url=http://169.254.169.254/latest/user-data debian-installer/locale=en_US console-setup/layoutcode=us netcfg/choose_interface=auto keyboard-configuration/layoutcode=us priority=critical --"
 
-    kernel_dest = os.path.join(dest_dir,"vmlinuz")
-    http_download_file(kernel_url, kernel_dest)
+    # The tree's checksum files come first so that the kernel and ramdisk
+    # can be checked as they download.  They are small, optional and go no
+    # further than the cache.
+    manager = download_utils.download_manager()
+    manager.fetch_all([ (sum_url, None) for sum_url in sum_urls ], optional=sum_urls)
+    expected = boot_content_checksums(manager.cache, sum_urls, sum_names)
 
+    kernel_dest = os.path.join(dest_dir,"vmlinuz")
     initrd_dest = os.path.join(dest_dir,"initrd.img")
-    http_download_file(initrd_url, initrd_dest)
+    manager.fetch_all([ (kernel_url, kernel_dest), (initrd_url, initrd_dest) ], expected=expected)
 
     pvgrub_conf="""# This file is for use with pv-grub; legacy grub is not installed in this image
 default=0
@@ -85,24 +172,66 @@ title Anaconda install inside of EC2
     f.write(pvgrub_conf)
     f.close()
 
-def http_download_file(url, filename):
-    fd = os.open(filename,os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
+def boot_content_checksums(cache, sum_urls, sum_names):
+    """
+    Read the expected checksums of the files in sum_names - { URL: name in
+    the checksum file } - from the .treeinfo, SHA256SUMS or MD5SUMS files at
+    sum_urls in cache.  The first file listing a name is used for it.
+    Returns { URL: (algorithm, hex digest) } for those they list.
+    """
+    log = logging.getLogger(__name__)
+    expected = { }
+    for sum_url in sum_urls:
+        if not cache.entry(sum_url):
+            continue
+        sum_file = cache.data_path(sum_url)
+        for (url, name) in sum_names.items():
+            if url in expected:
+                continue
+            if sum_url.endswith(".treeinfo"):
+                checksum = treeinfo_checksum(sum_file, name)
+            elif sum_url.endswith("MD5SUMS"):
+                checksum = ozutil.get_md5sum_from_file(sum_file, name)
+                if checksum:
+                    checksum = ('md5', checksum)
+            else:
+                checksum = ozutil.get_sha256sum_from_file(sum_file, name)
+                if checksum:
+                    checksum = ('sha256', checksum)
+            if checksum:
+                expected[url] = checksum
+    for url in sum_names:
+        if url not in expected:
+            log.warning("No checksum for %s in %s - it will not be verified" % (url, " or ".join(sum_urls)))
+    return expected
+
+def treeinfo_checksum(treeinfo, name):
+    # The [checksums] section of a .treeinfo looks like this:
+    # images/pxeboot/vmlinuz = sha256:5b2a0e3a...
+    config = ConfigParser.RawConfigParser()
     try:
-        ozutil.http_download_file(url, fd, False, logging.getLogger())
-    finally:
-        os.close(fd)
-
+        config.read(treeinfo)
+        (algorithm, digest) = config.get('checksums', name).split(':', 1)
+        hashlib.new(algorithm.strip().lower())
+    except (ConfigParser.Error, ValueError):
+        return None
+    return (algorithm.strip().lower(), digest.strip())
 
 def copy_content_to_image(contentdir, target_image):
-    g = guestfs.GuestFS()
-    g.add_drive(target_image)
-    g.launch()
-    g.mount_options ("", "/dev/sda1", "/")
-    g.mkdir_p("/boot/grub")
-    for filename in os.listdir(contentdir):
-        g.upload(os.path.join(contentdir,filename),"/boot/grub/" + filename)
-    g.sync()
-    #g.shutdown()
+    g = _guestfs()
+    try:
+        g.add_drive_opts(target_image, format="raw")
+        g.launch()
+        try:
+            g.mount_options ("", "/dev/sda1", "/")
+            g.mkdir_p("/boot/grub")
+            for filename in os.listdir(contentdir):
+                g.upload(os.path.join(contentdir,filename),"/boot/grub/" + filename)
+            g.sync()
+        finally:
+            g.shutdown()
+    finally:
+        g.close()
 
 
 def install_extract_bits(install_file, distro):
@@ -200,6 +329,45 @@ def do_pw_sub(ks_file, admin_password):
     f.close()
     return working_ks
 
+def rewrite_install_urls(install_script, proxy, hosts=None):
+    """
+    Point the install tree and repo URLs in install_script at the caching
+    install proxy at proxy (see install_proxy.py) - kickstart url and repo
+    lines are rewritten and preseeds get a mirror/http/proxy line.  The
+    upstream host of everything sent through the proxy is added to the set
+    hosts, if given, for the proxy's allow list.
+    """
+    distro = detect_distro(install_script)
+    if not proxy or not distro:
+        return install_script
+
+    def _rewrite(m):
+        url = proxy_url(proxy, m.group(2))
+        if hosts is not None and url != m.group(2):
+            hosts.add(upstream_host(m.group(2)))
+        return m.group(1) + url
+
+    lines = [ ]
+    proxy_set = False
+    for line in install_script.splitlines(True):
+        if distro == "rpm" and re.match("\s*(url|repo)\s", line):
+            line = re.sub("(--(?:url|baseurl)[=\s]\s*[\"']?)([^\s\"']+)", _rewrite, line)
+        elif distro == "ubuntu" and re.match("d-i\s+mirror/http/proxy\s", line):
+            line = "d-i mirror/http/proxy string %s\n" % (proxy)
+            proxy_set = True
+        elif distro == "ubuntu" and hosts is not None:
+            # The mirror and security hosts apt will ask the proxy for
+            m = re.match("d-i\s+(?:mirror/http/hostname|apt-setup/security_host)\s+string\s+(\S+)", line)
+            if m:
+                hosts.add(m.group(1).lower())
+            m = re.match("#ubuntu_baseurl=(\S+)", line)
+            if m:
+                hosts.add(upstream_host(m.group(1)))
+        lines.append(line)
+    if distro == "ubuntu" and not proxy_set:
+        lines.append("d-i mirror/http/proxy string %s\n" % (proxy))
+    return "".join(lines)
+
 def detect_distro(install_script):
 
     for line in install_script.splitlines():
@@ -211,11 +379,15 @@ def detect_distro(install_script):
     return None
 
 
-def generate_install_image(ks_file, image_filename):
+def stage_install_content(ks_file, staging_dir):
+    """
+    Lay out the boot content for the installer described by ks_file in
+    staging_dir as the image's filesystem will hold it
+    """
     # No need for PW sub here - the relevant bits can be read without sub
     working_kickstart = open(ks_file).read()
     distro = detect_distro(working_kickstart)
-    if not detect_distro:
+    if not distro:
         raise Exception("Could not determine distro type from install script '%s'" % (ks_file))
     (install_tree_url, console_password, console_command, poweroff) = install_extract_bits(working_kickstart, distro)
 
@@ -228,14 +400,42 @@ def generate_install_image(ks_file, image_filename):
     if not install_tree_url:
         raise Exception("ERROR: no install tree URL specified and could not extract one from the kickstart/install-script")
 
-    create_ext2_image(image_filename, image_size=(1024*1024*200))
+    boot_dir = os.path.join(staging_dir, "boot", "grub")
+    os.makedirs(boot_dir)
+    generate_boot_content(install_tree_url, boot_dir, distro, False)
+
+def generate_install_image(ks_file, image_filename, method=None):
+    """
+    Build a pvgrub bootable install image - method is passed on to
+    ext2_utils.create_boot_image(), or is 'guestfs' to use libguestfs
+    """
+    if method == "guestfs":
+        generate_install_images([ (ks_file, image_filename) ])
+        return
     tmp_content_dir = mkdtemp()
     try:
-        generate_boot_content(install_tree_url, tmp_content_dir, distro, False)
-        copy_content_to_image(tmp_content_dir, image_filename)
+        stage_install_content(ks_file, tmp_content_dir)
+        ext2_utils.create_boot_image(image_filename, tmp_content_dir, image_size=(1024*1024*200), method=method)
     finally:
         shutil.rmtree(tmp_content_dir)
 
+def generate_install_images(images, fs_type="ext2"):
+    """
+    Build the install images in images - a list of (ks_file, image_filename)
+    - with one libguestfs appliance
+    """
+    tmp_content_dirs = [ ]
+    try:
+        session = BootImageSession(fs_type)
+        for (ks_file, image_filename) in images:
+            tmp_content_dirs.append(mkdtemp())
+            stage_install_content(ks_file, tmp_content_dirs[-1])
+            session.add(image_filename, tmp_content_dirs[-1], image_size=(1024*1024*200))
+        session.build()
+    finally:
+        for tmp_content_dir in tmp_content_dirs:
+            shutil.rmtree(tmp_content_dir)
+
 if __name__ == "__main__":
     # stuff only to run when not called via 'import' here
     if len(sys.argv) != 3:
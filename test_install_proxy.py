@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Tests for install_proxy.py against a local stand-in for an install tree -
+# a SimpleHTTPServer serving a few files from a temporary directory.
+
+import os
+import os.path
+import json
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+try:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from httplib import HTTPConnection
+except ImportError:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from http.client import HTTPConnection
+
+import install_proxy
+from install_proxy import InstallProxy
+
+TREE_FILES = { 'repodata/repomd.xml': b'<repomd/>\n',
+               'images/install.img': bytes(bytearray([ i % 251 for i in range(3 * install_proxy.BLOCK_SIZE + 1234) ])) }
+
+
+class TreeHandler(SimpleHTTPRequestHandler):
+    # Set to the tree directory and a list of (method, path) per request
+    tree = None
+    requests = None
+
+    def translate_path(self, path):
+        return os.path.join(self.tree, path.split('?')[0].lstrip('/'))
+
+    def do_GET(self):
+        self.requests.append( ('GET', self.path) )
+        SimpleHTTPRequestHandler.do_GET(self)
+
+    def do_HEAD(self):
+        self.requests.append( ('HEAD', self.path) )
+        SimpleHTTPRequestHandler.do_HEAD(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InstallProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        tree = os.path.join(self.work_dir, 'tree')
+        for (name, data) in TREE_FILES.items():
+            path = os.path.join(tree, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = open(path, 'wb')
+            f.write(data)
+            f.close()
+        TreeHandler.tree = tree
+        TreeHandler.requests = self.requests = [ ]
+        self.tree_server = HTTPServer(('127.0.0.1', 0), TreeHandler)
+        self.tree_thread = threading.Thread(target=self.tree_server.serve_forever)
+        self.tree_thread.daemon = True
+        self.tree_thread.start()
+        self.tree_url = "http://127.0.0.1:%d/" % (self.tree_server.server_address[1])
+
+        # The stand-in is on loopback, which the proxy otherwise always refuses
+        self.local_address = install_proxy.local_address
+        install_proxy.local_address = lambda host: False
+        self.proxy = InstallProxy(os.path.join(self.work_dir, 'cache'), address='127.0.0.1', port=0,
+                                  public_host='127.0.0.1', allowed_hosts=[ '127.0.0.1' ])
+        self.proxy.start()
+
+    def tearDown(self):
+        install_proxy.local_address = self.local_address
+        self.proxy.stop()
+        self.tree_server.shutdown()
+        self.tree_server.server_close()
+        self.tree_thread.join()
+        shutil.rmtree(self.work_dir)
+
+    def request(self, name, method='GET', headers=None, url=None):
+        connection = HTTPConnection('127.0.0.1', self.proxy.server.server_address[1], timeout=30)
+        try:
+            path = "/" + install_proxy.proxy_url("", url or self.tree_url + name).lstrip('/')
+            connection.request(method, path, headers=headers or { })
+            response = connection.getresponse()
+            return (response.status, dict([ (k.lower(), v) for (k, v) in response.getheaders() ]), response.read())
+        finally:
+            connection.close()
+
+    def stats(self):
+        return json.loads(self.request(None, url="/stats")[2].decode('utf-8'))
+
+    def upstream(self, method):
+        return len([ r for r in self.requests if r[0] == method ])
+
+    def test_cold_then_warm(self):
+        data = TREE_FILES['images/install.img']
+        (status, headers, body) = self.request('images/install.img')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, data)
+        (status, headers, body) = self.request('images/install.img')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, data)
+        self.assertEqual(self.upstream('GET'), 1)
+        self.assertEqual(self.stats()['hits'], 1)
+
+    def test_head(self):
+        size = len(TREE_FILES['images/install.img'])
+        (status, headers, body) = self.request('images/install.img', 'HEAD')
+        self.assertEqual(status, 200)
+        self.assertEqual(int(headers['content-length']), size)
+        # A cold HEAD asks upstream with a HEAD and caches nothing
+        self.assertEqual((self.upstream('HEAD'), self.upstream('GET')), (1, 0))
+        self.assertEqual(self.stats()['files'], 0)
+        self.request('images/install.img')
+        (status, headers, body) = self.request('images/install.img', 'HEAD')
+        self.assertEqual(status, 200)
+        self.assertEqual(int(headers['content-length']), size)
+        self.assertEqual((self.upstream('HEAD'), self.upstream('GET')), (1, 1))
+
+    def test_range(self):
+        data = TREE_FILES['images/install.img']
+        start = install_proxy.BLOCK_SIZE - 10
+        end = install_proxy.BLOCK_SIZE + 20
+        # Cold - the stand-in ignores Range, so the proxy cuts the range out as it downloads
+        (status, headers, body) = self.request('images/install.img', headers={ 'Range': 'bytes=%d-%d' % (start, end) })
+        self.assertEqual(status, 206)
+        self.assertEqual(headers['content-range'], "bytes %d-%d/%d" % (start, end, len(data)))
+        self.assertEqual(body, data[start:end + 1])
+        # The download carried on to fill the cache - this waits for it if need be
+        self.assertEqual(self.request('images/install.img')[2], data)
+        # Warm
+        (status, headers, body) = self.request('images/install.img', headers={ 'Range': 'bytes=-100' })
+        self.assertEqual(status, 206)
+        self.assertEqual(body, data[-100:])
+        (status, headers, body) = self.request('images/install.img', headers={ 'Range': 'bytes=%d-' % (len(data)) })
+        self.assertEqual(status, 416)
+        self.assertEqual(self.upstream('GET'), 1)
+
+    def test_refused(self):
+        (status, headers, body) = self.request(None, url="http://example.com/pub/")
+        self.assertEqual(status, 403)
+        install_proxy.local_address = self.local_address
+        self.proxy.allow_hosts([ '169.254.169.254' ])
+        (status, headers, body) = self.request(None, url="http://169.254.169.254/latest/meta-data/")
+        self.assertEqual(status, 403)
+        (status, headers, body) = self.request('repodata/repomd.xml')
+        self.assertEqual(status, 403)
+        self.assertEqual(self.requests, [ ])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    unittest.main()
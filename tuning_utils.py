@@ -0,0 +1,267 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Instance type selection from the timings of earlier builds
+
+import os
+import os.path
+import json
+import fcntl
+import logging
+import threading
+from time import time
+
+# Hourly on demand price in us-east-1 and the architectures each type can run
+INSTANCE_TYPES = { 't1.micro':   (0.020, [ 'i386', 'x86_64' ]),
+                   'm1.small':   (0.060, [ 'i386', 'x86_64' ]),
+                   'm1.medium':  (0.120, [ 'i386', 'x86_64' ]),
+                   'c1.medium':  (0.145, [ 'i386', 'x86_64' ]),
+                   'm1.large':   (0.240, [ 'x86_64' ]),
+                   'm1.xlarge':  (0.480, [ 'x86_64' ]),
+                   'm3.xlarge':  (0.500, [ 'x86_64' ]),
+                   'm3.2xlarge': (1.000, [ 'x86_64' ]),
+                   'c1.xlarge':  (0.580, [ 'x86_64' ]),
+                   'm2.xlarge':  (0.410, [ 'x86_64' ]) }
+
+DEFAULT_INSTANCE_TYPE = 'm1.small'
+
+# Too little memory for the installers
+INSTALLER_EXCLUDED_TYPES = [ 't1.micro' ]
+DEFAULT_HISTORY = os.path.expanduser("~/.ebshelper/instance_history.json")
+
+# Only the most recent timings of each kind are kept and used
+HISTORY_DEPTH = 10
+
+
+class InstanceHistory(object):
+    """
+    Durations of build phases by distro and instance type, kept in a JSON
+    file.  Phases that move data, such as an upload, can record the size
+    moved as well and are then estimated by rate rather than by time.
+    Builds running at the same time can share one file - each timing is
+    merged into whatever is in the file when it is recorded.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY):
+        super(InstanceHistory, self).__init__()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.path = path
+        self.lock = threading.Lock()
+        # "distro/instance type/phase" -> list of [ seconds, size ]
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return { }
+        f = open(self.path)
+        try:
+            return json.load(f)
+        except ValueError:
+            self.log.warning("Instance history (%s) is not valid JSON - starting a new one" % (self.path))
+            return { }
+        finally:
+            f.close()
+
+    def record(self, distro, instance_type, phase, seconds, size=None):
+        self.lock.acquire()
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            lock_file = open(self.path + '.lock', 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                # Start from the file, so that timings recorded by other
+                # builds since it was last read are kept
+                self.entries = self._load()
+                key = self._key(distro, instance_type, phase)
+                self.entries[key] = (self.entries.get(key, [ ]) + [ [ seconds, size ] ])[-HISTORY_DEPTH:]
+                self._save()
+            finally:
+                # Closing the file drops the flock
+                lock_file.close()
+        finally:
+            self.lock.release()
+        self.log.debug("Recorded %s on %s for (%s): %.1f seconds" % (phase, instance_type, distro, seconds))
+
+    def estimate(self, distro, instance_type, phase, size=None):
+        """
+        Expected seconds for phase, or None if it has never been recorded
+        """
+        self.lock.acquire()
+        try:
+            entries = list(self.entries.get(self._key(distro, instance_type, phase), [ ]))
+        finally:
+            self.lock.release()
+        if not entries:
+            return None
+        if size:
+            rates = [ float(entry_size) / seconds for (seconds, entry_size) in entries if entry_size and seconds > 0 ]
+            if rates:
+                return size / _median(rates)
+        return _median([ seconds for (seconds, entry_size) in entries ])
+
+    def _key(self, distro, instance_type, phase):
+        return "%s/%s/%s" % (distro, instance_type, phase)
+
+    def _save(self):
+        # Called with both locks held
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+
+class PhaseTimer(object):
+    """
+    Times one phase of a build for an InstanceHistory, which may be None to
+    time nothing
+    """
+
+    def __init__(self, history, distro, instance_type, phase, size=None):
+        super(PhaseTimer, self).__init__()
+        self.history = history
+        self.distro = distro
+        self.instance_type = instance_type
+        self.phase = phase
+        self.size = size
+        self.start = time()
+
+    def done(self):
+        if self.history:
+            self.history.record(self.distro, self.instance_type, self.phase, time() - self.start, self.size)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def candidate_types(arch=None, installer=False):
+    """
+    Instance types that can run arch, cheapest first - without those too
+    small for an installer if installer is True
+    """
+    return [ name for (price, name) in sorted([ (price, name) for (name, (price, arches)) in INSTANCE_TYPES.items()
+                                                if (not arch or arch in arches) and
+                                                   not (installer and name in INSTALLER_EXCLUDED_TYPES) ]) ]
+
+
+def choose_instance_type(history, distro, phases, arch=None, policy='time', candidates=None, size=None, log=None,
+                         installer=False):
+    """
+    Return the instance type with the lowest estimated total time for phases
+    or, with policy 'cost', the lowest time x hourly price.  Candidates
+    without history for every phase are tried first, cheapest first, so that
+    each gets measured.  size is passed to estimates of rate based phases.
+    installer leaves out the types too small to run an installer.
+    """
+    log = log or logging.getLogger(__name__)
+    best = None
+    for instance_type in candidates or candidate_types(arch, installer):
+        estimates = [ history.estimate(distro, instance_type, phase, size) for phase in phases ]
+        if None in estimates:
+            log.debug("No timings for %s for (%s) - trying it" % (instance_type, distro))
+            return instance_type
+        seconds = sum(estimates)
+        score = seconds
+        if policy == 'cost':
+            score = seconds * INSTANCE_TYPES[instance_type][0]
+        log.debug("Instance type %s for (%s): estimated %.0f seconds, score %.2f" % (instance_type, distro, seconds, score))
+        if best is None or score < best[0]:
+            best = (score, instance_type)
+    if not best:
+        log.debug("No candidate instance types for (%s) - using %s" % (distro, DEFAULT_INSTANCE_TYPE))
+        return DEFAULT_INSTANCE_TYPE
+    log.debug("Chose instance type %s for (%s) by %s" % (best[1], distro, policy))
+    return best[1]
+
+
+def resolve_instance_type(instance_type, history, distro, phases, arch=None, policy='time', size=None, log=None,
+                          installer=False):
+    """
+    Return instance_type, unless it is 'auto', in which case pick one from
+    history
+    """
+    if instance_type != 'auto':
+        return instance_type
+    return choose_instance_type(history, distro, phases, arch, policy, size=size, log=log, installer=installer)
+
+
+# Ways of making an AMI from a stopped install instance - see AMIHelper
+IMAGE_METHODS = [ 'create_image', 'snapshot' ]
+
+
+def image_history_key(region):
+    # Image timings depend on the region, not the distro
+    return "image:%s" % (region)
+
+
+def choose_image_method(history, region, log=None):
+    """
+    Return the image method that has made AMIs available fastest in region.
+    Methods with no timings yet are tried first, so that both get measured.
+    """
+    log = log or logging.getLogger(__name__)
+    estimates = [ ]
+    for method in IMAGE_METHODS:
+        seconds = history.estimate(image_history_key(region), method, 'available')
+        if seconds is None:
+            log.debug("No image timings for %s in (%s) - trying it" % (method, region))
+            return method
+        estimates.append((seconds, method))
+    log.debug("Image timings in (%s): %s" % (region, ", ".join([ "%s %.0f seconds" % (method, seconds)
+                                                                   for (seconds, method) in estimates ])))
+    return min(estimates)[1]
+
+
+def benchmark_instance_types(ami_helper, install_ami, user_data, distro, instance_types, history,
+                             img_size=10, keep_amis=False):
+    """
+    Run the same install on each of instance_types at once, recording the
+    phase timings of each in history.  The AMIs produced are deregistered
+    unless keep_amis is set.  Returns { instance type: (seconds, error) }.
+    """
+    results = { }
+
+    def _worker(instance_type):
+        start = time()
+        try:
+            # Each run needs its own helper - they hold the state of one launch
+            helper = ami_helper.__class__(None, None, None, connection=ami_helper.conn, history=history)
+            ami = helper.launch_wait_snapshot(install_ami, user_data, img_size, instance_type=instance_type,
+                                              distro=distro)
+            results[instance_type] = (time() - start, None)
+            if not keep_amis:
+                helper.deregister_ami(ami)
+        except Exception as e:
+            ami_helper.log.error("Benchmark install on %s failed" % (instance_type), exc_info = True)
+            results[instance_type] = (time() - start, str(e))
+
+    threads = [ ]
+    for instance_type in instance_types:
+        thread = threading.Thread(target=_worker, args=(instance_type,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
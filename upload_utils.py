@@ -0,0 +1,735 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#   Copyright (C) 2013 Ian McLeod <imcleod@redhat.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Helpers for moving local image files into block devices on a remote host
+
+import os
+import re
+import errno
+import hashlib
+import json
+import subprocess
+import threading
+import multiprocessing
+import ozutil
+import pipeline_utils
+from time import time
+
+# Not exposed by the os module in python 2 - values are from linux/fs.h
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# Granularity of the zero block scan - large enough to keep the python side
+# cheap, small enough to find the holes in a freshly made filesystem
+ZERO_SCAN_BLOCK = 64 * 1024
+
+# Holes smaller than this are not worth a separate remote dd invocation
+MIN_HOLE_SIZE = 1024 * 1024
+
+READ_SIZE = 1024 * 1024
+
+# Unit of verification and retransmission for resumable uploads
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def file_extents(filename, scan_zeros=False):
+    """
+    Return a list of (offset, length) tuples covering the parts of filename
+    that may contain non-zero data.  Holes are found with SEEK_DATA/SEEK_HOLE
+    where the filesystem supports it and with a zero block scan otherwise.
+    A filesystem without real hole support reports the whole file as one
+    data extent, so that is scanned too.  If scan_zeros is True the data
+    extents reported by the filesystem are always scanned, which catches
+    zeros that were written out explicitly.
+    """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        try:
+            extents = _seek_data_extents(fd, size)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOTSUP):
+                raise
+            # Kernel or filesystem does not know about SEEK_DATA - treat the
+            # whole file as data and fall back to scanning it
+            extents = [ (0, size) ]
+            scan_zeros = True
+        if extents == [ (0, size) ]:
+            # Fully allocated, or the generic SEEK_DATA of a filesystem that
+            # cannot tell - either way only a scan will find the zeros
+            scan_zeros = True
+
+        if scan_zeros:
+            scanned = [ ]
+            for (offset, length) in extents:
+                scanned.extend(_zero_scan_extents(fd, offset, length))
+            extents = scanned
+    finally:
+        os.close(fd)
+
+    return coalesce_extents(extents, MIN_HOLE_SIZE)
+
+
+def _seek_data_extents(fd, size):
+    extents = [ ]
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            # ENXIO means there is no more data past offset
+            if e.errno == errno.ENXIO:
+                break
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        extents.append( (start, end - start) )
+        offset = end
+    return extents
+
+
+def _zero_scan_extents(fd, offset, length):
+    # Same idea as ozutil.copyfile_sparse - compare whole buffers against a
+    # zero string first and only look at individual blocks when that fails
+    zero_read = '\0' * READ_SIZE
+    zero_block = '\0' * ZERO_SCAN_BLOCK
+    extents = [ ]
+    start = None
+    os.lseek(fd, offset, os.SEEK_SET)
+    end = offset + length
+    while offset < end:
+        buf = os.read(fd, min(READ_SIZE, end - offset))
+        if len(buf) == 0:
+            break
+        if buf == zero_read[:len(buf)]:
+            blocks = [ (offset, len(buf), True) ]
+        else:
+            blocks = [ ]
+            for i in range(0, len(buf), ZERO_SCAN_BLOCK):
+                block = buf[i:i + ZERO_SCAN_BLOCK]
+                blocks.append( (offset + i, len(block), block == zero_block[:len(block)]) )
+        for (block_offset, block_len, is_zero) in blocks:
+            if is_zero:
+                if start is not None:
+                    extents.append( (start, block_offset - start) )
+                    start = None
+            elif start is None:
+                start = block_offset
+        offset += len(buf)
+    if start is not None:
+        extents.append( (start, offset - start) )
+    return extents
+
+
+def coalesce_extents(extents, min_hole):
+    """
+    Merge extents that are separated by holes smaller than min_hole
+    """
+    merged = [ ]
+    for (offset, length) in sorted(extents):
+        if length == 0:
+            continue
+        if merged and offset - (merged[-1][0] + merged[-1][1]) < min_hole:
+            last_offset = merged[-1][0]
+            merged[-1] = (last_offset, max(merged[-1][1], offset + length - last_offset))
+        else:
+            merged.append( (offset, length) )
+    return merged
+
+
+def extents_size(extents):
+    return sum([ length for (offset, length) in extents ])
+
+
+def split_extents(extents, count, align=READ_SIZE):
+    """
+    Split a list of extents into count lists carrying roughly equal amounts of
+    data.  The lists only ever change over at align boundaries in the file, so
+    no align sized piece of the file is shared between two lists.  Lists that
+    would be empty are dropped, so fewer than count may be returned.
+    """
+    total = extents_size(extents)
+    if count <= 1 or total == 0:
+        return [ list(extents) ]
+
+    share = total / count
+    groups = [ [ ] ]
+    group_bytes = 0
+    for (offset, length) in extents:
+        while length > 0:
+            if group_bytes >= share and offset % align == 0 and len(groups) < count:
+                groups.append([ ])
+                group_bytes = 0
+            piece = min(length, (offset / align + 1) * align - offset)
+            group = groups[-1]
+            if group and group[-1][0] + group[-1][1] == offset:
+                group[-1] = (group[-1][0], group[-1][1] + piece)
+            else:
+                group.append( (offset, piece) )
+            group_bytes += piece
+            offset += piece
+            length -= piece
+    return groups
+
+
+def read_extents(filename, extents, buf_size=READ_SIZE):
+    """
+    Generator returning the contents of the listed extents of filename, in
+    order, as a series of strings of at most buf_size bytes
+    """
+    f = open(filename, 'rb')
+    try:
+        for (offset, length) in extents:
+            f.seek(offset)
+            while length > 0:
+                buf = f.read(min(buf_size, length))
+                if len(buf) == 0:
+                    raise Exception("Unexpected end of file reading (%s) at offset %d" % (filename, f.tell()))
+                length -= len(buf)
+                yield buf
+    finally:
+        f.close()
+
+
+def dd_extent_script(extents, device, block_size=READ_SIZE):
+    """
+    Generate a shell script that reads the concatenated extents from stdin and
+    writes each one to its own offset in device.  The holes between extents are
+    skipped, which is safe when the target is a freshly created EBS volume that
+    already reads back as zeros.
+    """
+    lines = [ '#!/bin/sh', 'set -e' ]
+    for (offset, length) in extents:
+        # count_bytes and seek_bytes let us use large blocks without requiring
+        # the extents to be block aligned - fullblock stops short pipe reads
+        # from being treated as partial records
+        lines.append('dd of=%s bs=%d seek=%d count=%d iflag=fullblock,count_bytes oflag=seek_bytes conv=notrunc 2>/dev/null' %
+                     (device, block_size, offset, length))
+    return '\n'.join(lines) + '\n'
+
+
+class UploadOptions(object):
+    """
+    How data is moved into a volume - the settings shared by every stream of
+    an upload
+    """
+
+    def __init__(self, codec, streams=1, receiver=None, direct=False, block_size=4 * 1024 * 1024, sparse=False):
+        super(UploadOptions, self).__init__()
+        self.codec = codec
+        self.streams = streams
+        # Path of ebs_receiver.py on the utility instance, or None for dd
+        self.receiver = receiver
+        self.direct = direct
+        self.block_size = block_size
+        self.sparse = sparse
+        # Called with the size of each buffer sent, if set
+        self.meter = None
+
+    def receiver_command(self, device):
+        command = "python %s --device %s --block-size %d" % (self.receiver, device, self.block_size)
+        if self.direct:
+            command += " --direct"
+        return command
+
+
+def parse_receiver_hashes(lines, chunk_size):
+    """
+    Turn the HASH lines printed by ebs_receiver.py into a dict of chunk index
+    to hex digest
+    """
+    hashes = { }
+    for line in lines:
+        m = re.match("^HASH (\d+) (\d+) ([0-9a-f]{64})", line.strip())
+        if m:
+            hashes[int(m.group(1)) / chunk_size] = m.group(3)
+    return hashes
+
+
+class ThroughputLimiter(object):
+    """
+    Caps the number of uploads copying data at the same time.  The cap starts
+    at one and is raised by one each time the uploads have run for window
+    seconds at the current cap, with more waiting to start, at an aggregate
+    throughput at least gain times the best seen so far.  Uploads starting
+    and finishing inside a window do not restart it - throughput is measured
+    across the whole window.  Once a step fails to improve the cap is frozen.
+    """
+
+    def __init__(self, max_limit, log, window=20, gain=1.1):
+        super(ThroughputLimiter, self).__init__()
+        self.max_limit = max(1, max_limit)
+        self.log = log
+        self.window = window
+        self.gain = gain
+        self.limit = 1
+        self.active = 0
+        self.bytes = 0
+        self.best_rate = None
+        self.frozen = False
+        self.cond = threading.Condition()
+        # The first window starts with the first upload
+        self.window_start = None
+        self.window_bytes = 0
+        self.demand = False
+
+    def add(self, nbytes):
+        self.cond.acquire()
+        try:
+            self.bytes += nbytes
+            self._evaluate()
+        finally:
+            self.cond.release()
+
+    def acquire(self):
+        self.cond.acquire()
+        try:
+            if self.window_start is None:
+                self._reset_window()
+            while self.active >= self.limit:
+                # Held back by the cap - this window can tell whether to raise it
+                self.demand = True
+                self.cond.wait(1)
+                self._evaluate()
+            self.active += 1
+        finally:
+            self.cond.release()
+
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.active -= 1
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _reset_window(self):
+        self.window_start = time()
+        self.window_bytes = self.bytes
+        self.demand = False
+
+    def _evaluate(self):
+        # Called with the lock held - only a full window at the current cap
+        # with uploads waiting on it says anything about whether the cap is right
+        if self.frozen or self.window_start is None or self.limit >= self.max_limit:
+            return
+        elapsed = time() - self.window_start
+        if elapsed < self.window or not self.demand:
+            return
+        rate = (self.bytes - self.window_bytes) / elapsed
+        if self.best_rate is None or rate >= self.best_rate * self.gain:
+            self.best_rate = rate
+            self.limit += 1
+            self.log.debug("Aggregate upload throughput %.2f MiB/s - allowing %d concurrent uploads" %
+                           (rate / (1024 ** 2), self.limit))
+            self.cond.notify_all()
+        else:
+            self.frozen = True
+            self.log.debug("Aggregate upload throughput %.2f MiB/s did not improve on %.2f MiB/s - holding at %d concurrent uploads" %
+                           (rate / (1024 ** 2), self.best_rate / (1024 ** 2), self.limit))
+        self._reset_window()
+
+
+class Codec(object):
+    """
+    A compression program that can sit on either end of an upload stream.
+    level and threads are only passed to codecs that understand them.
+    """
+
+    # name: (compress argv, decompress command, default level, threaded)
+    PROGRAMS = { 'none': (None, None, None, False),
+                 'gzip': ([ 'gzip', '-c' ], 'gzip -d -c', 6, False),
+                 'pigz': ([ 'pigz', '-c' ], 'pigz -d -c', 6, True),
+                 'zstd': ([ 'zstd', '-c', '-q' ], 'zstd -d -c -q', 3, True),
+                 'lz4':  ([ 'lz4', '-c', '-q' ], 'lz4 -d -c -q', 1, False) }
+
+    def __init__(self, name, level=None, threads=None):
+        super(Codec, self).__init__()
+        if name not in self.PROGRAMS:
+            raise Exception("Unknown compression codec (%s) - must be one of: %s" % (name, ', '.join(sorted(self.PROGRAMS.keys()))))
+        self.name = name
+        self.level = level if level is not None else self.PROGRAMS[name][2]
+        if self.PROGRAMS[name][3]:
+            self.threads = threads or multiprocessing.cpu_count()
+        else:
+            self.threads = None
+
+    def __str__(self):
+        desc = self.name
+        if self.level is not None:
+            desc += ' -%d' % (self.level)
+        if self.threads:
+            desc += ' (%d threads)' % (self.threads)
+        return desc
+
+    def compress_command(self):
+        base = self.PROGRAMS[self.name][0]
+        if base is None:
+            return None
+        cmd = base + [ '-%d' % (self.level) ]
+        if self.name == 'pigz':
+            cmd += [ '-p', str(self.threads) ]
+        elif self.name == 'zstd':
+            cmd += [ '-T%d' % (self.threads) ]
+        return cmd
+
+    def compress_stage(self):
+        """
+        A pipeline_utils stage that compresses in-process in place of
+        compress_command(), or None if the codec needs its program
+        """
+        if self.name == 'gzip':
+            return pipeline_utils.GzipStage(self.level)
+        return None
+
+    def decompress_command(self):
+        return self.PROGRAMS[self.name][1]
+
+    def programs(self):
+        """
+        Names of the executables needed on the local and remote side
+        """
+        if self.name == 'none':
+            return [ ]
+        return [ self.name ]
+
+
+def get_codec(spec):
+    """
+    Turn a codec specification like 'zstd' or 'zstd:19' into a Codec object.
+    Codec objects are passed through unchanged.
+    """
+    if isinstance(spec, Codec):
+        return spec
+    parts = spec.split(':')
+    level = None
+    if len(parts) > 1 and parts[1]:
+        level = int(parts[1])
+    return Codec(parts[0], level=level)
+
+
+def local_codecs(names=None):
+    """
+    Default instances of every codec (or just the ones named) whose program is
+    present on this machine
+    """
+    codecs = [ ]
+    for name in sorted(names or Codec.PROGRAMS.keys()):
+        codec = Codec(name)
+        try:
+            for program in codec.programs():
+                ozutil.executable_exists(program)
+        except Exception:
+            continue
+        codecs.append(codec)
+    return codecs
+
+
+def sample_extents(extents, count=4, size=4 * 1024 * 1024):
+    """
+    Return up to count extents of at most size bytes spread evenly over the data
+    in extents
+    """
+    total = extents_size(extents)
+    if total <= count * size:
+        return list(extents)
+
+    samples = [ ]
+    step = total / count
+    for i in range(count):
+        # Walk the extents to find the one holding this position in the data
+        position = i * step
+        for (offset, length) in extents:
+            if position < length:
+                samples.append( (offset + position, min(size, length - position)) )
+                break
+            position -= length
+    return samples
+
+
+def benchmark_codec(codec, sample):
+    """
+    Compress and decompress the string sample with codec and return a tuple of
+    (compression ratio, compress seconds, decompress seconds)
+    """
+    if codec.name == 'none':
+        return (1.0, 0.0, 0.0)
+
+    def _run(cmd, data):
+        start = time()
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = p.communicate(data)
+        if p.returncode:
+            raise Exception("'%s' failed(%d): %s" % (' '.join(cmd), p.returncode, err))
+        return (out, time() - start)
+
+    stage = codec.compress_stage()
+    if stage:
+        start = time()
+        compressed = ''.join([ buf for (offset, buf) in stage.process(0, sample) + stage.finish() ])
+        compress_time = time() - start
+    else:
+        (compressed, compress_time) = _run(codec.compress_command(), sample)
+    (plain, decompress_time) = _run(codec.decompress_command().split(), compressed)
+    if plain != sample:
+        raise Exception("Codec (%s) did not round trip the sample data" % (codec))
+    return (float(len(compressed)) / max(len(sample), 1), compress_time, decompress_time)
+
+
+def choose_codec(filename, extents, link_speed, codecs, log):
+    """
+    Sample the data in extents of filename and return the codec from codecs
+    with the lowest predicted end to end upload time over a link that moves
+    link_speed bytes per second.  The stages of the upload run concurrently so
+    the prediction for each codec is the time taken by its slowest stage.
+    """
+    sample = ''.join(read_extents(filename, sample_extents(extents)))
+    total = extents_size(extents)
+    if not sample or not codecs:
+        return Codec('none')
+
+    best = None
+    for codec in codecs:
+        try:
+            (ratio, compress_time, decompress_time) = benchmark_codec(codec, sample)
+        except Exception as e:
+            log.debug("Codec %s failed its benchmark - skipping: %s" % (codec, e))
+            continue
+        scale = float(total) / len(sample)
+        predicted = max(compress_time * scale, decompress_time * scale, total * ratio / link_speed)
+        log.debug("Codec %s: ratio %.3f, compress %.1f MiB/s, decompress %.1f MiB/s, predicted upload %.1f seconds" %
+                  (codec, ratio, _rate(len(sample), compress_time), _rate(len(sample), decompress_time), predicted))
+        if best is None or predicted < best[0]:
+            best = (predicted, codec)
+
+    if best is None:
+        return Codec('none')
+    log.info("Selected codec %s for (%s) - %d bytes of data, link %.1f MiB/s, predicted upload %.1f seconds" %
+             (best[1], filename, total, link_speed / float(1024 ** 2), best[0]))
+    return best[1]
+
+
+def _rate(nbytes, seconds):
+    if seconds <= 0:
+        return float('inf')
+    return nbytes / seconds / (1024 ** 2)
+
+
+class UploadManifest(object):
+    """
+    SHA256 hashes of each chunk_size piece of an image file, saved next to
+    the image along with the EBS volume it is being copied into so that an
+    interrupted upload can be verified and completed later.
+    """
+
+    def __init__(self, path, filename, chunk_size=CHUNK_SIZE):
+        super(UploadManifest, self).__init__()
+        self.path = path
+        self.filename = os.path.abspath(filename)
+        self.chunk_size = chunk_size
+        self.size = None
+        self.mtime = None
+        self.hashes = [ ]
+        self.volume_id = None
+        self.zone = None
+
+    def save(self):
+        state = { 'filename': self.filename, 'chunk_size': self.chunk_size,
+                  'size': self.size, 'mtime': self.mtime, 'hashes': self.hashes,
+                  'volume_id': self.volume_id, 'zone': self.zone }
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def chunk_range(self, index):
+        offset = index * self.chunk_size
+        return (offset, min(self.chunk_size, self.size - offset))
+
+    def current(self):
+        """
+        True if the manifest still describes the image file on disk.  The
+        hashes may not have been filled in yet.
+        """
+        st = os.stat(self.filename)
+        return self.size == st.st_size and self.mtime == st.st_mtime
+
+    def chunk_count(self):
+        return (self.size + self.chunk_size - 1) / self.chunk_size
+
+    def set_hashes(self, chunk_hashes):
+        """
+        Fill in the hashes from a dict of chunk index to hex digest, as produced
+        by pipeline_utils.ChunkHashStage.  Missing chunks are all zeros.
+        """
+        self.hashes = [ ]
+        zero_hashes = { }
+        for index in range(self.chunk_count()):
+            if index in chunk_hashes:
+                self.hashes.append(chunk_hashes[index])
+                continue
+            length = self.chunk_range(index)[1]
+            if length not in zero_hashes:
+                zero_hashes[length] = _zero_hash(length)
+            self.hashes.append(zero_hashes[length])
+
+    def compute(self, extents):
+        """
+        Hash every chunk of the file.  Chunks that do not overlap any of the
+        data extents are all holes and are not read at all.
+        """
+        self.hashes = [ ]
+        zero_hashes = { }
+        f = open(self.filename, 'rb')
+        try:
+            for index in range(self.chunk_count()):
+                (offset, length) = self.chunk_range(index)
+                if not chunk_extents(extents, [ index ], self.chunk_size):
+                    if length not in zero_hashes:
+                        zero_hashes[length] = _zero_hash(length)
+                    self.hashes.append(zero_hashes[length])
+                    continue
+                digest = hashlib.sha256()
+                f.seek(offset)
+                while length > 0:
+                    buf = f.read(min(READ_SIZE, length))
+                    if len(buf) == 0:
+                        raise Exception("Unexpected end of file reading (%s) at offset %d" % (self.filename, f.tell()))
+                    digest.update(buf)
+                    length -= len(buf)
+                self.hashes.append(digest.hexdigest())
+        finally:
+            f.close()
+
+
+def manifest_path(filename):
+    return filename + '.upload-manifest'
+
+
+def manifest_zone(path):
+    """
+    Return the availability zone of the volume recorded in the manifest at path,
+    if any, so that a utility instance can be started next to it
+    """
+    if not os.path.exists(path):
+        return None
+    f = open(path, 'r')
+    try:
+        return json.load(f).get('zone')
+    except ValueError:
+        return None
+    finally:
+        f.close()
+
+
+def load_manifest(path, filename, chunk_size=CHUNK_SIZE):
+    """
+    Return the manifest saved at path if it still matches filename, otherwise
+    a new one for filename.  The hashes of a new manifest are left empty so
+    that they can be computed while the file is streamed.
+    """
+    manifest = UploadManifest(path, filename, chunk_size)
+    if os.path.exists(path):
+        f = open(path, 'r')
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        if state.get('filename') == manifest.filename and state.get('chunk_size') == chunk_size:
+            manifest.size = state.get('size')
+            manifest.mtime = state.get('mtime')
+            manifest.hashes = state.get('hashes', [ ])
+            manifest.volume_id = state.get('volume_id')
+            manifest.zone = state.get('zone')
+            if manifest.current():
+                return manifest
+        manifest = UploadManifest(path, filename, chunk_size)
+
+    st = os.stat(manifest.filename)
+    manifest.size = st.st_size
+    manifest.mtime = st.st_mtime
+    manifest.save()
+    return manifest
+
+
+def _zero_hash(length):
+    digest = hashlib.sha256()
+    zeros = '\0' * min(READ_SIZE, length)
+    while length > 0:
+        digest.update(zeros[:min(len(zeros), length)])
+        length -= len(zeros)
+    return digest.hexdigest()
+
+
+def chunk_extents(extents, chunks, chunk_size):
+    """
+    Return the parts of extents that fall inside the listed chunk indexes
+    """
+    result = [ ]
+    for index in sorted(chunks):
+        chunk_start = index * chunk_size
+        chunk_end = chunk_start + chunk_size
+        for (offset, length) in extents:
+            start = max(offset, chunk_start)
+            end = min(offset + length, chunk_end)
+            if start < end:
+                result.append( (start, end - start) )
+    return coalesce_extents(result, 1)
+
+
+def extent_chunks(extents, chunk_size):
+    """
+    Return the sorted indexes of the chunks that extents touch
+    """
+    chunks = set()
+    for (offset, length) in extents:
+        if length > 0:
+            chunks.update(range(offset / chunk_size, (offset + length - 1) / chunk_size + 1))
+    return sorted(chunks)
+
+
+def remote_hash_script(manifest, device, chunks=None):
+    """
+    Generate a shell script that prints the index and SHA256 of each chunk of
+    device covered by the manifest, one chunk per line
+    """
+    if chunks is None:
+        chunks = range(manifest.chunk_count())
+    lines = [ '#!/bin/sh', 'set -e' ]
+    for index in chunks:
+        (offset, length) = manifest.chunk_range(index)
+        lines.append("printf '%d '; dd if=%s bs=%d skip=%d count=%d iflag=skip_bytes,count_bytes 2>/dev/null | sha256sum" %
+                     (index, device, READ_SIZE, offset, length))
+    return '\n'.join(lines) + '\n'
+
+
+def mismatched_chunks(manifest, remote_output):
+    """
+    Compare the output of a remote_hash_script run with the manifest and
+    return the indexes of chunks that are wrong or were not reported at all
+    """
+    remote = { }
+    for line in remote_output.splitlines():
+        m = re.match("^(\d+) ([0-9a-f]{64})", line.strip())
+        if m:
+            remote[int(m.group(1))] = m.group(2)
+    return [ index for (index, digest) in enumerate(manifest.hashes) if remote.get(index) != digest ]